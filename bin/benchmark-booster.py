@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+'''
+Compare serializing & loading xgboost models through temporary files
+(how blackmagic used to do it) with serializing them in memory, for each
+model format.  blackmagic uses the binary format (segaux.bytes_from_booster).
+
+    $ PYTHONPATH=. python bin/benchmark-booster.py [--rounds 500] [--rows 20000] [--iterations 20]
+
+The model is trained on random data shaped like blackmagic training data
+(68 independent variables, 9 classes), so only its size is realistic.
+'''
+
+from blackmagic import segaux
+
+import argparse
+import numpy
+import os
+import tempfile
+import timeit
+import xgboost as xgb
+
+# file extension and save_raw format of each model format
+FORMATS = {'binary': ('', 'deprecated'),
+           'ubj':    ('.ubj', 'ubj'),
+           'json':   ('.json', 'json')}
+
+
+def file_bytes_from_booster(booster, extension):
+    f = tempfile.NamedTemporaryFile(suffix=extension, delete=False)
+    try:
+        booster.save_model(f.name)
+
+        with open(f.name, 'rb') as tf:
+            return tf.read()
+    finally:
+        os.remove(f.name)
+
+
+def file_booster_from_bytes(booster_bytes, params, extension):
+    f = tempfile.NamedTemporaryFile(suffix=extension, delete=False)
+    try:
+        with open(f.name, 'wb') as tf:
+            tf.write(booster_bytes)
+
+        return xgb.Booster(model_file=tf.name, params=params)
+    finally:
+        os.remove(f.name)
+
+
+def memory_bytes_from_booster(booster, raw_format):
+    return bytes(booster.save_raw(raw_format=raw_format))
+
+
+def train(rounds, rows):
+    data   = numpy.random.rand(rows, 68).astype(numpy.float32)
+    labels = numpy.random.randint(0, 9, rows)
+
+    return xgb.train(params={'objective': 'multi:softprob',
+                             'num_class': 9,
+                             'max_depth': 8,
+                             'tree_method': 'hist'},
+                     dtrain=xgb.DMatrix(data, label=labels),
+                     num_boost_round=rounds)
+
+
+def report(name, seconds, iterations):
+    print('{:<24} {:>10.2f} ms'.format(name, seconds / iterations * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark booster serialization')
+    parser.add_argument('--rounds', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    print('training {} rounds on {} rows'.format(args.rounds, args.rows))
+
+    model  = train(args.rounds, args.rows)
+    params = {'nthread': 1}
+    n      = args.iterations
+
+    # the binary format warns on every save
+    with xgb.config_context(verbosity=0):
+        for name, (extension, raw_format) in FORMATS.items():
+            file_bytes   = file_bytes_from_booster(model, extension)
+            memory_bytes = memory_bytes_from_booster(model, raw_format)
+
+            print('{} model size: {:.1f}MB file, {:.1f}MB in memory'.format(name,
+                                                                          len(file_bytes) / 1024 ** 2,
+                                                                          len(memory_bytes) / 1024 ** 2))
+
+            report('save via file', timeit.timeit(lambda: file_bytes_from_booster(model, extension), number=n), n)
+            report('save in memory', timeit.timeit(lambda: memory_bytes_from_booster(model, raw_format), number=n), n)
+            report('load via file', timeit.timeit(lambda: file_booster_from_bytes(file_bytes, params, extension), number=n), n)
+            report('load in memory', timeit.timeit(lambda: segaux.booster_from_bytes(memory_bytes, params), number=n), n)
+
+    report('segaux save', timeit.timeit(lambda: segaux.bytes_from_booster(model), number=n), n)
+
+
+if __name__ == '__main__':
+    main()
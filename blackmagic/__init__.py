@@ -1,15 +1,27 @@
+from contextlib import contextmanager
 from cytoolz import first
 from cytoolz import get
 from functools import wraps
 from multiprocessing import Pool
+from multiprocessing.pool import RUN
 
+import atexit
 import logging
 import os
+import threading
+
+logger = logging.getLogger('blackmagic')
 
 cfg = {'ard_url': os.environ['ARD_URL'],
        'aux_url': os.environ['AUX_URL'],
        'log_level': logging.INFO,
        'cpus_per_worker': int(os.environ.get('CPUS_PER_WORKER', 1)),
+       'pool_max_tasks': int(os.environ.get('POOL_MAX_TASKS', 1000)),
+       'shared_timeseries': bool(int(os.environ.get('SHARED_TIMESERIES', 0))),
+       'shared_timeseries_dir': os.environ.get('SHARED_TIMESERIES_DIR',
+                                               '/dev/shm' if os.path.isdir('/dev/shm') else None),
+       'booster_cache_bytes': int(os.environ.get('BOOSTER_CACHE_BYTES', 512 * 1024 ** 2)),
+       'prediction_chunk_rows': int(os.environ.get('PREDICTION_CHUNK_ROWS', 100000)),
        'xgboost': {'num_round': int(os.environ.get('XGBOOST_NUM_ROUND', 500)),
                    'test_size': float(os.environ.get('XGBOOST_TEST_SIZE', 0.2)),
                    'early_stopping_rounds': int(os.environ.get('XGBOOST_EARLY_STOPPING_ROUNDS', 10)),
@@ -17,6 +29,10 @@ cfg = {'ard_url': os.environ['ARD_URL'],
                    'target_samples': int(os.environ.get('XGBOOST_TARGET_SAMPLES', 20000000)),
                    'class_max': int(os.environ.get('XGBOOST_CLASS_MAX', 8000000)),
                    'class_min': int(os.environ.get('XGBOOST_CLASS_MIN', 600000)),
+                   'seed': int(os.environ['XGBOOST_SEED']) if os.environ.get('XGBOOST_SEED') else None,
+                   'external_memory': bool(int(os.environ.get('XGBOOST_EXTERNAL_MEMORY', 0))),
+                   'external_memory_dir': os.environ.get('XGBOOST_EXTERNAL_MEMORY_DIR', '') or None,
+                   'external_memory_bytes': int(os.environ.get('XGBOOST_EXTERNAL_MEMORY_BYTES', 256 * 1024 ** 2)),
                    'parameters': {'objective': 'multi:softprob',
                                   'num_class': 9,
                                   'max_depth': 8,
@@ -26,8 +42,96 @@ cfg = {'ard_url': os.environ['ARD_URL'],
                                   'nthread': int(os.environ.get('CPUS_PER_WORKER', 1))}}}
 
 
+_pool = {'pool': None, 'pid': None, 'size': None}
+_pool_lock = threading.Lock()
+
+
+def _healthy(pool):
+    '''Check the pool is running and none of its processes have died.
+
+       Processes recycled after pool_max_tasks exit cleanly, so only a
+       nonzero exit code counts.  This never waits behind queued tasks.
+    '''
+
+    return pool._state == RUN and all(w.exitcode in (None, 0) for w in pool._pool)
+
+
+def pool(cfg):
+    '''Return the long lived worker pool for this process.
+
+       The pool is created on first use and shared by every blueprint.
+       It is recreated when the process has forked since the pool was
+       built (gunicorn workers, --preload), when the configured size
+       changes or when it fails a health check.  Pool processes are 
+       recycled after cfg['pool_max_tasks'] tasks, 0 disables recycling.
+    '''
+
+    with _pool_lock:
+        p = _pool['pool']
+
+        if p is not None and _pool['pid'] != os.getpid():
+            # Inherited across a fork.  The pool's handler threads and
+            # processes belong to the parent, so leave them alone.
+            p = None
+        elif p is not None and _pool['size'] != cfg['cpus_per_worker']:
+            p.terminate()
+            p = None
+        elif p is not None and not _healthy(p):
+            logger.warning("worker pool failed health check, recreating")
+            p.terminate()
+            p = None
+            
+        if p is None:
+            p = Pool(cfg['cpus_per_worker'],
+                     maxtasksperchild=get('pool_max_tasks', cfg, None) or None)
+            
+            _pool.update({'pool': p,
+                          'pid': os.getpid(),
+                          'size': cfg['cpus_per_worker']})
+        return p
+
+
+@atexit.register
+def shutdown():
+    '''Close the worker pool when this process exits'''
+
+    with _pool_lock:
+        p = _pool['pool']
+
+        if p is not None and _pool['pid'] == os.getpid():
+            p.close()
+            p.join()
+
+        _pool.update({'pool': None, 'pid': None, 'size': None})
+
+
+def _discard(p):
+    '''Terminate p and forget it if it is still the shared pool'''
+
+    with _pool_lock:
+        if _pool['pool'] is p:
+            _pool.update({'pool': None, 'pid': None, 'size': None})
+
+    p.terminate()
+
+
+@contextmanager
 def workers(cfg):
-    return Pool(cfg['cpus_per_worker'])
+    '''Lend out the shared worker pool.
+
+       Unlike Pool.__exit__, leaving the block does not terminate the
+       pool so the next request pays for task dispatch only.  Leaving it
+       with an exception does, since tasks from the failed request may
+       still be queued and the next request would wait behind them.
+    '''
+
+    p = pool(cfg)
+
+    try:
+        yield p
+    except BaseException:
+        _discard(p)
+        raise
 
 
 def skip_on_exception(fn):
@@ -4,19 +4,22 @@ from blackmagic.blueprints.prediction import prediction
 from blackmagic.blueprints.health import health
 from blackmagic.blueprints.segment import segment
 from blackmagic.blueprints.tile import tile
+from blackmagic.data import cache
 from blackmagic.data import ceph
+from blackmagic.data import local
+from blackmagic.data import storage
 from cytoolz import merge
 from flask import Flask
 
 import blackmagic
 import logging
 
-cfg = merge(blackmagic.cfg, ceph.cfg)
+cfg = merge(blackmagic.cfg, ceph.cfg, cache.cfg, local.cfg)
 
 logging.basicConfig(format='%(asctime)-15s %(name)-15s %(levelname)-8s - %(message)s', level=cfg['log_level'])
 logger = logging.getLogger('blackmagic.app')
 
-ceph.Ceph(cfg).setup()
+storage(cfg).setup()
 
 app = Flask('blackmagic')
 app.register_blueprint(health)
@@ -1,3 +1,4 @@
+from blackmagic.data import cache
 from flask import Blueprint
 from flask import jsonify
 
@@ -6,3 +7,7 @@ health = Blueprint('health', __name__)
 @health.route('/health', methods=['GET'])
 def health_fn():
     return jsonify(True)
+
+@health.route('/health/cache', methods=['GET'])
+def cache_fn():
+    return jsonify(cache.stats())
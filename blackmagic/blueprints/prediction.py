@@ -3,8 +3,13 @@ from blackmagic import segaux
 from blackmagic import skip_on_empty
 from blackmagic import skip_on_exception
 from blackmagic import workers
+from blackmagic.data import cache
 from blackmagic.data import ceph
+from blackmagic.data import local
+from blackmagic.data import connect
 
+from collections import deque
+from collections import OrderedDict
 from cytoolz import assoc
 from cytoolz import count
 from cytoolz import dissoc
@@ -17,7 +22,9 @@ from cytoolz import groupby
 from cytoolz import merge
 from cytoolz import partial
 from cytoolz import second
+from cytoolz import take
 from cytoolz import thread_first
+from datetime import date
 from datetime import datetime
 from flask import Blueprint
 from flask import jsonify
@@ -35,12 +42,14 @@ import blackmagic
 import logging
 import merlin
 import numpy
+import os
+import threading
 import xgboost as xgb
 
 logger = logging.getLogger('blackmagic.prediction')
 prediction = Blueprint('prediction', __name__)
 
-cfg = merge(blackmagic.cfg, ceph.cfg)
+cfg = merge(blackmagic.cfg, ceph.cfg, cache.cfg, local.cfg)
 
 
 def log_request(ctx):
@@ -64,6 +73,28 @@ def log_request(ctx):
     return ctx
 
 
+def log_batch_request(ctx):
+    '''Create log message for batch HTTP request'''
+
+    tx = get('tx', ctx, None)
+    ty = get('ty', ctx, None)
+    m  = get('month', ctx, None)
+    d  = get('day', ctx, None)
+    ds = get('dates', ctx, None)
+    a  = get('acquired', ctx, None)
+    c  = get('chips', ctx, None)
+
+    logger.info("POST /predictions {tx},{ty},{m},{d},{ds},{a},{n},{c}".format(tx=tx,
+                                                                             ty=ty,
+                                                                             m=m,
+                                                                             d=d,
+                                                                             ds=ds,
+                                                                             a=a,
+                                                                             n=count(c or []),
+                                                                             c=c))
+    return ctx
+
+
 def exception_handler(ctx, http_status, name, fn):
     try:
         return fn(ctx)
@@ -74,15 +105,12 @@ def exception_handler(ctx, http_status, name, fn):
                                      'cy': get('cy', ctx, None),
                                      'month': get('month', ctx, None),
                                      'day':   get('day', ctx, None),
+                                     'dates': get('dates', ctx, None),
                                      'acquired': get('acquired', ctx, None),
                                      'exception': '{name} exception: {ex}'.format(name=name, ex=e),
                                      'http_status': http_status})
 
 
-def reformat(segments):
-    return map(segaux.prediction_format, segments)
-
-
 def booster(cfg, model_bytes):
     return segaux.booster_from_bytes(model_bytes,
                                      {'nthread': get_in(['xgboost', 'parameters', 'nthread'], cfg)})
@@ -120,7 +148,7 @@ def measure(fn):
 def segments(ctx, cfg):
     '''Return saved segments'''
 
-    with ceph.connect(cfg) as c:
+    with connect(cfg) as c:
         return assoc(ctx,
                      'segments',
                      c.select_segments(ctx['cx'], ctx['cy']))
@@ -138,28 +166,93 @@ def load_data(ctx, cfg):
                               segaux.combine,
                               segaux.unload_segments,
                               segaux.unload_aux,
-                              extract_segments,
-                              partial(segaux.prediction_dates,
-                                      month=get("month", ctx),
-                                      day=get("day", ctx)),
-                              segaux.average_reflectance,
-                              reformat))
+                              extract_segments))
+
+
+_boosters = {'pid': None, 'entries': OrderedDict(), 'size': 0}
+_boosters_lock = threading.Lock()
+
+
+def cached_booster(key):
+    '''Return the cached booster for (tx, ty, etag) or None'''
+
+    with _boosters_lock:
+        if _boosters['pid'] != os.getpid():
+            _boosters.update({'pid': os.getpid(), 'entries': OrderedDict(), 'size': 0})
+
+        entry = get(key, _boosters['entries'], None)
+
+        if entry is None:
+            return None
+
+        _boosters['entries'].move_to_end(key)
+        return first(entry)
+
+
+def cache_booster(key, model, size, capacity):
+    '''Cache a booster that was deserialized from size bytes, evicting
+       least recently used boosters and older versions of the same tile'''
+
+    with _boosters_lock:
+        entries = _boosters['entries']
+        
+        for k in [k for k in entries if k[:2] == key[:2]]:
+            _boosters['size'] -= second(entries.pop(k))
+
+        if size > capacity:
+            return model
+
+        entries[key] = (model, size)
+        _boosters['size'] += size
+
+        while _boosters['size'] > capacity:
+            _, (_, s) = entries.popitem(last=False)
+            _boosters['size'] -= s
+
+        return model
+
+
+def load_booster(tx, ty, cfg):
+    '''Return the trained model for tx, ty.
+
+       Boosters are cached per process keyed by (tx, ty, ETag), bounded
+       by cfg['booster_cache_bytes'] of serialized model.  Only a HEAD 
+       request is made while the tile is unchanged.
+    '''
+    
+    with connect(cfg) as c:
+        etag = c.select_tile_etag(tx, ty)
+
+        if etag is None:
+            raise Exception("No model found for tx:{tx} and ty:{ty}".format(tx=tx, ty=ty))
+
+        model = cached_booster((tx, ty, etag))
+
+        if model is not None:
+            return model
+        
+        tile = c.select_model(tx, ty, etag=etag)
+
+        if not tile:
+            raise Exception("No model found for tx:{tx} and ty:{ty}".format(tx=tx, ty=ty))
+
+        layout = get_in(['metadata', 'layout'], tile, segaux.FEATURE_LAYOUT)
+        
+        if layout != segaux.FEATURE_LAYOUT:
+            raise Exception("Model for tx:{tx} and ty:{ty} uses feature layout {l}, "
+                            "expected {e}".format(tx=tx, ty=ty, l=layout, e=segaux.FEATURE_LAYOUT))
+
+        return cache_booster((tx, ty, etag),
+                             booster(cfg, tile['model']),
+                             len(tile['model']),
+                             get('booster_cache_bytes', cfg, 0))
 
 
 @raise_on('test_load_model_exception')
 @skip_on_exception
 @measure
 def load_model(ctx, cfg):
-
-    with ceph.connect(cfg) as c:
-        ctile = c.select_tile(ctx['tx'], ctx['ty'])
-
-        model = bytes.fromhex(first(ctile)['model'])
-    
-        if model is None:
-            raise Exception("No model found for tx:{tx} and ty:{ty}".format(**ctx))
-        else:
-            return assoc(ctx, 'model_bytes', model)
+    return assoc(ctx, 'model', load_booster(ctx['tx'], ctx['ty'], cfg))
     
 
 @raise_on('test_group_data_exception')
@@ -177,24 +270,25 @@ def group_data(ctx):
 @skip_on_exception
 @measure
 def matrix(ctx):
-    
-    return assoc(ctx,
-                 'ndata',
-                 numpy.array([d['independent'] for d in ctx['data']], dtype='float32'))
+    '''Build the independent variables for every prediction date, with
+       the rows they describe, and date the default segments'''
+
+    rows, ndata = segaux.prediction_matrix(ctx['data'], ctx['dates'])
+
+    return merge(dissoc(ctx, 'data'),
+                 {'rows': rows,
+                  'ndata': ndata,
+                  'defaults': [assoc(d, 'pday', '0001-01-01') for d in get('defaults', ctx, [])]})
 
     
 @raise_on('test_prediction_exception')
 @skip_on_exception
 @measure
 def predictions(ctx, cfg):
-    model = booster(cfg, get('model_bytes', ctx))
-    probs = model.predict(xgb.DMatrix(ctx['ndata'])) if len(ctx['ndata']) > 0 else []
-    preds = []
-    
-    for i,v in enumerate(probs):
-        preds.append(assoc(ctx['data'][i], 'prob', v))
+    model = ctx['model']
+    probs = segaux.predict(model, ctx['ndata'], cfg['prediction_chunk_rows'])
 
-    return assoc(ctx, 'predictions', preds)
+    return assoc(ctx, 'predictions', segaux.prediction_records(ctx['rows'], probs))
 
     #############################################################
     # relying on position in a collection is highly error prone,
@@ -254,57 +348,189 @@ def parameters(r):
     cy       = get('cy', r, None)
     month    = get('month', r, None)
     day      = get('day', r, None)
+    dates    = dates_parameter(r)
         
     if (tx is None or
         ty is None or
         acquired is None or
         cx is None or
         cy is None or
-        month is None or
-        day is None):
-        raise Exception('tx, ty, cx, cy, acquired, month and day are required parameters')
+        dates is None):
+        raise Exception('tx, ty, cx, cy, acquired and month and day or dates are required parameters')
     else:
         return {'tx': int(tx),
                 'ty': int(ty),
                 'acquired': acquired,
                 'month': month,
                 'day': day,
+                'dates': dates,
                 'cx': int(cx),
                 'cy': int(cy),
-                'test_load_model_exception': get('test_load_model_exception', r, None),
-                'test_load_data_exception': get('test_load_data_exception', r, None),
-                'test_group_data_exception': get('test_group_data_exception', r, None),
-                'test_matrix_exception': get('test_matrix_exception', r, None),
-                'test_prediction_exception': get('test_prediction_exception', r, None),
-                'test_default_predictions_exception': get('test_default_predictions_exception', r, None),
-                'test_delete_exception': get('test_delete_exception', r, None),
-                'test_save_exception': get('test_save_exception', r, None)}
+                **test_exceptions(r)}
+
+
+def dates_parameter(r):
+    '''Return the requested prediction dates as [month, day] pairs, 
+       from dates if supplied or month and day.  None if neither is.
+       Raises if dates is not a list of pairs or a month & day do not
+       make a date.'''
+
+    dates = get('dates', r, None)
+    month = get('month', r, None)
+    day   = get('day', r, None)
+
+    if dates:
+        if not isinstance(dates, list) or not all(isinstance(d, list) and len(d) == 2 for d in dates):
+            raise Exception('dates must be a list of [month, day] pairs')
+
+        pairs = [[first(d), second(d)] for d in dates]
+    elif month is not None and day is not None:
+        pairs = [[month, day]]
+    else:
+        return None
+
+    for m, d in pairs:
+        check_month_day(m, d)
+
+    return pairs
+
+
+def check_month_day(month, day):
+    '''Raise unless month & day fall on a date in a leap year'''
+
+    try:
+        date(2000, int(month), int(day))
+    except (TypeError, ValueError):
+        raise Exception('{}-{} is not a valid month and day'.format(month, day))
+
+
+def test_exceptions(r):
+    '''Exceptions requested by tests'''
+
+    return {'test_load_model_exception': get('test_load_model_exception', r, None),
+            'test_load_data_exception': get('test_load_data_exception', r, None),
+            'test_group_data_exception': get('test_group_data_exception', r, None),
+            'test_matrix_exception': get('test_matrix_exception', r, None),
+            'test_prediction_exception': get('test_prediction_exception', r, None),
+            'test_default_predictions_exception': get('test_default_predictions_exception', r, None),
+            'test_save_exception': get('test_save_exception', r, None)}
+
 
-        
-@raise_on('test_delete_exception')
 @skip_on_exception
 @measure
-def delete(ctx, cfg):                                                
-    '''Delete existing predictions'''
-
-    with ceph.connect(cfg) as c:
-        c.delete_predictions(ctx['cx'], ctx['cy'])
+def batch_parameters(r):
+    '''Check HTTP request parameters for /predictions'''
     
-    return ctx
-
+    tx       = get('tx', r, None)
+    ty       = get('ty', r, None)
+    acquired = get('acquired', r, None)
+    chips    = get('chips', r, None)
+    month    = get('month', r, None)
+    day      = get('day', r, None)
+    dates    = dates_parameter(r)
+        
+    if (tx is None or
+        ty is None or
+        acquired is None or
+        not chips or
+        dates is None):
+        raise Exception('tx, ty, acquired, chips and month and day or dates are required parameters')
+    else:
+        return {'tx': int(tx),
+                'ty': int(ty),
+                'acquired': acquired,
+                'month': month,
+                'day': day,
+                'dates': dates,
+                'chips': [[int(first(c)), int(second(c))] for c in chips],
+                **test_exceptions(r)}
 
+        
 @raise_on('test_save_exception')
 @skip_on_exception
 @measure
 def save(ctx, cfg):                                                
-    '''Saves predictions'''
+    '''Saves predictions over any existing ones'''
     
-    with ceph.connect(cfg) as c:    
-        c.insert_predictions(merlin.functions.denumpify(ctx['predictions']))
+    with connect(cfg) as c:
+        if len(ctx['predictions']) > 0:
+            c.insert_predictions(merlin.functions.denumpify(ctx['predictions']))
+        else:
+            c.delete_predictions(ctx['cx'], ctx['cy'])
                 
     return ctx
 
 
+def load_chip(ctx, cfg):
+    '''Load one chip's data ready for prediction'''
+
+    return thread_first(ctx,
+                        partial(exception_handler, http_status=500, name='load_data', fn=partial(load_data, cfg=cfg)),
+                        partial(exception_handler, http_status=500, name='group_data', fn=group_data),
+                        partial(exception_handler, http_status=500, name='matrix', fn=matrix))
+
+
+def predict_chip(ctx, cfg):
+    '''Predict and save one chip's loaded data'''
+
+    return thread_first(ctx,
+                        partial(exception_handler, http_status=500, name='predictions', fn=partial(predictions, cfg=cfg)),
+                        partial(exception_handler, http_status=500, name='default_predictions', fn=default_predictions),
+                        partial(exception_handler, http_status=500, name='save', fn=partial(save, cfg=cfg)))
+
+
+def chip_status(ctx):
+    '''Summarize a predicted chip'''
+
+    status = {'cx': get('cx', ctx, None),
+              'cy': get('cy', ctx, None),
+              'status': get('http_status', ctx, 200),
+              'predictions': count(get('predictions', ctx, []))}
+
+    e = get('exception', ctx, None)
+
+    return assoc(status, 'exception', e) if e else status
+
+
+def prefetch(w, fn, items, size):
+    '''Yield fn(item) for items in order, running fn on pool w with up to
+       size items in flight while earlier results are consumed.
+
+       Tasks in flight cannot be cancelled, so use w from workers(),
+       which discards the pool if the caller raises while consuming.'''
+
+    items   = iter(items)
+    pending = deque(w.apply_async(fn, (i,)) for i in take(size, items))
+
+    while pending:
+        result = pending.popleft()
+
+        for i in take(1, items):
+            pending.append(w.apply_async(fn, (i,)))
+
+        yield result.get()
+
+
+@skip_on_exception
+@measure
+def predict_chips(ctx, cfg):
+    '''Predict every chip in ctx with the same model.
+
+       Pool processes load the data for upcoming chips while this process
+       predicts and saves the current one.
+    '''
+
+    chip  = dissoc(ctx, 'chips', 'model')
+    chips = [merge(chip, {'cx': cx, 'cy': cy}) for cx, cy in ctx['chips']]
+    size  = 2 * cfg['cpus_per_worker']
+
+    with workers(cfg) as w:
+        statuses = [chip_status(predict_chip(assoc(c, 'model', ctx['model']), cfg))
+                    for c in prefetch(w, partial(load_chip, cfg=cfg), chips, size)]
+
+    return assoc(dissoc(ctx, 'model'), 'chips', statuses)
+
+
 def respond(ctx):
     '''Send the HTTP response'''
 
@@ -313,6 +539,7 @@ def respond(ctx):
             'acquired': get('acquired', ctx, None),
             'month': get('month', ctx, None),
             'day': get('day', ctx, None),
+            'dates': get('dates', ctx, None),
             'cx': get('cx', ctx, None),
             'cy': get('cy', ctx, None)}
 
@@ -328,6 +555,31 @@ def respond(ctx):
     return response
 
                 
+def respond_batch(ctx):
+    '''Send the HTTP response for /predictions'''
+
+    chips = get('chips', ctx, [])
+    
+    body = {'tx': get('tx', ctx, None),
+            'ty': get('ty', ctx, None),
+            'acquired': get('acquired', ctx, None),
+            'month': get('month', ctx, None),
+            'day': get('day', ctx, None),
+            'dates': get('dates', ctx, None),
+            'chips': chips}
+
+    e = get('exception', ctx, None)
+    
+    if e:
+        response = jsonify(assoc(body, 'exception', e))
+        response.status_code = get('http_status', ctx, 500)
+    else:
+        response = jsonify(body)
+        response.status_code = 200 if all(get('status', c) == 200 for c in chips) else 500
+
+    return response
+
+                
 @prediction.route('/prediction', methods=['POST'])        
 def predictions_route():
     
@@ -340,6 +592,16 @@ def predictions_route():
                         partial(exception_handler, http_status=500, name='matrix', fn=matrix),
                         partial(exception_handler, http_status=500, name='predictions', fn=partial(predictions, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='default_predictions', fn=default_predictions),
-                        partial(exception_handler, http_status=500, name='delete', fn=partial(delete, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='save', fn=partial(save, cfg=cfg)),
                         respond)
+
+
+@prediction.route('/predictions', methods=['POST'])        
+def batch_predictions_route():
+    
+    return thread_first(request.json,
+                        partial(exception_handler, http_status=500, name='log_request', fn=log_batch_request),
+                        partial(exception_handler, http_status=400, name='batch_parameters', fn=batch_parameters),
+                        partial(exception_handler, http_status=500, name='load_model', fn=partial(load_model, cfg=cfg)),
+                        partial(exception_handler, http_status=500, name='predict_chips', fn=partial(predict_chips, cfg=cfg)),
+                        respond_batch)
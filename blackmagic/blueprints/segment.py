@@ -1,6 +1,10 @@
+from blackmagic import columnar
 from blackmagic import skip_on_exception
 from blackmagic import workers
+from blackmagic.data import cache
 from blackmagic.data import ceph
+from blackmagic.data import local
+from blackmagic.data import storage
 from cytoolz import assoc
 from cytoolz import count
 from cytoolz import do
@@ -20,101 +24,173 @@ from flask import jsonify
 from flask import request
 from functools import wraps
 from merlin.functions import flatten
+from numpy.lib.format import open_memmap
 
 import blackmagic
 import ccd
 import logging
 import merlin
+import numpy
 import os
+import shutil
 import sys
+import tempfile
 
-cfg     = merge(blackmagic.cfg, ceph.cfg)
+cfg     = merge(blackmagic.cfg, ceph.cfg, cache.cfg, local.cfg)
 logger  = logging.getLogger('blackmagic.segment')
 segment = Blueprint('segment', __name__)
-_ceph   = ceph.Ceph(cfg)
-_ceph.start()
+_storage = storage(cfg)
+_storage.start()
 
 def save_chip(ctx, cfg):
-    _ceph.insert_chip(ctx['detections'])
+    _storage.insert_chip([{'cx': ctx['cx'],
+                           'cy': ctx['cy'],
+                           'dates': columnar.isoformat(ctx['dates'])}])
     return ctx
     
 
 def save_pixels(ctx, cfg):
-    _ceph.insert_pixels(ctx['detections'])
+    if columnar.length(ctx['pixels']) > 0:
+        _storage.insert_pixels(ctx['pixels'])
+    else:
+        _storage.delete_pixels(ctx['cx'], ctx['cy'])
     return ctx
 
 
 def save_segments(ctx, cfg):
-    _ceph.insert_segments(ctx['detections'])
+    if columnar.length(ctx['segments']) > 0:
+        _storage.insert_segments(ctx['segments'])
+    else:
+        _storage.delete_segments(ctx['cx'], ctx['cy'])
     return ctx
 
 
-def defaults(cms):
-    return [{}] if (not cms or len(cms) == 0) else cms
+def detect(timeseries):
+    '''Run change detection for one pixel, returning columnar results'''
+    
+    cx, cy, px, py = first(timeseries)
+    ccdresult = ccd.detect(**second(timeseries))
+
+    return {'segments': columnar.segments(cx=cx,
+                                          cy=cy,
+                                          px=px,
+                                          py=py,
+                                          change_models=get('change_models', ccdresult, None)),
+            'pixels':   columnar.pixels(cx=cx,
+                                        cy=cy,
+                                        px=px,
+                                        py=py,
+                                        mask=get('processing_mask', ccdresult))}
+
+
+def dates(timeseries):
+    '''Observation dates as ordinals.  Every pixel in a chip shares them.'''
+
+    return numpy.asarray(get('dates', second(first(timeseries))), dtype=numpy.int64)
+
 
+def tables(results):
+    '''Combine per-pixel detection results into chip level tables'''
+
+    results = list(results)
     
-def coefficients(change_model, spectra):
-    coefs = get_in([spectra, 'coefficients'], change_model)
-    return list(coefs) if coefs else []
+    return {'segments': columnar.concat([r['segments'] for r in results]),
+            'pixels':   columnar.concat([r['pixels'] for r in results])}
+
+
+SPECTRA = ('blues', 'greens', 'reds', 'nirs', 'swir1s', 'swir2s', 'thermals')
+
+
+def share(timeseries, directory=None):
+    '''Write a chip's timeseries into memory-mapped arrays.
 
+       Every pixel in a chip shares the same dates, so they are written
+       once.  Spectra are written as one contiguous [pixels, 7, dates]
+       cube and qas as [pixels, dates].  Returns the directory holding
+       the arrays, which the caller is responsible for removing.
+    '''
 
-def format(cx, cy, px, py, dates, ccdresult):
+    ts   = list(timeseries)
+    k, v = first(ts)
+    path = tempfile.mkdtemp(prefix='blackmagic-', dir=directory)
+
+    try:
+        arrays = {'keys':    open_memmap(os.path.join(path, 'keys.npy'),
+                                         mode='w+',
+                                         dtype=numpy.int64,
+                                         shape=(len(ts), len(k))),
+                  'dates':   open_memmap(os.path.join(path, 'dates.npy'),
+                                         mode='w+',
+                                         dtype=numpy.int64,
+                                         shape=(len(v['dates']),)),
+                  'spectra': open_memmap(os.path.join(path, 'spectra.npy'),
+                                         mode='w+',
+                                         dtype=numpy.asarray(v['blues']).dtype,
+                                         shape=(len(ts), len(SPECTRA), len(v['dates']))),
+                  'qas':     open_memmap(os.path.join(path, 'qas.npy'),
+                                         mode='w+',
+                                         dtype=numpy.asarray(v['qas']).dtype,
+                                         shape=(len(ts), len(v['dates'])))}
+
+        arrays['dates'][:] = v['dates']
+
+        for i, (key, values) in enumerate(ts):
+            arrays['keys'][i] = key
+            arrays['qas'][i]  = values['qas']
+
+            for j, s in enumerate(SPECTRA):
+                arrays['spectra'][i, j] = values[s]
+
+        for a in arrays.values():
+            a.flush()
+
+        return path
     
-    return [
-             {'cx'     : int(cx),
-              'cy'     : int(cy),
-              'px'     : int(px),
-              'py'     : int(py),
-              'sday'   : date.fromordinal(get('start_day', cm, 1)).isoformat(),
-              'eday'   : date.fromordinal(get('end_day', cm, 1)).isoformat(),
-              'bday'   : date.fromordinal(get('break_day', cm, 1)).isoformat(),
-              'chprob' : get('change_probability', cm, 0.0),
-              'curqa'  : get('curve_qa', cm, 0),
-              'blmag'  : get_in(['blue', 'magnitude'], cm, 0.0),
-              'grmag'  : get_in(['green', 'magnitude'], cm, 0.0),
-              'remag'  : get_in(['red', 'magnitude'], cm, 0.0),
-              'nimag'  : get_in(['nir', 'magnitude'], cm, 0.0),
-              's1mag'  : get_in(['swir1', 'magnitude'], cm, 0.0),
-              's2mag'  : get_in(['swir2', 'magnitude'], cm, 0.0),
-              'thmag'  : get_in(['thermal', 'magnitude'], cm, 0.0),
-              'blrmse' : get_in(['blue', 'rmse'], cm, 0.0),
-              'grrmse' : get_in(['green', 'rmse'], cm, 0.0),
-              'rermse' : get_in(['red', 'rmse'], cm, 0.0),
-              'nirmse' : get_in(['nir', 'rmse'], cm, 0.0),
-              's1rmse' : get_in(['swir1', 'rmse'], cm, 0.0),
-              's2rmse' : get_in(['swir2', 'rmse'], cm, 0.0),
-              'thrmse' : get_in(['thermal', 'rmse'], cm, 0.0),
-              'blcoef' : coefficients(cm, 'blue'),
-              'grcoef' : coefficients(cm, 'green'),
-              'recoef' : coefficients(cm, 'red'),
-              'nicoef' : coefficients(cm, 'nir'),
-              's1coef' : coefficients(cm, 'swir1'),
-              's2coef' : coefficients(cm, 'swir2'),
-              'thcoef' : coefficients(cm, 'thermal'),
-              'blint'  : get_in(['blue', 'intercept'], cm, 0.0),
-              'grint'  : get_in(['green', 'intercept'], cm, 0.0),
-              'reint'  : get_in(['red', 'intercept'], cm, 0.0),
-              'niint'  : get_in(['nir', 'intercept'], cm, 0.0),
-              's1int'  : get_in(['swir1', 'intercept'], cm, 0.0),
-              's2int'  : get_in(['swir2', 'intercept'], cm, 0.0),
-              'thint'  : get_in(['thermal', 'intercept'], cm, 0.0),
-              'dates'  : [date.fromordinal(o).isoformat() for o in dates],
-              'mask'   : get('processing_mask', ccdresult)}
-        
-             for cm in defaults(get('change_models', ccdresult, None))]
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
 
 
-def detect(timeseries):
-   
-    cx, cy, px, py = first(timeseries)
+def shared(path):
+    '''Open read only views of the arrays written by share()'''
+    
+    return {name: numpy.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r')
+            for name in ('keys', 'dates', 'spectra', 'qas')}
+
+
+def detect_shared(indices, path):
+    '''Run detection for a block of pixel indices from a shared timeseries'''
+
+    a = shared(path)
+
+    def timeseries(i):
+        values = {s: a['spectra'][i, j] for j, s in enumerate(SPECTRA)}
+        values.update({'dates': a['dates'], 'qas': a['qas'][i]})
+        return (tuple(int(k) for k in a['keys'][i]), values)
+
+    return [detect(timeseries(i)) for i in indices]
+
+
+def blocks(count, size):
+    return [range(i, min(i + size, count)) for i in range(0, count, size)]
+
+
+def shared_detection(w, timeseries, cfg):
+    '''Detect change with pixel data handed to workers via memory-mapped arrays'''
+    
+    path = share(timeseries, directory=get('shared_timeseries_dir', cfg, None))
 
-    return format(cx=cx,
-                  cy=cy,
-                  px=px,
-                  py=py,
-                  dates=get('dates', second(timeseries)),
-                  ccdresult=ccd.detect(**second(timeseries)))
+    try:
+        count = len(shared(path)['keys'])
+        size  = max(1, count // (cfg['cpus_per_worker'] * 4))
+        
+        return list(flatten(w.map(partial(detect_shared, path=path),
+                                  blocks(count, size),
+                                  chunksize=1)))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
 
+        
 def measure(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -191,22 +267,16 @@ def detection(ctx, cfg):
     with workers(cfg) as w:
         if get('test_detection_exception', ctx, None) is not None:
             return merge(ctx, exception(msg='test_detection_exception', http_status=500))
+        elif get('shared_timeseries', cfg, False):
+            return merge(ctx,
+                         {'dates': dates(ctx['timeseries'])},
+                         tables(shared_detection(w, take(ctx['test_pixel_count'], ctx['timeseries']), cfg)))
         else:
-            return merge(ctx, {'detections': list(flatten(w.map(detect, take(ctx['test_pixel_count'], ctx['timeseries']))))})
+            return merge(ctx,
+                         {'dates': dates(ctx['timeseries'])},
+                         tables(w.map(detect, take(ctx['test_pixel_count'], ctx['timeseries']))))
 
     
-@skip_on_exception
-def delete(ctx, cfg):
-    cx = int(get('cx', ctx))
-    cy = int(get('cy', ctx))
-
-    _ceph.delete_chip(cx, cy)
-    _ceph.delete_pixels(cx, cy)
-    _ceph.delete_segments(cx, cy)
-
-    return ctx
-
-
 @skip_on_exception
 @measure
 def save(ctx, cfg):
@@ -214,9 +284,10 @@ def save(ctx, cfg):
     if get('test_save_exception', ctx, None) is not None:
         raise Exception('test_save_exception')
     else:
-        save_chip(ctx, cfg)
-        save_pixels(ctx, cfg)
-        save_segments(ctx, cfg)
+        with _storage.batch():
+            save_chip(ctx, cfg)
+            save_pixels(ctx, cfg)
+            save_segments(ctx, cfg)
         return ctx
 
 
@@ -259,6 +330,5 @@ def segments():
                         partial(exception_handler, http_status=500, name='timeseries', fn=partial(timeseries, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='nodata', fn=partial(nodata, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='detection', fn=partial(detection, cfg=cfg)),
-                        partial(exception_handler, http_status=500, name='delete', fn=partial(delete, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='save', fn=partial(save, cfg=cfg)),
                         respond)
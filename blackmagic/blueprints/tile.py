@@ -1,9 +1,14 @@
 from blackmagic import raise_on
+from blackmagic import sampling
 from blackmagic import segaux
 from blackmagic import skip_on_empty
 from blackmagic import skip_on_exception
 from blackmagic import workers
+from blackmagic.data import cache
 from blackmagic.data import ceph
+from blackmagic.data import local
+from blackmagic.data import connect
+from concurrent.futures import ThreadPoolExecutor
 from cytoolz import assoc
 from cytoolz import count
 from cytoolz import dissoc
@@ -12,6 +17,7 @@ from cytoolz import first
 from cytoolz import get
 from cytoolz import get_in
 from cytoolz import merge
+from cytoolz import nth
 from cytoolz import partial
 from cytoolz import second
 from cytoolz import thread_first
@@ -34,12 +40,14 @@ import blackmagic
 import logging
 import json
 import numpy
+import os
+import tempfile
 import xgboost as xgb
 
 logger = logging.getLogger('blackmagic.tile')
 tile = Blueprint('tile', __name__)
 
-cfg = merge(blackmagic.cfg, ceph.cfg)
+cfg = merge(blackmagic.cfg, ceph.cfg, cache.cfg, local.cfg)
 
 
 def log_request(ctx):
@@ -64,16 +72,6 @@ def add_average_reflectance(ctx):
     return assoc(ctx, 'data', segaux.average_reflectance(ctx['data']))
 
 
-@retry(stop=stop_after_attempt(20),
-       reraise=True,
-       wait=wait_exponential(multiplier=1, min=2, max=5))
-def segments(ctx, cfg):
-    '''Return saved segments'''
-    logger.info("getting segments for cx:{} cy:{}".format(ctx['cx'], ctx['cy']))
-    with ceph.connect(cfg) as c:     
-        return assoc(ctx, 'segments', c.select_segments(ctx['cx'], ctx['cy']))
-
-
 def segments_filter(ctx):
     '''Yield segments that span the supplied date'''
     
@@ -86,16 +84,18 @@ def segments_filter(ctx):
 
 
 def pipeline(chip, tx, ty, date, acquired, cfg):
-
+    '''Build training data for one chip from (cx, cy, segments),
+       returning (cx, cy, data)'''
+    
     ctx = {'tx': tx,
            'ty': ty,
            'cx': first(chip),
            'cy': second(chip),
+           'segments': nth(2, chip),
            'date': date,
            'acquired': acquired}
 
-    return thread_first(ctx,
-                        partial(segments, cfg=cfg),
+    data = thread_first(ctx,
                         segments_filter,
                         partial(segaux.aux, cfg=cfg),
                         segaux.aux_filter,                        
@@ -108,6 +108,8 @@ def pipeline(chip, tx, ty, date, acquired, cfg):
                         #segaux.log_chip,
                         segaux.exit_pipeline)
 
+    return first(chip), second(chip), data
+
 
 def exception_handler(ctx, http_status, name, fn):
     try:
@@ -149,7 +151,8 @@ def measure(fn):
 @skip_on_exception
 @measure
 def parameters(r):
-    '''Check HTTP request parameters'''
+    '''Check HTTP request parameters.  date is parsed once here and
+       passed on as YYYY-MM-DD, the form the training pipeline expects.'''
     
     tx       = get('tx', r, None)
     ty       = get('ty', r, None)
@@ -163,17 +166,53 @@ def parameters(r):
         return {'tx': int(tx),
                 'ty': int(ty),
                 'acquired': acquired,
-                'date': date,
+                'date': arrow.get(date).date().isoformat(),
                 'chips': list(map(lambda chip: (int(first(chip)), int(second(chip))), chips)),
                 'test_data_exception': get('test_data_exception', r, None),
                 'test_training_exception': get('test_training_exception', r, None),
                 'test_save_exception': get('test_save_exception', r, None)}
 
+
+def workspace(cfg):
+    '''A temporary directory for external memory training, or None'''
+
+    if not get_in(['xgboost', 'external_memory'], cfg):
+        return None
+
+    return tempfile.TemporaryDirectory(prefix='tile-', dir=get_in(['xgboost', 'external_memory_dir'], cfg))
+
+
+def row_key(cx, cy, ctx):
+    '''Training row cache key for a chip.  Entries are also matched on
+       the ETag of the chip's segments.'''
+
+    return 'training/{cx}-{cy}/{acquired}/{date}/{layout}'.format(cx=cx,
+                                                                  cy=cy,
+                                                                  acquired=ctx['acquired'],
+                                                                  date=ctx['date'],
+                                                                  layout=segaux.FEATURE_LAYOUT)
+
+
+def segment_etags(c, chips, cfg):
+    '''Return {(cx, cy): ETag of the chip's segments}, HEADing chips
+       concurrently on s3_threads threads'''
+
+    with ThreadPoolExecutor(max_workers=get('s3_threads', cfg, 10)) as executor:
+        return dict(zip(chips, executor.map(lambda chip: c.select_segments_etag(*chip), chips)))
+
+
 @skip_on_exception
 @raise_on('test_data_exception')
 @measure
 def data(ctx, cfg):
-    '''Retrieve training data for all chips in parallel'''
+    '''Retrieve training data for all chips in parallel, keeping only
+       a random sample of each class large enough for sample().
+
+       In external memory mode the sample is kept in files under a
+       temporary 'workdir' that lives as long as ctx or until train().
+
+       With a training_cache_dir, each chip's training rows are cached
+       and chips whose segments are unchanged skip the pipeline.'''
     
     p = partial(pipeline,
                 tx=ctx['tx'],
@@ -183,9 +222,48 @@ def data(ctx, cfg):
                 cfg=cfg)
 
     logger.info("loading segments and aux data")
-    
-    with workers(cfg) as w:
-        return assoc(ctx, 'data', numpy.array(list(flatten(w.map(p, ctx['chips']))), dtype=numpy.float32))
+
+    # Segments are fetched concurrently here and handed to the workers
+    # as they arrive so downloads overlap with aux retrieval.
+    seed       = get_in(['xgboost', 'seed'], cfg)
+    workdir    = workspace(cfg)
+    reservoirs = sampling.Reservoirs(sampling.capacity(cfg['xgboost']['target_samples'],
+                                                       cfg['xgboost']['class_max'],
+                                                       cfg['xgboost']['class_min']),
+                                     random_state=seed,
+                                     directory=workdir.name if workdir else None)
+
+    def add(cx, cy, rows):
+        reservoirs.add(rows, keys=None if seed is None else sampling.keys(len(rows), seed, cx, cy))
+
+    rows_cache = cache.arrays(cfg)
+    chips      = ctx['chips']
+    etags      = {}
+
+    with connect(cfg) as c, workers(cfg) as w:
+        if rows_cache is not None:
+            etags  = segment_etags(c, chips, cfg)
+            misses = []
+
+            for cx, cy in chips:
+                e    = etags[(cx, cy)]
+                rows = None if e is None else rows_cache.get(row_key(cx, cy, ctx), e)
+
+                if rows is None:
+                    misses.append((cx, cy))
+                else:
+                    add(cx, cy, rows)
+
+            logger.info("training row cache: {} hits, {} misses".format(len(chips) - len(misses), len(misses)))
+            chips = misses
+
+        for cx, cy, rows in w.imap_unordered(p, c.select_segments_many(chips)):
+            if get((cx, cy), etags, None) is not None:
+                rows_cache.put(row_key(cx, cy, ctx), etags[(cx, cy)], segaux.to_numpy(rows))
+
+            add(cx, cy, rows)
+
+    return merge(ctx, {'reservoirs': reservoirs, 'workdir': workdir})
 
     
 @skip_on_exception
@@ -199,35 +277,26 @@ def statistics(ctx):
 
     logger.info("generating statistics")
     
-    dimension = ctx['data'][::-1, ::ctx['data'].shape[1]]
-    dep = dimension.flatten()
-    vals, cnts = numpy.unique(dep, return_counts=True)
-    prct = cnts / numpy.sum(cnts)
-    dimension = None
-    dep = None
-    cnts = None
-    del dimension
-    del dep
-    del cnts
-    return assoc(ctx, 'statistics', (vals, prct))
+    return assoc(ctx, 'statistics', ctx['reservoirs'].statistics())
 
 
 @skip_on_exception
 @measure
 def randomize(ctx, cfg):
-    '''Randomize the order of training data'''
+    '''Randomize the order of training data by permuting row indices
+       rather than the data itself'''
 
     logger.info("randomizing data")
     
-    r = numpy.random.RandomState().permutation(ctx['data'])
-    del ctx['data']
-    
-    return assoc(ctx, 'data', r)
+    seed = get_in(['xgboost', 'seed'], cfg)
+
+    return assoc(ctx, 'indices', numpy.random.RandomState(seed).permutation(len(ctx['data'])))
 
 
 @skip_on_exception
 @measure
 def split_data(ctx):
+    '''Split data into independent variables, a view of data, and labels'''
 
     logger.info("splitting data")
     
@@ -237,6 +306,34 @@ def split_data(ctx):
     del ctx['data']
     
     return merge(ctx, {'independent': independent, 'dependent': dependent})
+
+
+def train_test_indices(indices, test_size):
+    '''Split randomized row indices into sorted training & test indices'''
+
+    itrain, itest = train_test_split(indices, test_size=test_size, shuffle=False)
+
+    return numpy.sort(itrain), numpy.sort(itest)
+
+
+def matrix(ctx, indices, name, cfg):
+    '''DMatrix of the training rows at indices.  With a workdir the rows
+       are streamed to xgboost in batches of external_memory_bytes and
+       cached on disk rather than copied into memory.'''
+
+    workdir = get('workdir', ctx, None)
+
+    if workdir is None:
+        return xgb.DMatrix(data=ctx['independent'][indices], label=ctx['dependent'][indices])
+
+    batches = segaux.Batches(ctx['independent'],
+                             ctx['dependent'],
+                             indices,
+                             segaux.batch_rows(get_in(['xgboost', 'external_memory_bytes'], cfg),
+                                               ctx['independent']),
+                             cache_prefix=os.path.join(workdir.name, name))
+
+    return xgb.DMatrix(batches)
     
 
 @skip_on_exception
@@ -256,32 +353,14 @@ def sample(ctx, cfg):
     adj_counts[adj_counts > cfg['xgboost']['class_max']] = cfg['xgboost']['class_max']
     adj_counts[adj_counts < cfg['xgboost']['class_min']] = cfg['xgboost']['class_min']
 
-    selected_indices = []
-    for cls, count in zip(class_values, adj_counts):
-        # Index locations of values
-        indices = numpy.where(ctx['dependent'] == cls)[0]
-
-        # Add the index locations up to the count
-        selected_indices.extend(indices[:int(count)])
-
-    si = numpy.array(selected_indices)
-
-    # do we need to wipe out ctx['independent'] & ctx['dependent'] after
-    # taking the sample to free up memory?
-    # Advanced indexing always returns a copy of the data (contrast with basic slicing that returns a view).
-    independent = ctx['independent'][si]
-    dependent   = ctx['dependent'][si]
+    data = ctx['reservoirs'].sample(class_values, adj_counts)
 
-    selected_indices = None
+    ctx['reservoirs'] = None
     ctx['statistics'] = None
-    si = None
-    del selected_indices
+    del ctx['reservoirs']
     del ctx['statistics']
-    del si
-    del class_values
-    del percent
 
-    return merge(ctx, {'independent': independent, 'dependent': dependent})
+    return assoc(ctx, 'data', data)
 
 
 @raise_on('test_training_exception')
@@ -294,15 +373,16 @@ def train(ctx, cfg):
 
     logger.info("training model")
     
-    itrain, itest, dtrain, dtest = train_test_split(ctx['independent'],
-                                                    ctx['dependent'],
-                                                    test_size=get_in(['xgboost', 'test_size'], cfg))
+    itrain, itest = train_test_indices(ctx['indices'], get_in(['xgboost', 'test_size'], cfg))
     
-    train_matrix = xgb.DMatrix(data=itrain, label=dtrain)
-    test_matrix  = xgb.DMatrix(data=itest, label=dtest)
+    train_matrix = matrix(ctx, itrain, 'train', cfg)
+    test_matrix  = matrix(ctx, itest, 'test', cfg)
     watch_list   = watchlist(train_matrix, test_matrix)
     
-    model = xgb.train(params=get_in(['xgboost', 'parameters'], cfg),
+    seed  = get_in(['xgboost', 'seed'], cfg)
+    
+    model = xgb.train(params=merge(get_in(['xgboost', 'parameters'], cfg),
+                                   {} if seed is None else {'seed': seed}),
                       dtrain=train_matrix,
                       num_boost_round=get_in(['xgboost', 'num_round'], cfg),
                       evals=watch_list,
@@ -311,24 +391,25 @@ def train(ctx, cfg):
 
     ctx['independent'] = None
     ctx['dependent'] = None
+    ctx['indices'] = None
     itrain = None
     itest = None
-    dtrain = None
-    dtest = None
     train_matrix = None
     test_matrix = None
     watch_list = None
     del ctx['independent']
     del ctx['dependent']
+    del ctx['indices']
     del itrain
     del itest
-    del dtrain
-    del dtest
     del train_matrix
     del test_matrix
     del watch_list
 
-    return assoc(ctx, 'model', model)
+    if get('workdir', ctx, None) is not None:
+        ctx['workdir'].cleanup()
+
+    return assoc(dissoc(ctx, 'workdir'), 'model', model)
 
 
 @raise_on('test_save_exception')
@@ -338,21 +419,22 @@ def train(ctx, cfg):
 def save(ctx, cfg):                                                
     '''Saves an xgboost model for this tx & ty'''
 
-    # will need to decode hex when pulling model
-    # >>> bytes.fromhex('deadbeef')
-    #b'\xde\xad\xbe\xef'
-
     logger.info("saving model")
     
-    model_bytes = segaux.bytes_from_booster(ctx['model']).hex()
+    model_bytes = segaux.bytes_from_booster(ctx['model'])
 
     ctx['model'] = None
     del ctx['model']
     
-    with ceph.connect(cfg) as c:
+    with connect(cfg) as c:
         c.insert_tile(ctx['tx'],
                       ctx['ty'],
-                      model_bytes)
+                      model_bytes,
+                      metadata={'tx': ctx['tx'],
+                                'ty': ctx['ty'],
+                                'date': ctx['date'],
+                                'acquired': ctx['acquired'],
+                                'layout': segaux.FEATURE_LAYOUT})
         return ctx
     
     
@@ -396,9 +478,9 @@ def tiles():
                         partial(exception_handler, http_status=400, name='parameters', fn=parameters),
                         partial(exception_handler, http_status=500, name='data', fn=partial(data, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='statistics', fn=statistics),
+                        partial(exception_handler, http_status=500, name='sample', fn=partial(sample, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='randomize', fn=partial(randomize, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='split_data', fn=split_data),
-                        partial(exception_handler, http_status=500, name='sample', fn=partial(sample, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='train', fn=partial(train, cfg=cfg)),
                         partial(exception_handler, http_status=500, name='save', fn=partial(save, cfg=cfg)),
                         respond)
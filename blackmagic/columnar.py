@@ -0,0 +1,253 @@
+'''
+columnar.py holds change detection results for a chip as
+a struct of arrays rather than a list of dicts.
+
+A table is a plain dict of numpy arrays that all share
+the same first dimension, one row per change model.  Per band
+values are held as [rows, 7] matrices and coefficients as
+[rows, 7, k] matrices with bands ordered as in BANDS.  Days are
+kept as ordinals.
+
+Dicts are only materialized at the storage boundary by
+records() and pixel_records().
+'''
+
+from cytoolz import first
+from cytoolz import get
+from cytoolz import get_in
+
+import numpy
+
+
+BANDS = ('blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'thermal')
+
+PREFIXES = ('bl', 'gr', 're', 'ni', 's1', 's2', 'th')
+
+COEFFICIENTS = 7
+
+EPOCH = 719163  # date(1970, 1, 1).toordinal()
+
+
+def length(table):
+    return len(first(table.values())) if table else 0
+
+
+def concat(tables):
+    '''Concatenate tables row-wise'''
+
+    tables = [t for t in tables if length(t) > 0]
+
+    if len(tables) == 0:
+        return {}
+
+    return {k: numpy.concatenate([t[k] for t in tables]) for k in first(tables).keys()}
+
+
+def coefficients(change_model, band):
+    c = numpy.zeros(COEFFICIENTS, dtype=numpy.float64)
+    v = get_in([band, 'coefficients'], change_model, None)
+
+    if v:
+        c[:len(v)] = v[:COEFFICIENTS]
+
+    return c
+
+
+def segments(cx, cy, px, py, change_models):
+    '''Build a segment table for one pixel from pyccd change models.
+
+       A pixel without change models gets a single default row with
+       ordinal 1 (0001-01-01) days and zeroed values, matching what
+       is saved for pixels where no change was detected.
+    '''
+
+    cms = change_models if change_models else [{}]
+    n   = len(cms)
+
+    band = lambda key: numpy.array([[get_in([b, key], cm, 0.0) for b in BANDS] for cm in cms],
+                                   dtype=numpy.float64)
+
+    return {'cx':     numpy.full(n, cx, dtype=numpy.int32),
+            'cy':     numpy.full(n, cy, dtype=numpy.int32),
+            'px':     numpy.full(n, px, dtype=numpy.int32),
+            'py':     numpy.full(n, py, dtype=numpy.int32),
+            'sday':   numpy.array([get('start_day', cm, 1) for cm in cms], dtype=numpy.int32),
+            'eday':   numpy.array([get('end_day', cm, 1) for cm in cms], dtype=numpy.int32),
+            'bday':   numpy.array([get('break_day', cm, 1) for cm in cms], dtype=numpy.int32),
+            'chprob': numpy.array([get('change_probability', cm, 0.0) for cm in cms], dtype=numpy.float64),
+            'curqa':  numpy.array([get('curve_qa', cm, 0) for cm in cms], dtype=numpy.int32),
+            'mag':    band('magnitude'),
+            'rmse':   band('rmse'),
+            'int':    band('intercept'),
+            'coef':   numpy.array([[coefficients(cm, b) for b in BANDS] for cm in cms],
+                                  dtype=numpy.float64).reshape(n, len(BANDS), COEFFICIENTS)}
+
+
+def pixels(cx, cy, px, py, mask):
+    '''Build a one row pixel table holding the processing mask'''
+
+    return {'cx':   numpy.array([cx], dtype=numpy.int32),
+            'cy':   numpy.array([cy], dtype=numpy.int32),
+            'px':   numpy.array([px], dtype=numpy.int32),
+            'py':   numpy.array([py], dtype=numpy.int32),
+            'mask': numpy.array([mask], dtype=numpy.bool_)}
+
+
+def defaults(table):
+    '''Boolean index of default (no change model) rows'''
+
+    return (table['sday'] == 1) & (table['eday'] == 1)
+
+
+def isoformat(ordinals):
+    '''Convert an array of ordinal days to a list of ISO 8601 date strings'''
+
+    o = numpy.asarray(ordinals, dtype=numpy.int64) - EPOCH
+    return numpy.datetime_as_string(o.astype('datetime64[D]')).tolist()
+
+
+def ordinals(isodates):
+    '''Convert ISO 8601 date strings to an array of ordinal days'''
+
+    return numpy.array(isodates, dtype='datetime64[D]').astype(numpy.int64) + EPOCH
+
+
+def segment_table(records):
+    '''Build a segment table from a list of segment dicts'''
+
+    if len(records) == 0:
+        return {}
+
+    n    = len(records)
+    coef = numpy.zeros((n, len(BANDS), COEFFICIENTS), dtype=numpy.float64)
+
+    for i, r in enumerate(records):
+        for j, p in enumerate(PREFIXES):
+            c = r['{}coef'.format(p)][:COEFFICIENTS]
+            coef[i, j, :len(c)] = c
+
+    column = lambda key, dtype: numpy.array([r[key] for r in records], dtype=dtype)
+    band   = lambda suffix: numpy.array([[r['{}{}'.format(p, suffix)] for p in PREFIXES] for r in records],
+                                        dtype=numpy.float64).reshape(n, len(PREFIXES))
+
+    return {'cx':     column('cx', numpy.int32),
+            'cy':     column('cy', numpy.int32),
+            'px':     column('px', numpy.int32),
+            'py':     column('py', numpy.int32),
+            'sday':   ordinals([r['sday'] for r in records]).astype(numpy.int32),
+            'eday':   ordinals([r['eday'] for r in records]).astype(numpy.int32),
+            'bday':   ordinals([r['bday'] for r in records]).astype(numpy.int32),
+            'chprob': column('chprob', numpy.float64),
+            'curqa':  column('curqa', numpy.int32),
+            'mag':    band('mag'),
+            'rmse':   band('rmse'),
+            'int':    band('int'),
+            'coef':   coef}
+
+
+def records(table):
+    '''Materialize a segment table as a list of dicts'''
+
+    if length(table) == 0:
+        return []
+
+    d = defaults(table)
+
+    cols = {'cx':     table['cx'].tolist(),
+            'cy':     table['cy'].tolist(),
+            'px':     table['px'].tolist(),
+            'py':     table['py'].tolist(),
+            'sday':   isoformat(table['sday']),
+            'eday':   isoformat(table['eday']),
+            'bday':   isoformat(table['bday']),
+            'chprob': table['chprob'].tolist(),
+            'curqa':  table['curqa'].tolist()}
+
+    for i, p in enumerate(PREFIXES):
+        coefs = table['coef'][:, i].tolist()
+
+        cols.update({'{}mag'.format(p):  table['mag'][:, i].tolist(),
+                     '{}rmse'.format(p): table['rmse'][:, i].tolist(),
+                     '{}int'.format(p):  table['int'][:, i].tolist(),
+                     '{}coef'.format(p): [[] if dflt else c for dflt, c in zip(d, coefs)]})
+
+    keys = list(cols.keys())
+
+    return [dict(zip(keys, row)) for row in zip(*cols.values())]
+
+
+def pixel_table(records):
+    '''Build a pixel table from a list of pixel dicts'''
+
+    if len(records) == 0:
+        return {}
+
+    return {'cx':   numpy.array([r['cx'] for r in records], dtype=numpy.int32),
+            'cy':   numpy.array([r['cy'] for r in records], dtype=numpy.int32),
+            'px':   numpy.array([r['px'] for r in records], dtype=numpy.int32),
+            'py':   numpy.array([r['py'] for r in records], dtype=numpy.int32),
+            'mask': numpy.array([r['mask'] for r in records], dtype=numpy.bool_)}
+
+
+def pixel_records(table):
+    '''Materialize a pixel table as a list of dicts'''
+
+    if length(table) == 0:
+        return []
+
+    return [{'cx': cx, 'cy': cy, 'px': px, 'py': py, 'mask': m}
+            for cx, cy, px, py, m in zip(table['cx'].tolist(),
+                                         table['cy'].tolist(),
+                                         table['px'].tolist(),
+                                         table['py'].tolist(),
+                                         table['mask'].astype(numpy.int64).tolist())]
+
+
+def prediction_table(records):
+    '''Build a prediction table from a list of prediction dicts.
+
+       prob is [rows, classes].  Predictions without probabilities, for
+       default segments, have a zeroed row and scored set to False.
+    '''
+
+    if len(records) == 0:
+        return {}
+
+    n       = len(records)
+    classes = max(len(r['prob']) for r in records)
+    prob    = numpy.zeros((n, classes), dtype=numpy.float32)
+
+    for i, r in enumerate(records):
+        prob[i, :len(r['prob'])] = r['prob']
+
+    column = lambda key: numpy.array([r[key] for r in records], dtype=numpy.int32)
+
+    return {'cx':     column('cx'),
+            'cy':     column('cy'),
+            'px':     column('px'),
+            'py':     column('py'),
+            'sday':   ordinals([r['sday'] for r in records]).astype(numpy.int32),
+            'eday':   ordinals([r['eday'] for r in records]).astype(numpy.int32),
+            'pday':   ordinals([r['pday'] for r in records]).astype(numpy.int32),
+            'scored': numpy.array([len(r['prob']) > 0 for r in records], dtype=numpy.bool_),
+            'prob':   prob}
+
+
+def prediction_records(table):
+    '''Materialize a prediction table as a list of dicts'''
+
+    if length(table) == 0:
+        return []
+
+    return [{'cx': cx, 'cy': cy, 'px': px, 'py': py,
+             'sday': sday, 'eday': eday, 'pday': pday,
+             'prob': prob if scored else []}
+            for cx, cy, px, py, sday, eday, pday, scored, prob in zip(table['cx'].tolist(),
+                                                                       table['cy'].tolist(),
+                                                                       table['px'].tolist(),
+                                                                       table['py'].tolist(),
+                                                                       isoformat(table['sday']),
+                                                                       isoformat(table['eday']),
+                                                                       isoformat(table['pday']),
+                                                                       table['scored'].tolist(),
+                                                                       table['prob'].tolist())]
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+from cytoolz import get
 from interface import Interface
 
 """Blackmagic Storage provides a pluggable interface that can be implemented for
@@ -26,29 +28,41 @@ class Storage(Interface):
 
     def select_tile(self, tx, ty):
         pass
+
+    def select_tile_etag(self, tx, ty):
+        pass
+
+    def select_model(self, tx, ty, etag=None):
+        pass
     
     def select_chip(self, cx, cy):
         pass
 
-    def select_pixels(self, cx, cy):
+    def select_pixels(self, cx, cy, packed=False):
+        pass
+
+    def select_segments(self, cx, cy, table=False):
+        pass
+
+    def select_segments_many(self, chips, table=False):
         pass
 
-    def select_segments(self, cx, cy):
+    def select_segments_etag(self, cx, cy):
         pass
 
-    def select_predictions(self, cx, cy):
+    def select_predictions(self, cx, cy, table=False):
         pass
 
-    def insert_tile(self, tx, ty, model):
+    def insert_tile(self, tx, ty, model, metadata=None):
         pass
     
     def insert_chip(self, detections):
         pass
 
-    def insert_pixels(self, detections):
+    def insert_pixels(self, pixels):
         pass
 
-    def insert_segments(self, detections):
+    def insert_segments(self, segments):
         pass
 
     def insert_predictions(self, predictions):
@@ -68,3 +82,36 @@ class Storage(Interface):
 
     def delete_predictions(self, cx, cy):
         pass
+
+    def batch(self):
+        pass
+
+
+def storage(cfg):
+    '''Return the Storage named by cfg['storage'], ceph (default) or
+       local, reading through the cache if cfg['cache'] is set'''
+
+    from blackmagic.data import cache
+    from blackmagic.data import ceph
+    from blackmagic.data import local
+
+    if get('storage', cfg, 'ceph') == 'local':
+        s = local.Local(cfg)
+    else:
+        s = ceph.Ceph(cfg)
+
+    return cache.Cached(cfg, s) if get('cache', cfg, False) else s
+
+
+@contextmanager
+def connect(cfg):
+
+    s = None
+
+    try:
+        s = storage(cfg)
+        s.start()
+        yield s
+    finally:
+        if s is not None:
+            s.stop()
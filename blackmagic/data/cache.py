@@ -0,0 +1,412 @@
+from blackmagic.data import ceph
+from blackmagic.data import Storage
+from collections import Counter
+from collections import OrderedDict
+from cytoolz import get
+from interface import implements
+
+import glob
+import hashlib
+import io
+import logging
+import mmap
+import numpy
+import os
+import tempfile
+import threading
+
+"""Blackmagic cache wraps another Storage backend with a read-through
+object cache.
+
+Objects are cached by their storage key in two tiers:
+
+memory: an in-process LRU bounded by cache_memory_bytes
+disk:   an LRU of files under cache_dir bounded by cache_disk_bytes, shared
+        by every process on the host.  Disabled when cache_dir is not set.
+
+Every read HEADs the object and a cached copy is only served while its
+ETag still matches, so retrained tiles and re-run chips are never stale.
+Objects the backend returns memory-mapped (local files) are not cached,
+as each map holds a file descriptor and the OS already caches the file.
+Writes and deletes go straight to the backend.
+
+Arrays is a separate disk LRU of numpy arrays, saved as .npy files and
+read memory-mapped, that /tile uses to keep each chip's training rows
+under training_cache_dir.  Disabled when training_cache_dir is not set.
+"""
+
+logger = logging.getLogger('blackmagic.cache')
+
+cfg = {'cache': bool(int(os.environ.get('CACHE', 0))),
+       'cache_memory_bytes': int(os.environ.get('CACHE_MEMORY_BYTES', 256 * 1024 ** 2)),
+       'cache_dir': os.environ.get('CACHE_DIR', '') or None,
+       'cache_disk_bytes': int(os.environ.get('CACHE_DISK_BYTES', 10 * 1024 ** 3)),
+       'training_cache_dir': os.environ.get('TRAINING_CACHE_DIR', '') or None,
+       'training_cache_bytes': int(os.environ.get('TRAINING_CACHE_BYTES', 10 * 1024 ** 3))}
+
+
+def _digest(s):
+    return hashlib.sha1(bytes(s, 'utf-8')).hexdigest()
+
+
+class Memory(object):
+    '''LRU of key -> (etag, value) bounded by the total bytes held'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key, etag):
+        e = self.entries.get(key)
+
+        if e is None:
+            return None
+
+        if e[0] != etag:
+            self.remove(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return e[1]
+
+    def put(self, key, etag, value):
+        '''Add value, returning the number of entries evicted'''
+
+        self.remove(key)
+
+        if len(value) > self.capacity:
+            return 0
+
+        self.entries[key] = (etag, value)
+        self.size += len(value)
+
+        evicted = 0
+
+        while self.size > self.capacity:
+            _, (_, v) = self.entries.popitem(last=False)
+            self.size -= len(v)
+            evicted += 1
+
+        return evicted
+
+    def remove(self, key):
+        e = self.entries.pop(key, None)
+
+        if e is not None:
+            self.size -= len(e[1])
+
+
+class Disk(object):
+    '''LRU of files under directory bounded by the total bytes held.
+
+       Files are named for their key & etag and written by rename so
+       processes may share a directory.  Recency is tracked with mtime.
+    '''
+
+    def __init__(self, directory, capacity, suffix=''):
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.capacity = capacity
+        self.suffix = suffix
+        self.size = sum(size for _, _, size in self._files())
+
+    def _path(self, key, etag):
+        return os.path.join(self.directory, '{}-{}{}'.format(_digest(key), _digest(etag), self.suffix))
+
+    def _files(self):
+        for e in os.scandir(self.directory):
+            if e.is_file() and not e.name.startswith('.'):
+                try:
+                    st = e.stat()
+                    yield st.st_mtime, e.path, st.st_size
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key, etag):
+        path = self._path(key, etag)
+
+        try:
+            with open(path, 'rb') as f:
+                v = f.read()
+            os.utime(path)
+            return v
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, etag, value):
+        '''Add value, returning the number of files evicted'''
+
+        if len(value) > self.capacity:
+            return 0
+
+        # drop copies of previous versions
+        for path in glob.glob(os.path.join(self.directory, '{}-*'.format(_digest(key)))):
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, self._path(key, etag))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        self.size += len(value)
+
+        return self.evict() if self.size > self.capacity else 0
+
+    def evict(self):
+        '''Remove least recently used files until under capacity.  The
+           directory is rescanned since other processes write to it.'''
+
+        files = sorted(self._files())
+
+        self.size = sum(size for _, _, size in files)
+
+        evicted = 0
+
+        for _, path, size in files:
+            if self.size <= self.capacity:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.size -= size
+            evicted += 1
+
+        return evicted
+
+
+class Arrays(object):
+    '''Disk LRU of numpy arrays saved as .npy files & loaded memory-mapped'''
+
+    def __init__(self, directory, capacity):
+        self.disk = Disk(directory, capacity, suffix='.npy')
+
+    def get(self, key, etag):
+        path = self.disk._path(key, etag)
+
+        try:
+            a = numpy.load(path, mmap_mode='r')
+            os.utime(path)
+            return a
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, etag, array):
+        '''Add array, returning the number of files evicted'''
+
+        b = io.BytesIO()
+        numpy.save(b, numpy.asarray(array), allow_pickle=False)
+
+        return self.disk.put(key, etag, b.getvalue())
+
+
+def arrays(cfg):
+    '''Return the training row cache for cfg, None if it is disabled'''
+
+    d = get('training_cache_dir', cfg, None)
+
+    return Arrays(d, cfg['training_cache_bytes']) if d else None
+
+
+class Cache(object):
+    '''Memory & disk tiers plus hit/miss/byte counters'''
+
+    def __init__(self, cfg):
+        self.memory = Memory(cfg['cache_memory_bytes'])
+        self.disk = Disk(cfg['cache_dir'], cfg['cache_disk_bytes']) if get('cache_dir', cfg, None) else None
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def read(self, key, etag, fetch):
+        '''Return the object stored at key.
+
+           etag(key) returns the object's current ETag and fetch(key)
+           returns the object's bytes and ETag.  Both raise the backend's
+           not found exception for missing objects.
+        '''
+
+        current = etag(key)
+
+        with self.lock:
+            v = self.memory.get(key, current)
+
+            if v is not None:
+                self.counters.update({'memory_hits': 1, 'memory_bytes': len(v)})
+                return v
+
+        if self.disk is not None:
+            v = self.disk.get(key, current)
+
+            if v is not None:
+                with self.lock:
+                    self.counters.update({'disk_hits': 1,
+                                          'disk_bytes': len(v),
+                                          'memory_evictions': self.memory.put(key, current, v)})
+                return v
+
+        v, e = fetch(key)
+
+        if isinstance(v, mmap.mmap):
+            with self.lock:
+                self.counters.update({'misses': 1, 'backend_bytes': len(v)})
+            return v
+
+        with self.lock:
+            self.counters.update({'misses': 1,
+                                  'backend_bytes': len(v),
+                                  'memory_evictions': self.memory.put(key, e, v)})
+
+        if self.disk is not None:
+            evicted = self.disk.put(key, e, v)
+
+            with self.lock:
+                self.counters.update({'disk_evictions': evicted})
+
+        return v
+
+    def stats(self):
+        with self.lock:
+            return dict({'memory_hits': 0,
+                         'disk_hits': 0,
+                         'misses': 0,
+                         'memory_bytes': 0,
+                         'disk_bytes': 0,
+                         'backend_bytes': 0,
+                         'memory_evictions': 0,
+                         'disk_evictions': 0},
+                        **self.counters,
+                        memory_size=self.memory.size,
+                        disk_size=self.disk.size if self.disk is not None else 0)
+
+
+_caches = {'pid': None, 'caches': {}}
+_caches_lock = threading.Lock()
+
+
+def cache(cfg):
+    '''Return the process-wide Cache for cfg.  Like S3 clients, caches
+       are rebuilt rather than shared across a fork.'''
+
+    key = (cfg['cache_memory_bytes'],
+           get('cache_dir', cfg, None),
+           cfg['cache_disk_bytes'])
+
+    with _caches_lock:
+        if _caches['pid'] != os.getpid():
+            _caches.update({'pid': os.getpid(), 'caches': {}})
+
+        c = get(key, _caches['caches'], None)
+
+        if c is None:
+            c = Cache(cfg)
+            _caches['caches'][key] = c
+
+        return c
+
+
+def stats():
+    '''Counters for every cache in this process'''
+
+    with _caches_lock:
+        caches = list(_caches['caches'].values()) if _caches['pid'] == os.getpid() else []
+
+    return [c.stats() for c in caches]
+
+
+class Cached(implements(Storage)):
+    '''Storage that reads through the process cache to backend.
+
+       backend defaults to Ceph and must read objects through its
+       cache attribute.
+    '''
+
+    def __init__(self, cfg, backend=None):
+        self.cfg = cfg
+        self.backend = backend if backend is not None else ceph.Ceph(cfg)
+        self.backend.cache = cache(cfg)
+
+    def stats(self):
+        return self.backend.cache.stats()
+
+    def setup(self):
+        return self.backend.setup()
+
+    def start(self):
+        return self.backend.start()
+
+    def stop(self):
+        return self.backend.stop()
+
+    def select_tile(self, tx, ty):
+        return self.backend.select_tile(tx, ty)
+
+    def select_tile_etag(self, tx, ty):
+        return self.backend.select_tile_etag(tx, ty)
+
+    def select_model(self, tx, ty, etag=None):
+        return self.backend.select_model(tx, ty, etag=etag)
+
+    def select_chip(self, cx, cy):
+        return self.backend.select_chip(cx, cy)
+
+    def select_pixels(self, cx, cy, packed=False):
+        return self.backend.select_pixels(cx, cy, packed=packed)
+
+    def select_segments(self, cx, cy, table=False):
+        return self.backend.select_segments(cx, cy, table=table)
+
+    def select_segments_many(self, chips, table=False):
+        return self.backend.select_segments_many(chips, table=table)
+
+    def select_segments_etag(self, cx, cy):
+        return self.backend.select_segments_etag(cx, cy)
+
+    def select_predictions(self, cx, cy, table=False):
+        return self.backend.select_predictions(cx, cy, table=table)
+
+    def insert_tile(self, tx, ty, model, metadata=None):
+        return self.backend.insert_tile(tx, ty, model, metadata=metadata)
+
+    def insert_chip(self, detections):
+        return self.backend.insert_chip(detections)
+
+    def insert_pixels(self, pixels):
+        return self.backend.insert_pixels(pixels)
+
+    def insert_segments(self, segments):
+        return self.backend.insert_segments(segments)
+
+    def insert_predictions(self, predictions):
+        return self.backend.insert_predictions(predictions)
+
+    def delete_tile(self, tx, ty):
+        return self.backend.delete_tile(tx, ty)
+
+    def delete_chip(self, cx, cy):
+        return self.backend.delete_chip(cx, cy)
+
+    def delete_pixels(self, cx, cy):
+        return self.backend.delete_pixels(cx, cy)
+
+    def delete_segments(self, cx, cy):
+        return self.backend.delete_segments(cx, cy)
+
+    def delete_predictions(self, cx, cy):
+        return self.backend.delete_predictions(cx, cy)
+
+    def batch(self):
+        return self.backend.batch()
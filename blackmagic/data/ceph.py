@@ -1,8 +1,9 @@
-from blackmagic.data import Storage
+from blackmagic.data.objects import Objects
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from contextlib import contextmanager
-from cytoolz import first
 from cytoolz import get
-from interface import implements
+from cytoolz import get_in
 
 import blackmagic
 import boto3
@@ -10,6 +11,7 @@ import json
 import gzip
 import logging
 import os
+import threading
 
 """Blackmagic ceph provides the capability of storing and retrieving
 all Blackmagic data with Ceph (S3).
@@ -53,17 +55,62 @@ logger = logging.getLogger(__name__)
 cfg = {'s3_url': os.environ.get('S3_URL', 'http://localhost:4572'),
        's3_access_key': os.environ.get('S3_ACCESS_KEY', ''),
        's3_secret_key': os.environ.get('S3_SECRET_KEY', ''),
-       's3_bucket': os.environ.get('S3_BUCKET', 'blackmagic-test-bucket')}
+       's3_bucket': os.environ.get('S3_BUCKET', 'blackmagic-test-bucket'),
+       's3_max_pool_connections': int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 10)),
+       's3_threads': int(os.environ.get('S3_THREADS', 10)),
+       'tile_format': os.environ.get('TILE_FORMAT', 'json'),
+       'pixel_format': os.environ.get('PIXEL_FORMAT', 'json'),
+       'segment_format': os.environ.get('SEGMENT_FORMAT', 'json'),
+       'segment_compression': os.environ.get('SEGMENT_COMPRESSION', '') or None,
+       'prediction_format': os.environ.get('PREDICTION_FORMAT', 'json'),
+       'prediction_quantization': os.environ.get('PREDICTION_QUANTIZATION', 'uint8'),
+       'prediction_top_k': int(os.environ.get('PREDICTION_TOP_K', 0)),
+       'format_cleanup': bool(int(os.environ.get('FORMAT_CLEANUP', 0)))}
+
+
+_clients = {'pid': None, 'clients': {}}
+_clients_lock = threading.Lock()
+
+
+def client(cfg):
+    '''Return the process-wide S3 client for cfg's endpoint & credentials.
+
+       boto3 clients are thread safe and hold an HTTP connection pool of
+       s3_max_pool_connections, so sharing one keeps connections alive
+       across requests.  Clients are never shared across a fork: the first
+       call in a new process (gunicorn worker, pool process) rebuilds them.
+    '''
+
+    key = (cfg['s3_url'],
+           cfg['s3_access_key'],
+           cfg['s3_secret_key'],
+           get('s3_max_pool_connections', cfg, 10))
+
+    with _clients_lock:
+        if _clients['pid'] != os.getpid():
+            _clients.update({'pid': os.getpid(), 'clients': {}})
+
+        c = get(key, _clients['clients'], None)
+        
+        if c is None:
+            c = boto3.session.Session().client('s3',
+                                               endpoint_url=cfg['s3_url'],
+                                               aws_access_key_id=cfg['s3_access_key'],
+                                               aws_secret_access_key=cfg['s3_secret_key'],
+                                               config=Config(max_pool_connections=key[3]))
+            _clients['clients'][key] = c
+
+        return c
 
-   
-class Ceph(implements(Storage)):
+    
+class Ceph(Objects):
 
     def __init__(self, cfg):
+        super().__init__(cfg)
         self.url = cfg['s3_url']
         self.bucket_name = cfg['s3_bucket']
         self.access_key = cfg['s3_access_key']
         self.secret_key = cfg['s3_secret_key']
-        self.cfg = cfg
         
     def setup(self):   
         s3 = boto3.resource('s3',
@@ -86,183 +133,31 @@ class Ceph(implements(Storage)):
         
         return s3.Bucket(self.bucket_name).create()
 
+    @property
+    def client(self):
+        return client(self.cfg)
+
     def start(self):
-        
-        self.client = boto3.client('s3',
-                                   endpoint_url=self.url,
-                                   aws_access_key_id=self.access_key,
-                                   aws_secret_access_key=self.secret_key)
-
-        resource = boto3.resource('s3',
-                                   endpoint_url=self.url,
-                                   aws_access_key_id=self.access_key,
-                                   aws_secret_access_key=self.secret_key)
-        
-        self.bucket = resource.Bucket(self.bucket_name)
+        return self.client
 
     def stop(self):
-        self.client = None
-        self.bucket = None
-
-    def select_tile(self, tx, ty):
-        try:
-            return self._get_json(self._tile_key(tx=tx, ty=ty))
-        except self.client.exceptions.NoSuchKey:
-            return []
-    
-    def select_chip(self, cx, cy):
-        try:
-            return self._get_json(self._chip_key(cx=cx, cy=cy))
-        except self.client.exceptions.NoSuchKey:
-            return []
-
-    def select_pixels(self, cx, cy):
-        try:
-            return self._get_json(self._pixel_key(cx=cx, cy=cy))
-        except self.client.exceptions.NoSuchKey:
-            return []
-
-    def select_segments(self, cx, cy):
-        try:
-            return self._get_json(self._segment_key(cx=cx, cy=cy))
-        except self.client.exceptions.NoSuchKey:
-            return []
-
-    def select_predictions(self, cx, cy):
-        try:
-            return self._get_json(self._prediction_key(cx=cx, cy=cy))
-        except self.client.exceptions.NoSuchKey:
-            return []
-
-    def insert_tile(self, tx, ty, model):
-
-        def tile(tx, ty, tile):
-            return {'tx': tx,
-                    'ty': ty,
-                    'model': model}
-
-        t = tile(tx, ty, model)
-        
-        return self._put_json(self._tile_key(tx, ty),
-                              [t],
-                              compress=True)
-    
-    def insert_chip(self, detections):
+        # the client is shared by the process, nothing to release
+        pass
 
-        def chip(detection):
-            return {'cx':    detection['cx'],
-                    'cy':    detection['cy'],
-                    'dates': detection['dates']}
+    @property
+    def not_found(self):
+        return self.client.exceptions.NoSuchKey
 
-        c = chip(first(detections))
+    def _keys(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
 
-        return self._put_json(self._chip_key(c['cx'], c['cy']),
-                              [c],
-                              compress=True)
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for o in get('Contents', page, []):
+                yield o['Key']
 
-    def insert_pixels(self, detections):
+    def _fetch(self, key):
+        '''GET an object, returning its uncompressed bytes and ETag'''
         
-        def pixel(detection):
-            return {'cx':   detection['cx'],
-                    'cy':   detection['cy'],
-                    'px':   detection['px'],
-                    'py':   detection['py'],
-                    'mask': detection['mask']}
-
-        pixels = [pixel(d) for d in detections]
-        
-        return self._put_json(self._pixel_key(first(pixels)['cx'], first(pixels)['cy']),
-                              pixels,
-                              compress=True)
-
-    def insert_segments(self, detections):
-
-        def segment(detection):
-            return {'cx':     detection['cx'],
-                    'cy':     detection['cy'],
-                    'px':     detection['px'],
-                    'py':     detection['py'],
-                    'sday':   detection['sday'],
-                    'eday':   detection['eday'],
-                    'bday':   detection['bday'],
-                    'chprob': detection['chprob'],
-                    'curqa':  detection['curqa'],
-                    'blcoef': detection['blcoef'],
-                    'blint':  detection['blint'],
-                    'blmag':  detection['blmag'],
-                    'blrmse': detection['blrmse'],
-                    'grcoef': detection['grcoef'],
-                    'grint':  detection['grint'],
-                    'grmag':  detection['grmag'],
-                    'grrmse': detection['grrmse'],
-                    'nicoef': detection['nicoef'],
-                    'niint':  detection['niint'],
-                    'nimag':  detection['nimag'],
-                    'nirmse': detection['nirmse'],
-                    'recoef': detection['recoef'],
-                    'reint':  detection['reint'],
-                    'remag':  detection['remag'],
-                    'rermse': detection['rermse'],
-                    's1coef': detection['s1coef'],
-                    's1int':  detection['s1int'],
-                    's1mag':  detection['s1mag'],
-                    's1rmse': detection['s1rmse'],
-                    's2coef': detection['s2coef'],
-                    's2int':  detection['s2int'],
-                    's2mag':  detection['s2mag'],
-                    's2rmse': detection['s2rmse'],
-                    'thcoef': detection['thcoef'],
-                    'thint':  detection['thint'],
-                    'thmag':  detection['thmag'],
-                    'thrmse': detection['thrmse']}
-
-        segments = [segment(d) for d in detections]
-        
-        return self._put_json(self._segment_key(first(detections)['cx'], first(detections)['cy']),
-                              segments,
-                              compress=True)
-
-    def insert_predictions(self, predictions):
-
-        def prediction(p):
-            return {'cx':   p['cx'],
-                    'cy':   p['cy'],
-                    'px':   p['px'],
-                    'py':   p['py'],
-                    'sday': p['sday'],
-                    'eday': p['eday'],
-                    'pday': p['pday'],
-                    'prob': p['prob']}
-
-        preds = [prediction(p) for p in predictions]
-
-        if len(preds) > 0:
-            return self._put_json(self._prediction_key(first(predictions)['cx'],
-                                                       first(predictions)['cy']),
-                                  preds,
-                                  compress=True)
-        else:
-            msg = "No predictions supplied to ceph.insert_predictions... skipping save"
-            logger.warn(msg)
-            return msg
-            
-
-    def delete_tile(self, tx, ty):
-        return self._delete(self._tile_key(tx=tx, ty=ty))
-    
-    def delete_chip(self, cx, cy):
-        return self._delete(self._chip_key(cx=cx, cy=cy))
-
-    def delete_pixels(self, cx, cy):
-        return self._delete(self._pixel_key(cx=cx, cy=cy))
-
-    def delete_segments(self, cx, cy):
-        return self._delete(self._segment_key(cx=cx, cy=cy))
-
-    def delete_predictions(self, cx, cy):
-        return self._delete(self._prediction_key(cx=cx, cy=cy))
-
-    def _get_bin(self, key):
         o = self.client.get_object(Bucket=self.bucket_name, Key=key)
 
         if get('ContentEncoding', o, None) == 'gzip':
@@ -270,7 +165,17 @@ class Ceph(implements(Storage)):
         else:
             v = o['Body'].read()
 
-        return v
+        return v, o['ETag']
+
+    def _etag(self, key):
+        '''HEAD an object, returning its ETag'''
+        
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=key)['ETag']
+        except ClientError as e:
+            if get_in(['Error', 'Code'], e.response) in ('404', 'NoSuchKey'):
+                raise self.client.exceptions.NoSuchKey(e.response, 'HeadObject')
+            raise
 
     def _put_bin(self, key, value, compress=True):
 
@@ -278,8 +183,8 @@ class Ceph(implements(Storage)):
 
         if compress:
             v = gzip.compress(v)
-            
-            return self.bucket.put_object(Bucket=self.bucket_name,
+
+            return self.client.put_object(Bucket=self.bucket_name,
                                           Key=key,
                                           Body=v,
                                           ACL='public-read',
@@ -287,23 +192,13 @@ class Ceph(implements(Storage)):
                                           ContentLength=len(v),
                                           ContentEncoding='gzip')
         else:
-            return self.bucket.put_object(Bucket=self.bucket_name,
+            return self.client.put_object(Bucket=self.bucket_name,
                                           Key=key,
                                           Body=v,
                                           ACL='public-read',
                                           ContentType='application/octet-stream',
                                           ContentLength=len(v))
     
-    def _get_json(self, key):
-        o = self.client.get_object(Bucket=self.bucket_name, Key=key)
-        
-        if get('ContentEncoding', o, None) == 'gzip':
-            v = gzip.decompress(o['Body'].read()).decode('utf-8')
-        else:
-            v = o['Body'].read().decode('utf-8')
-
-        return json.loads(v)
-                            
     def _put_json(self, key, value, compress=True):
 
         """if compression is desired, this works:
@@ -316,8 +211,8 @@ class Ceph(implements(Storage)):
 
         if compress:
             v = gzip.compress(v)
-            
-            return self.bucket.put_object(Bucket=self.bucket_name,
+
+            return self.client.put_object(Bucket=self.bucket_name,
                                           Key=key,
                                           Body=v,
                                           ACL='public-read',
@@ -325,7 +220,7 @@ class Ceph(implements(Storage)):
                                           ContentLength=len(v),
                                           ContentEncoding='gzip')
         else:
-            return self.bucket.put_object(Bucket=self.bucket_name,
+            return self.client.put_object(Bucket=self.bucket_name,
                                           Key=key,
                                           Body=v,
                                           ACL='public-read',
@@ -335,21 +230,20 @@ class Ceph(implements(Storage)):
     def _delete(self, key):
         return self.client.delete_object(Bucket=self.bucket_name, Key=key)
 
-    def _tile_key(self, tx, ty):
-        return 'tile/{tx}-{ty}.json'.format(tx=tx, ty=ty)
-
-    def _chip_key(self, cx, cy):
-        return 'chip/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+    def _delete_many(self, keys):
+        '''Delete keys with as few requests as possible, 1000 keys per request'''
 
-    def _pixel_key(self, cx, cy):
-        return 'pixel/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+        keys = list(keys)
 
-    def _segment_key(self, cx, cy):
-        return 'segment/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+        for i in range(0, len(keys), 1000):
+            r = self.client.delete_objects(Bucket=self.bucket_name,
+                                           Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]],
+                                                   'Quiet': True})
 
-    def _prediction_key(self, cx, cy):
-        return 'prediction/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+            errors = get('Errors', r, [])
 
+            if errors:
+                raise Exception('could not delete {}'.format(errors))
 
 @contextmanager
 def connect(cfg):
@@ -0,0 +1,47 @@
+'''
+Convert the JSON segment objects in a bucket to the columnar format.
+
+    $ python -m blackmagic.data.convert [--remove] [--other-formats]
+
+--other-formats instead deletes every object that is also saved in the
+format configured for it, which is needed once after changing
+TILE_FORMAT, PIXEL_FORMAT, SEGMENT_FORMAT or PREDICTION_FORMAT.
+
+The storage, formats and compression are taken from the same environment
+variables used by the server: STORAGE, S3_URL, S3_BUCKET, S3_ACCESS_KEY, 
+S3_SECRET_KEY, LOCAL_DIR, the *_FORMAT variables & SEGMENT_COMPRESSION.
+'''
+
+from blackmagic.data import ceph
+from blackmagic.data import connect
+from blackmagic.data import local
+from cytoolz import merge
+
+import argparse
+import logging
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert JSON segments to columnar segments')
+    parser.add_argument('--remove',
+                        action='store_true',
+                        help='delete JSON segment objects after converting them')
+    parser.add_argument('--other-formats',
+                        action='store_true',
+                        help='delete objects also saved in their configured format instead of converting')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s %(name)-15s %(levelname)-8s - %(message)s',
+                        level=logging.INFO)
+
+    with connect(merge(ceph.cfg, local.cfg)) as c:
+        if args.other_formats:
+            n = c.remove_other_formats()
+            logging.getLogger('blackmagic.convert').info("removed {} objects".format(n))
+        else:
+            n = c.convert_segments(remove=args.remove)
+            logging.getLogger('blackmagic.convert').info("converted {} chips".format(n))
+
+
+if __name__ == '__main__':
+    main()
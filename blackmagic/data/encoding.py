@@ -0,0 +1,292 @@
+'''
+encoding.py packs columnar tables (dicts of numpy arrays, see
+blackmagic.columnar) into a single versioned binary object and
+unpacks them with numpy.frombuffer so column data is never parsed
+and, when uncompressed, never copied.
+
+Layout:
+
+    magic    4 bytes  b'BMAG'
+    version  uint16
+    codec    uint16   compression applied to the data section, see CODECS
+    length   uint32   byte length of the header
+    header   JSON     {"attrs": {...},
+                       "columns": [{"name", "dtype", "shape", "offset"}, ...]}
+    data     raw little-endian column data, each column 8-byte aligned,
+             offsets relative to the start of the (decompressed) data section
+
+zstd and lz4 compression are optional and require the zstandard or
+lz4 packages.
+'''
+
+from blackmagic import columnar
+from cytoolz import dissoc
+from cytoolz import get
+
+import json
+import numpy
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+    
+
+MAGIC = b'BMAG'
+
+VERSION = 1
+
+PREAMBLE = struct.Struct('<4sHHI')
+
+ALIGNMENT = 8
+
+CODECS = {None: 0, 'zstd': 1, 'lz4': 2}
+
+SEGMENT_DTYPES = {'cx':     numpy.int32,
+                  'cy':     numpy.int32,
+                  'px':     numpy.int32,
+                  'py':     numpy.int32,
+                  'sday':   numpy.int32,
+                  'eday':   numpy.int32,
+                  'bday':   numpy.int32,
+                  'chprob': numpy.float32,
+                  'curqa':  numpy.int32,
+                  'mag':    numpy.float32,
+                  'rmse':   numpy.float32,
+                  'int':    numpy.float32,
+                  'coef':   numpy.float32}
+
+
+def _compress(data, codec):
+    if codec is None:
+        return data
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    elif codec == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(data)
+    else:
+        raise ValueError('compression codec unavailable: {}'.format(codec))
+
+
+def _decompress(data, codec):
+    if codec is None:
+        return data
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(bytes(data))
+    elif codec == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(bytes(data))
+    else:
+        raise ValueError('compression codec unavailable: {}'.format(codec))
+
+
+def _padding(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+def _little_endian(a):
+    a = numpy.asarray(a)
+    return numpy.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))
+
+
+def is_encoded(buf):
+    '''Determine if buf holds an encoded table'''
+
+    return bytes(buf[:len(MAGIC)]) == MAGIC
+
+
+def encode(table, attrs=None, codec=None):
+    '''Encode a table and optional JSON-able attrs as bytes.
+       codec may be None, 'zstd' or 'lz4'.'''
+
+    columns = []
+    chunks  = []
+    offset  = 0
+
+    for name, values in table.items():
+        a = _little_endian(values)
+
+        columns.append({'name': name,
+                        'dtype': a.dtype.str,
+                        'shape': list(a.shape),
+                        'offset': offset})
+
+        chunks.extend([a.tobytes(), bytes(_padding(a.nbytes))])
+        offset += a.nbytes + _padding(a.nbytes)
+
+    header = bytes(json.dumps({'attrs': attrs or {}, 'columns': columns}), 'utf-8')
+    header = header + b' ' * _padding(PREAMBLE.size + len(header))
+
+    return b''.join([PREAMBLE.pack(MAGIC, VERSION, CODECS[codec], len(header)),
+                     header,
+                     _compress(b''.join(chunks), codec)])
+
+
+def decode(buf):
+    '''Decode bytes produced by encode().
+
+       Columns are read-only views into buf.
+       Returns (table, attrs)
+    '''
+
+    if not is_encoded(buf):
+        raise ValueError('not an encoded table')
+
+    magic, version, code, length = PREAMBLE.unpack_from(buf, 0)
+
+    if version > VERSION:
+        raise ValueError('unsupported encoding version: {}'.format(version))
+
+    codec  = {v: k for k, v in CODECS.items()}.get(code, code)
+    header = json.loads(bytes(buf[PREAMBLE.size:PREAMBLE.size + length]).decode('utf-8'))
+    start  = PREAMBLE.size + length
+    table  = {}
+
+    if codec is not None:
+        buf   = _decompress(memoryview(buf)[start:], codec)
+        start = 0
+
+    for c in header['columns']:
+        dtype = numpy.dtype(c['dtype'])
+        count = int(numpy.prod(c['shape'], dtype=numpy.int64))
+
+        table[c['name']] = numpy.frombuffer(buf,
+                                            dtype=dtype,
+                                            count=count,
+                                            offset=start + c['offset']).reshape(c['shape'])
+
+    return table, get('attrs', header, {})
+
+
+def pack_pixels(pixels):
+    '''Bit-pack the processing masks of a pixel table'''
+
+    mask = numpy.asarray(pixels['mask'], dtype=numpy.bool_)
+
+    return {'cx':    numpy.asarray(pixels['cx'], dtype=numpy.int32),
+            'cy':    numpy.asarray(pixels['cy'], dtype=numpy.int32),
+            'px':    numpy.asarray(pixels['px'], dtype=numpy.int32),
+            'py':    numpy.asarray(pixels['py'], dtype=numpy.int32),
+            'mask':  numpy.packbits(mask, axis=1),
+            'dates': mask.shape[1]}
+
+
+def encode_pixels(pixels):
+    '''Encode a pixel table with its processing masks bit-packed'''
+
+    p = pack_pixels(pixels)
+    
+    return encode(dissoc(p, 'dates'), attrs={'kind': 'pixel', 'dates': p['dates']})
+
+
+def decode_pixels(buf, packed=False):
+    '''Decode encoded pixels.
+
+       packed=True returns the pixel table with the mask still bit-packed
+       as uint8 [pixels, ceil(dates / 8)] and a 'dates' count to unpack it.
+       Otherwise returns the legacy list of pixel dicts.
+    '''
+
+    table, attrs = decode(buf)
+
+    if packed:
+        return dict(table, dates=attrs['dates'])
+
+    mask = numpy.unpackbits(table['mask'], axis=1, count=attrs['dates'])
+
+    return columnar.pixel_records(dict(table, mask=mask))
+
+
+def encode_segments(segments, codec=None):
+    '''Encode a segment table with fixed width int32 & float32 columns'''
+
+    return encode({k: numpy.asarray(v, dtype=SEGMENT_DTYPES[k]) for k, v in segments.items()},
+                  attrs={'kind': 'segment'},
+                  codec=codec)
+
+
+def decode_segments(buf, table=False):
+    '''Decode encoded segments as a segment table (table=True) or 
+       the legacy list of segment dicts'''
+
+    segments, attrs = decode(buf)
+
+    return segments if table else columnar.records(segments)
+
+
+QUANTIZATIONS = ('uint8', 'float16')
+
+
+def quantize(prob, quantization):
+    '''Quantize probabilities to uint8 steps of 1/255 or to float16'''
+
+    if quantization == 'uint8':
+        return numpy.rint(numpy.clip(prob, 0, 1) * 255).astype(numpy.uint8)
+    elif quantization == 'float16':
+        return numpy.asarray(prob).astype(numpy.float16)
+    else:
+        raise ValueError('unsupported quantization: {}'.format(quantization))
+
+
+def dequantize(prob, quantization):
+    '''Restore float32 probabilities from quantize()'''
+
+    if quantization == 'uint8':
+        return prob.astype(numpy.float32) / numpy.float32(255)
+    elif quantization == 'float16':
+        return prob.astype(numpy.float32)
+    else:
+        raise ValueError('unsupported quantization: {}'.format(quantization))
+
+    
+def encode_predictions(predictions, quantization='uint8', top_k=0, codec=None):
+    '''Encode a prediction table with int32 metadata columns and quantized
+       probabilities.
+
+       top_k > 0 keeps only each row's top_k most probable classes, saved
+       as uint8 class indices alongside their probabilities.
+    '''
+
+    prob    = numpy.asarray(predictions['prob'], dtype=numpy.float32)
+    classes = prob.shape[1]
+    table   = {k: numpy.asarray(predictions[k], dtype=numpy.int32)
+               for k in ('cx', 'cy', 'px', 'py', 'sday', 'eday', 'pday')}
+
+    table['scored'] = numpy.asarray(predictions['scored'], dtype=numpy.bool_)
+
+    if 0 < top_k < classes:
+        leading = numpy.argsort(-prob, axis=1, kind='stable')[:, :top_k]
+        table['class'] = leading.astype(numpy.uint8)
+        table['prob']  = quantize(numpy.take_along_axis(prob, leading, axis=1), quantization)
+    else:
+        table['prob'] = quantize(prob, quantization)
+
+    return encode(table,
+                  attrs={'kind': 'prediction',
+                         'quantization': quantization,
+                         'classes': classes},
+                  codec=codec)
+
+
+def decode_predictions(buf, table=False):
+    '''Decode encoded predictions as a prediction table (table=True) or
+       the legacy list of prediction dicts.  Probabilities are restored
+       to float32 [rows, classes], zero for classes dropped by top_k.'''
+
+    predictions, attrs = decode(buf)
+
+    prob = dequantize(predictions['prob'], attrs['quantization'])
+
+    if 'class' in predictions:
+        full = numpy.zeros((len(prob), attrs['classes']), dtype=numpy.float32)
+        numpy.put_along_axis(full, predictions['class'].astype(numpy.intp), prob, axis=1)
+        prob = full
+
+    predictions = dict(dissoc(predictions, 'class'), prob=prob)
+
+    return predictions if table else columnar.prediction_records(predictions)
@@ -0,0 +1,116 @@
+from blackmagic.data.objects import Objects
+from contextlib import contextmanager
+
+import json
+import logging
+import mmap
+import os
+import tempfile
+
+"""Blackmagic local stores all Blackmagic data as files under a local
+directory, one file per object, laid out by the same keys as Ceph:
+
+local_dir/tile/tx-ty.json|.bin
+local_dir/tile/tx-ty.meta.json
+local_dir/chip/cx-cy.json
+local_dir/pixel/cx-cy.json|.bin
+local_dir/segment/cx-cy.json|.bin
+local_dir/prediction/cx-cy.json|.bin
+
+Files are never gzipped so binary objects can be memory-mapped and
+decoded in place.  Writes go to a temporary file that is renamed over
+the target, so readers only ever see whole objects.
+"""
+
+logger = logging.getLogger(__name__)
+
+cfg = {'storage': os.environ.get('STORAGE', 'ceph'),
+       'local_dir': os.environ.get('LOCAL_DIR', 'blackmagic-data')}
+
+
+class Local(Objects):
+
+    not_found = FileNotFoundError
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.directory = cfg['local_dir']
+
+    def setup(self):
+        for d in ('tile', 'chip', 'pixel', 'segment', 'prediction'):
+            os.makedirs(os.path.join(self.directory, d), exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def _keys(self, prefix):
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                key = os.path.relpath(os.path.join(root, f), self.directory).replace(os.sep, '/')
+
+                if key.startswith(prefix) and not f.startswith('.'):
+                    yield key
+
+    def _fetch(self, key):
+        '''Map a file read-only, returning the map and an ETag'''
+
+        with open(self._path(key), 'rb') as f:
+            st = os.fstat(f.fileno())
+
+            if st.st_size == 0:
+                v = b''
+            else:
+                v = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return v, self._etag_of(st)
+
+    def _etag(self, key):
+        return self._etag_of(os.stat(self._path(key)))
+
+    def _etag_of(self, st):
+        return '{}-{}'.format(st.st_mtime_ns, st.st_size)
+
+    def _put(self, key, value):
+        path = self._path(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+
+        try:
+            os.fchmod(fd, 0o644)
+
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        return path
+
+    def _put_bin(self, key, value, compress=True):
+        return self._put(key, value)
+
+    def _put_json(self, key, value, compress=True):
+        return self._put(key, bytes(json.dumps(value), 'utf-8'))
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def connect(cfg):
+
+    c = None
+
+    try:
+        c = Local(cfg)
+        c.start()
+        yield c
+    finally:
+        if c is not None:
+            c.stop()
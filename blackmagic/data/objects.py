@@ -0,0 +1,597 @@
+from blackmagic import columnar
+from blackmagic.data import encoding
+from blackmagic.data import Storage
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
+from cytoolz import first
+from cytoolz import get
+from cytoolz import take
+from interface import implements
+from tenacity import retry
+from tenacity import stop_after_attempt
+from tenacity import wait_exponential
+
+import json
+import logging
+import threading
+
+"""Blackmagic objects holds the Storage logic shared by backends that
+save each partition as one object under a key, such as Ceph (S3) and
+the local filesystem.
+
+Keys are:
+
+tile/tx-ty.json|.bin
+tile/tx-ty.meta.json
+chip/cx-cy.json
+pixel/cx-cy.json|.bin
+segment/cx-cy.json|.bin
+prediction/cx-cy.json|.bin
+
+Backends supply the object operations:
+
+_fetch(key)                 -> (bytes, etag) 
+_etag(key)                  -> etag
+_put_bin(key, value, compress=True)
+_put_json(key, value, compress=True)
+_delete(key)
+_keys(prefix)               -> iterable of keys
+not_found                   exception raised for missing objects
+
+and may override _delete_many(keys) to delete many objects per request.
+
+Writes overwrite objects in place, which is atomic for a single object.
+Reads try the configured format first, so a copy left in another format
+is never read while the format is unchanged.  remove_other_formats()
+deletes those copies once, after changing formats (see
+blackmagic.data.convert).  With format_cleanup on, every write removes
+them instead, with one _delete_many per batch() block.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Objects(implements(Storage)):
+
+    def __init__(self, cfg):
+        self.tile_format = cfg.get('tile_format', 'json')
+        self.pixel_format = cfg.get('pixel_format', 'json')
+        self.segment_format = cfg.get('segment_format', 'json')
+        self.segment_compression = cfg.get('segment_compression', None)
+        self.prediction_format = cfg.get('prediction_format', 'json')
+        self.prediction_quantization = cfg.get('prediction_quantization', 'uint8')
+        self.prediction_top_k = cfg.get('prediction_top_k', 0)
+        self.format_cleanup = cfg.get('format_cleanup', False)
+        self.cfg = cfg
+        self._batch = threading.local()
+        self.cache = None
+
+    def setup(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def select_tile(self, tx, ty):
+        '''Return the tile as a list holding one dict with the model as 
+           a hex string.  Both tile formats are readable regardless of the 
+           configured tile_format.'''
+
+        readers = [self._select_binary_tile, self._select_json_tile]
+
+        if self.tile_format != 'binary':
+            readers.reverse()
+
+        return self._first_found(readers, tx=tx, ty=ty)
+
+    def _select_binary_tile(self, tx, ty):
+        return [{'tx': tx,
+                 'ty': ty,
+                 'model': bytes(self._select_binary_model(tx, ty)).hex()}]
+
+    def _select_json_tile(self, tx, ty):
+        return self._get_json(self._tile_key(tx=tx, ty=ty))
+
+    def select_tile_etag(self, tx, ty):
+        '''Return the ETag of the tile's model without reading it, None
+           if there is no model'''
+
+        keys = [self._binary_tile_key(tx=tx, ty=ty), self._tile_key(tx=tx, ty=ty)]
+
+        if self.tile_format != 'binary':
+            keys.reverse()
+
+        for key in keys:
+            try:
+                return self._etag(key)
+            except self.not_found:
+                pass
+
+        return None
+
+    def select_model(self, tx, ty, etag=None):
+        '''Return {'model': bytes, 'metadata': dict} for the tile or {} 
+           if there is no model.  metadata is {} for tiles saved without it.
+
+           etag is the model's ETag from select_tile_etag, if known, and
+           spares the cache from asking for it again.  Both look for the
+           tile formats in the same order so it belongs to the model found.'''
+
+        readers = [self._select_binary_model, self._select_json_model]
+
+        if self.tile_format != 'binary':
+            readers.reverse()
+
+        model = self._first_found(readers, tx=tx, ty=ty, etag=etag)
+
+        if len(model) == 0:
+            return {}
+
+        try:
+            metadata = self._get_json(self._tile_metadata_key(tx=tx, ty=ty))
+        except self.not_found:
+            metadata = {}
+
+        return {'model': model, 'metadata': metadata}
+
+    def _select_binary_model(self, tx, ty, etag=None):
+        return self._get_bin(self._binary_tile_key(tx=tx, ty=ty), etag=etag)
+
+    def _select_json_model(self, tx, ty, etag=None):
+        return bytes.fromhex(first(self._get_json(self._tile_key(tx=tx, ty=ty), etag=etag))['model'])
+
+    def select_chip(self, cx, cy):
+        try:
+            return self._get_json(self._chip_key(cx=cx, cy=cy))
+        except self.not_found:
+            return []
+
+    def select_pixels(self, cx, cy, packed=False):
+        '''Return pixels as a list of dicts or, with packed=True, as a pixel
+           table with bit-packed masks.  Both pixel formats are readable
+           regardless of the configured pixel_format.'''
+
+        readers = [self._select_packed_pixels, self._select_json_pixels]
+
+        if self.pixel_format != 'packed':
+            readers.reverse()
+
+        return self._first_found(readers, cx=cx, cy=cy, packed=packed)
+
+    def _select_packed_pixels(self, cx, cy, packed):
+        return encoding.decode_pixels(self._get_bin(self._packed_pixel_key(cx=cx, cy=cy)),
+                                      packed=packed)
+
+    def _select_json_pixels(self, cx, cy, packed):
+        pixels = self._get_json(self._pixel_key(cx=cx, cy=cy))
+
+        if packed:
+            return encoding.pack_pixels(columnar.pixel_table(pixels))
+        else:
+            return pixels
+
+    def select_segments(self, cx, cy, table=False):
+        '''Return segments as a list of dicts or, with table=True, as a
+           segment table.  Both segment formats are readable regardless 
+           of the configured segment_format.'''
+
+        readers = [self._select_columnar_segments, self._select_json_segments]
+
+        if self.segment_format != 'columnar':
+            readers.reverse()
+
+        return self._first_found(readers, cx=cx, cy=cy, table=table)
+
+    def select_segments_many(self, chips, table=False):
+        '''Fetch segments for many chips concurrently.
+
+           Reads run on a pool of s3_threads threads.  At most twice 
+           that many chips are in flight or waiting to be consumed at once.
+
+           Yields (cx, cy, segments) in completion order.
+        '''
+
+        threads = get('s3_threads', self.cfg, 10)
+        chips   = iter(chips)
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+
+            def submit(n):
+                for cx, cy in take(n, chips):
+                    f = executor.submit(_select_segments, self, cx, cy, table)
+                    pending[f] = (cx, cy)
+
+            submit(threads * 2)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for f in done:
+                    cx, cy = pending.pop(f)
+                    yield (cx, cy, f.result())
+
+                submit(len(done))
+
+    def select_segments_etag(self, cx, cy):
+        '''Return the ETag of the chip's segments without reading them,
+           None if there are no segments'''
+
+        keys = [self._columnar_segment_key(cx=cx, cy=cy), self._segment_key(cx=cx, cy=cy)]
+
+        if self.segment_format != 'columnar':
+            keys.reverse()
+
+        for key in keys:
+            try:
+                return self._etag(key)
+            except self.not_found:
+                pass
+
+        return None
+
+    def _select_columnar_segments(self, cx, cy, table):
+        return encoding.decode_segments(self._get_bin(self._columnar_segment_key(cx=cx, cy=cy)),
+                                        table=table)
+
+    def _select_json_segments(self, cx, cy, table):
+        segments = self._get_json(self._segment_key(cx=cx, cy=cy))
+
+        if table:
+            return columnar.segment_table(segments)
+        else:
+            return segments
+
+    def select_predictions(self, cx, cy, table=False):
+        '''Return predictions as a list of dicts or, with table=True, as a
+           prediction table.  Both prediction formats are readable
+           regardless of the configured prediction_format.'''
+
+        readers = [self._select_compact_predictions, self._select_json_predictions]
+
+        if self.prediction_format != 'compact':
+            readers.reverse()
+
+        return self._first_found(readers, cx=cx, cy=cy, table=table)
+
+    def _select_compact_predictions(self, cx, cy, table):
+        return encoding.decode_predictions(self._get_bin(self._compact_prediction_key(cx=cx, cy=cy)),
+                                           table=table)
+
+    def _select_json_predictions(self, cx, cy, table):
+        predictions = self._get_json(self._prediction_key(cx=cx, cy=cy))
+
+        if table:
+            return columnar.prediction_table(predictions)
+        else:
+            return predictions
+
+    def insert_tile(self, tx, ty, model, metadata=None):
+        '''Save a tile's model, as bytes or a hex string, and optionally
+           a dict of metadata alongside it.
+
+           The metadata is written first so the model write commits the
+           save: a model is never newer than its metadata.'''
+
+        if metadata is not None:
+            self._put_json(self._tile_metadata_key(tx, ty),
+                           metadata,
+                           compress=False)
+        else:
+            self._delete_many([self._tile_metadata_key(tx, ty)])
+
+        if self.tile_format == 'binary':
+            stale = [self._tile_key(tx, ty)]
+            r = self._put_bin(self._binary_tile_key(tx, ty),
+                              bytes.fromhex(model) if isinstance(model, str) else model,
+                              compress=False)
+        else:
+            stale = [self._binary_tile_key(tx, ty)]
+            t = {'tx': tx,
+                 'ty': ty,
+                 'model': model if isinstance(model, str) else bytes(model).hex()}
+
+            r = self._put_json(self._tile_key(tx, ty),
+                               [t],
+                               compress=True)
+
+        self._remove_stale(stale)
+
+        return r
+    
+    def insert_chip(self, detections):
+
+        def chip(detection):
+            return {'cx':    detection['cx'],
+                    'cy':    detection['cy'],
+                    'dates': detection['dates']}
+
+        c = chip(first(detections))
+
+        return self._put_json(self._chip_key(c['cx'], c['cy']),
+                              [c],
+                              compress=True)
+
+    def insert_pixels(self, pixels):
+        '''Save a chip's pixels as a pixel table (see blackmagic.columnar)
+           or a list of pixel dicts'''
+
+        if not isinstance(pixels, dict):
+            pixels = columnar.pixel_table(pixels)
+
+        if columnar.length(pixels) == 0:
+            msg = "No pixels supplied to ceph.insert_pixels... skipping save"
+            logger.warn(msg)
+            return msg
+
+        cx = int(first(pixels['cx']))
+        cy = int(first(pixels['cy']))
+
+        if self.pixel_format == 'packed':
+            r = self._put_bin(self._packed_pixel_key(cx, cy),
+                              encoding.encode_pixels(pixels),
+                              compress=True)
+            self._remove_stale([self._pixel_key(cx, cy)])
+        else:
+            r = self._put_json(self._pixel_key(cx, cy),
+                               columnar.pixel_records(pixels),
+                               compress=True)
+            self._remove_stale([self._packed_pixel_key(cx, cy)])
+
+        return r
+
+    def insert_segments(self, segments):
+        '''Save a chip's segments as a segment table (see blackmagic.columnar)
+           or a list of segment dicts'''
+
+        if not isinstance(segments, dict):
+            segments = columnar.segment_table(segments)
+
+        if columnar.length(segments) == 0:
+            msg = "No segments supplied to ceph.insert_segments... skipping save"
+            logger.warn(msg)
+            return msg
+
+        cx = int(first(segments['cx']))
+        cy = int(first(segments['cy']))
+
+        if self.segment_format == 'columnar':
+            r = self._put_bin(self._columnar_segment_key(cx, cy),
+                              encoding.encode_segments(segments, codec=self.segment_compression),
+                              compress=self.segment_compression is None)
+            self._remove_stale([self._segment_key(cx, cy)])
+        else:
+            r = self._put_json(self._segment_key(cx, cy),
+                               columnar.records(segments),
+                               compress=True)
+            self._remove_stale([self._columnar_segment_key(cx, cy)])
+
+        return r
+
+    def insert_predictions(self, predictions):
+        '''Save a chip's predictions as a list of dicts.  The compact
+           prediction_format saves quantized probabilities, optionally only
+           the prediction_top_k leading classes.'''
+
+        if self.prediction_format == 'compact':
+            return self._insert_compact_predictions(predictions)
+
+        def prediction(p):
+            return {'cx':   p['cx'],
+                    'cy':   p['cy'],
+                    'px':   p['px'],
+                    'py':   p['py'],
+                    'sday': p['sday'],
+                    'eday': p['eday'],
+                    'pday': p['pday'],
+                    'prob': p['prob']}
+
+        preds = [prediction(p) for p in predictions]
+
+        if len(preds) > 0:
+            cx = first(preds)['cx']
+            cy = first(preds)['cy']
+            r  = self._put_json(self._prediction_key(cx, cy), preds, compress=True)
+            self._remove_stale([self._compact_prediction_key(cx, cy)])
+            return r
+        else:
+            msg = "No predictions supplied to ceph.insert_predictions... skipping save"
+            logger.warn(msg)
+            return msg
+
+    def _insert_compact_predictions(self, predictions):
+        predictions = columnar.prediction_table(list(predictions))
+
+        if columnar.length(predictions) == 0:
+            msg = "No predictions supplied to ceph.insert_predictions... skipping save"
+            logger.warn(msg)
+            return msg
+
+        cx = int(first(predictions['cx']))
+        cy = int(first(predictions['cy']))
+        r  = self._put_bin(self._compact_prediction_key(cx, cy),
+                           encoding.encode_predictions(predictions,
+                                                       quantization=self.prediction_quantization,
+                                                       top_k=self.prediction_top_k),
+                           compress=True)
+        self._remove_stale([self._prediction_key(cx, cy)])
+        return r
+
+    def delete_tile(self, tx, ty):
+        return self._delete_many([self._binary_tile_key(tx=tx, ty=ty),
+                                  self._tile_metadata_key(tx=tx, ty=ty),
+                                  self._tile_key(tx=tx, ty=ty)])
+    
+    def delete_chip(self, cx, cy):
+        return self._delete(self._chip_key(cx=cx, cy=cy))
+
+    def delete_pixels(self, cx, cy):
+        return self._delete_many([self._packed_pixel_key(cx=cx, cy=cy),
+                                  self._pixel_key(cx=cx, cy=cy)])
+
+    def delete_segments(self, cx, cy):
+        return self._delete_many([self._columnar_segment_key(cx=cx, cy=cy),
+                                  self._segment_key(cx=cx, cy=cy)])
+
+    def delete_predictions(self, cx, cy):
+        return self._delete_many([self._compact_prediction_key(cx=cx, cy=cy),
+                                  self._prediction_key(cx=cx, cy=cy)])
+
+    def convert_segments(self, remove=False):
+        '''Rewrite every JSON segment object in the bucket in the columnar
+           format.  JSON objects are deleted after conversion if remove=True.
+           Returns the number of chips converted.'''
+
+        converted = 0
+        
+        for key in self._keys(prefix='segment/'):
+            if not key.endswith('.json'):
+                continue
+
+            segments = columnar.segment_table(self._get_json(key))
+
+            if columnar.length(segments) > 0:
+                cx = int(first(segments['cx']))
+                cy = int(first(segments['cy']))
+                
+                self._put_bin(self._columnar_segment_key(cx, cy),
+                              encoding.encode_segments(segments, codec=self.segment_compression),
+                              compress=self.segment_compression is None)
+                converted += 1
+
+                logger.info("converted {} to {}".format(key, self._columnar_segment_key(cx, cy)))
+
+                if remove:
+                    self._delete(key)
+
+        return converted
+
+    def remove_other_formats(self):
+        '''Delete every tile, pixel, segment and prediction object that is
+           also saved in its configured format.  Returns the number of
+           objects deleted.'''
+
+        formats = [('tile/', '.bin' if self.tile_format == 'binary' else '.json'),
+                   ('pixel/', '.bin' if self.pixel_format == 'packed' else '.json'),
+                   ('segment/', '.bin' if self.segment_format == 'columnar' else '.json'),
+                   ('prediction/', '.bin' if self.prediction_format == 'compact' else '.json')]
+        removed = 0
+
+        for prefix, current in formats:
+            other = '.json' if current == '.bin' else '.bin'
+            keys  = set(k for k in self._keys(prefix=prefix) if not k.endswith('.meta.json'))
+            stale = sorted(k for k in keys if k.endswith(other) and k[:-len(other)] + current in keys)
+
+            self._delete_many(stale)
+            removed += len(stale)
+
+            for key in stale:
+                logger.info("removed {}".format(key))
+
+        return removed
+
+    def _delete_many(self, keys):
+        for key in keys:
+            self._delete(key)
+
+    @contextmanager
+    def batch(self):
+        '''Remove the other format copies replaced by inserts in the block
+           with one _delete_many as it exits, instead of one per insert'''
+
+        if getattr(self._batch, 'stale', None) is not None:
+            yield self
+            return
+
+        self._batch.stale = []
+
+        try:
+            yield self
+        finally:
+            stale, self._batch.stale = self._batch.stale, None
+
+            if stale:
+                self._delete_many(stale)
+
+    def _remove_stale(self, keys):
+        '''Remove copies of a just written object saved in other formats'''
+
+        if not self.format_cleanup:
+            return
+
+        stale = getattr(self._batch, 'stale', None)
+
+        if stale is None:
+            self._delete_many(keys)
+        else:
+            stale.extend(keys)
+
+    def _first_found(self, readers, **kwargs):
+        for reader in readers:
+            try:
+                return reader(**kwargs)
+            except self.not_found:
+                pass
+
+        return []
+
+    def _load(self, key, etag=None):
+        '''Read key, through the cache if there is one.  A known etag is
+           used as the object's current ETag instead of looking it up.'''
+
+        if self.cache is None:
+            return first(self._fetch(key))
+        elif etag is None:
+            return self.cache.read(key, etag=self._etag, fetch=self._fetch)
+        else:
+            return self.cache.read(key, etag=lambda k: etag, fetch=self._fetch)
+        
+    def _get_bin(self, key, etag=None):
+        return self._load(key, etag=etag)
+
+    def _get_json(self, key, etag=None):
+        return json.loads(bytes(self._load(key, etag=etag)).decode('utf-8'))
+                            
+    def _tile_key(self, tx, ty):
+        return 'tile/{tx}-{ty}.json'.format(tx=tx, ty=ty)
+
+    def _binary_tile_key(self, tx, ty):
+        return 'tile/{tx}-{ty}.bin'.format(tx=tx, ty=ty)
+
+    def _tile_metadata_key(self, tx, ty):
+        return 'tile/{tx}-{ty}.meta.json'.format(tx=tx, ty=ty)
+
+    def _chip_key(self, cx, cy):
+        return 'chip/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+
+    def _pixel_key(self, cx, cy):
+        return 'pixel/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+
+    def _packed_pixel_key(self, cx, cy):
+        return 'pixel/{cx}-{cy}.bin'.format(cx=cx, cy=cy)
+
+    def _segment_key(self, cx, cy):
+        return 'segment/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+
+    def _columnar_segment_key(self, cx, cy):
+        return 'segment/{cx}-{cy}.bin'.format(cx=cx, cy=cy)
+
+    def _prediction_key(self, cx, cy):
+        return 'prediction/{cx}-{cy}.json'.format(cx=cx, cy=cy)
+
+    def _compact_prediction_key(self, cx, cy):
+        return 'prediction/{cx}-{cy}.bin'.format(cx=cx, cy=cy)
+
+
+
+@retry(stop=stop_after_attempt(20),
+       reraise=True,
+       wait=wait_exponential(multiplier=1, min=2, max=5))
+def _select_segments(storage, cx, cy, table):
+    logger.info("getting segments for cx:{} cy:{}".format(cx, cy))
+    return storage.select_segments(cx, cy, table=table)
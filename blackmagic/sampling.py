@@ -0,0 +1,165 @@
+'''
+sampling.py draws class balanced training samples from a stream of
+training data without holding all of it in memory.
+
+Training rows arrive a chip at a time as float32 arrays whose first
+column is the class label.  Each row is given a random key and, for each
+class, Reservoirs keeps the capacity rows with the smallest keys along
+with how many rows of each class were seen, which is all /tile needs to
+level the classes.  Ordering rows by random keys is a random permutation,
+so the rows kept are a uniform sample of the class.
+
+Keys derived from a seed and the chip (see keys()) make the sample
+depend only on the data, not on the order chips arrive in, so seeded
+runs are reproducible.
+
+Given a directory, rows are kept in memory-mapped files there instead of
+in memory, so tiles may be sampled that are larger than RAM.
+'''
+
+import numpy
+import os
+
+
+def capacity(target_samples, class_max, class_min):
+    '''The most rows of any one class that /tile can select.
+
+       Each class is targeted at its share of target_samples, then
+       limited to class_max and raised to class_min.
+    '''
+
+    return int(max(min(target_samples, class_max), class_min))
+
+
+def keys(n, seed, cx, cy):
+    '''n random sort keys for a chip's rows, the same for every run with seed'''
+
+    return numpy.random.RandomState([seed % 2 ** 32, cx % 2 ** 32, cy % 2 ** 32]).random_sample(n)
+
+
+class Reservoirs(object):
+    '''Uniform random samples of up to capacity rows for each class'''
+
+    def __init__(self, capacity, random_state=None, directory=None):
+        self.capacity = capacity
+        self.random = numpy.random.RandomState(random_state)
+        self.directory = directory
+        self.counts = {}
+        self.sizes = {}
+        self.rows = {}
+        self.keys = {}
+
+    def add(self, rows, keys=None):
+        '''Add a [rows, columns] array labeled by its first column.
+           keys defaults to random keys.'''
+
+        rows = numpy.asarray(rows, dtype=numpy.float32)
+
+        if rows.ndim != 2 or len(rows) == 0:
+            return
+
+        if keys is None:
+            keys = self.random.random_sample(len(rows))
+
+        # group rows by label with one stable sort
+        labels = rows[:, 0]
+        order  = numpy.argsort(labels, kind='stable')
+        values, starts, counts = numpy.unique(labels[order], return_index=True, return_counts=True)
+
+        for label, start, count in zip(values.tolist(), starts, counts):
+            i = order[start:start + count]
+            self._add(label, rows[i], keys[i])
+
+    def _add(self, label, rows, keys):
+        size = self.sizes.get(label, 0)
+        r    = self.rows.get(label, numpy.empty((0, rows.shape[1]), dtype=numpy.float32))
+        k    = self.keys.get(label, numpy.empty(0, dtype=numpy.float64))
+
+        # fill the reservoir
+        n = min(self.capacity - size, len(rows))
+
+        if n > 0:
+            r, k = self._grow(label, r, k, size + n)
+            r[size:size + n] = rows[:n]
+            k[size:size + n] = keys[:n]
+            size += n
+
+        # then keep the capacity smallest keys of the reservoir & the rest
+        rest, rest_keys = rows[n:], keys[n:]
+
+        if len(rest) > 0:
+            keep = numpy.argpartition(numpy.concatenate([k[:size], rest_keys]), size - 1)[:size]
+            into = numpy.setdiff1d(numpy.arange(size), keep[keep < size], assume_unique=True)
+            come = keep[keep >= size] - size
+
+            r[into] = rest[come]
+            k[into] = rest_keys[come]
+
+        self.rows[label]   = r
+        self.keys[label]   = k
+        self.sizes[label]  = size
+        self.counts[label] = self.counts.get(label, 0) + len(rows)
+
+    def _allocate(self, name, shape):
+        '''An empty float32 array, memory-mapped under directory if set'''
+
+        if self.directory is None:
+            return numpy.empty(shape, dtype=numpy.float32)
+
+        return numpy.memmap(os.path.join(self.directory, name), dtype=numpy.float32, mode='w+', shape=shape)
+
+    def _grow(self, label, rows, keys, size):
+        '''Reallocate rows & keys to hold at least size rows, doubling up
+           to capacity so repeated small chunks are not copied each time.
+           Files are sparse, so on disk rows go straight to capacity.'''
+
+        if len(rows) >= size:
+            return rows, keys
+
+        n = self.capacity if self.directory else min(max(size, 2 * len(rows)), self.capacity)
+        r = self._allocate('rows-{:g}.f32'.format(label), (n, rows.shape[1]))
+        k = numpy.empty(n, dtype=keys.dtype)
+        r[:len(rows)] = rows
+        k[:len(keys)] = keys
+
+        return r, k
+
+    def statistics(self):
+        '''Return (labels, percent), the sorted labels seen and the
+           fraction of all rows seen that had each label'''
+
+        labels = numpy.array(sorted(self.counts), dtype=numpy.float32)
+        counts = numpy.array([self.counts[l.item()] for l in labels], dtype=numpy.float64)
+
+        if len(counts) > 0:
+            counts = counts / numpy.sum(counts)
+
+        return labels, counts
+
+    def sample(self, labels, counts):
+        '''Return up to counts[i] rows labeled labels[i] as one array,
+           grouped by label and ordered by key.  Each class is a uniform
+           random sample of every row seen with that label.  The sample
+           is memory-mapped under directory if set.'''
+
+        labels = [l.item() if hasattr(l, 'item') else l for l in labels]
+        quotas = [min(int(c), self.sizes.get(l, 0)) for l, c in zip(labels, counts)]
+        total  = sum(quotas)
+
+        if total == 0:
+            return numpy.empty((0, 0), dtype=numpy.float32)
+
+        width  = self.rows[labels[numpy.flatnonzero(quotas)[0]]].shape[1]
+        sample = self._allocate('sample.f32', (total, width))
+        start  = 0
+
+        # gather each row once, straight into the sample
+        for label, quota in zip(labels, quotas):
+            if quota > 0:
+                k = self.keys[label][:self.sizes[label]]
+                i = numpy.argpartition(k, quota - 1)[:quota] if quota < len(k) else numpy.arange(len(k))
+                numpy.take(self.rows[label], i[numpy.argsort(k[i], kind='stable')], axis=0,
+                           out=sample[start:start + quota], mode='clip')
+                start += quota
+
+        return sample
@@ -10,6 +10,7 @@ Segaux functions should remain non-complected and composed
 into functions in the module or namespace where they are used.
 '''
 
+from blackmagic import columnar
 from cytoolz import assoc
 from cytoolz import dissoc
 from cytoolz import filter
@@ -35,8 +36,6 @@ import arrow
 import logging
 import merlin
 import numpy
-import os
-import tempfile
 import xgboost as xgb
 
 
@@ -55,16 +54,11 @@ def independent(data):
     '''Independent variable is (are) all the values except the labels.
         data: 2d numpy array
         return: 2d numpy array minus the labels (first element of every row)
-    '''
-
-    # Remove the first element from every array no matter the dimensions.
-    # Returns data in same shape as provided. Is this really what we want?
-    d = numpy.delete(data, 0, data.ndim - 1)
 
-    data = None
-    del data
+       Returns a view of data, not a copy.
+    '''
 
-    return d
+    return data[..., 1:]
 
 
 def dependent(data):
@@ -73,14 +67,7 @@ def dependent(data):
        return: 1d numpy array of labels
     '''
 
-    d = numpy.delete(data,
-                     numpy.s_[1:],
-                     data.ndim - 1).flatten().astype('int8')
-
-    data = None
-    del data
-
-    return d
+    return numpy.atleast_1d(data[..., 0]).astype('int8')
 
 
 @retry(stop=stop_after_attempt(20),
@@ -146,21 +133,67 @@ def default_prediction_date(s):
         return None
 
     
-def prediction_dates(segments, month, day):
+def prediction_ordinals(sday, eday, dates):
+    '''Array version of prediction_date_fn for many segments & dates.
+
+       sday and eday are arrays of segment start & end ordinal days.
+       Returns (index, ordinals): the segment index & ordinal day of every
+       prediction, ordered by segment, then dates, then year.  Default
+       segments (both days ordinal 1) get one prediction on ordinal 1.
+       Dates that do not exist in a year, such as 02-29, are skipped.
+    '''
+
+    sday = numpy.asarray(sday, dtype=numpy.int64)
+    eday = numpy.asarray(eday, dtype=numpy.int64)
+    dflt = (sday == 1) & (eday == 1)
+
+    # years since 1970, as numpy counts datetime64[Y]
+    year = lambda o: (o - columnar.EPOCH).astype('datetime64[D]').astype('datetime64[Y]').astype(numpy.int64)
+
+    if numpy.all(dflt):
+        years = numpy.array([], dtype=numpy.int64)
+    else:
+        years = numpy.arange(year(sday[~dflt].min()), year(eday[~dflt].max()) + 1)
+
+    candidates = [numpy.ones(1, dtype=numpy.int64)]
+
+    for m, d in dates:
+        months = years.astype('datetime64[Y]').astype('datetime64[M]') + (int(m) - 1)
+        days   = months.astype('datetime64[D]') + (int(d) - 1)
+        days   = days[days.astype('datetime64[M]') == months]
+        candidates.append(days.astype(numpy.int64) + columnar.EPOCH)
+
+    candidates = numpy.concatenate(candidates)
+
+    # [segments, candidates], the first candidate is the default date
+    inside = (candidates >= sday[:, None]) & (candidates <= eday[:, None])
+    inside[:, 0] = dflt
+    inside[dflt, 1:] = False
+
+    index, column = numpy.nonzero(inside)
+
+    return index, candidates[column]
+
+
+def prediction_dates(segments, month=None, day=None, dates=None):
+    '''Yield a copy of each segment for every prediction date it spans.
+
+       Prediction dates fall on month & day of each year or, if dates is
+       supplied, on every (month, day) pair in it.
+    '''
+
+    dates    = dates if dates else [(month, day)]
+    segments = list(segments)
+
+    if len(segments) == 0:
+        return
     
-    for s in segments:
-        default_date = default_prediction_date(s)
-
-        if default_date:
-            yield assoc(s, 'date', default_date)
-        else:
-            dates = prediction_date_fn(sday=get('sday', s),
-                                       eday=get('eday', s),
-                                       month=month,
-                                       day=day)
-                
-            for date in dates:
-                yield assoc(s, 'date', date)
+    index, days = prediction_ordinals(columnar.ordinals([get('sday', s) for s in segments]),
+                                      columnar.ordinals([get('eday', s) for s in segments]),
+                                      dates)
+
+    for i, date in zip(index.tolist(), columnar.isoformat(days)):
+        yield assoc(segments[i], 'date', date)
 
                       
 def training_date(data, date):
@@ -204,9 +237,35 @@ def average_reflectance_fn(segment):
     return merge(segment, ar)
 
 
+def average_reflectances(intercepts, slopes, ordinals):
+    '''Average reflectance for [rows, bands] intercepts & slopes on
+       each row's ordinal day'''
+
+    return intercepts + slopes * numpy.asarray(ordinals)[:, None]
+
+
 def average_reflectance(segments):
+    '''Add average reflectance values into dataset, computing every row
+       and band at once rather than per segment'''
+
+    segments = list(segments)
+
+    if len(segments) == 0:
+        return []
     
-    return map(average_reflectance_fn, segments)
+    intercepts = numpy.array([[get(p + 'int', s) for p in columnar.PREFIXES] for s in segments],
+                             dtype=numpy.float64)
+    
+    slopes = numpy.array([[spectral_slope(p + 'coef', s) for p in columnar.PREFIXES] for s in segments],
+                         dtype=numpy.float64)
+
+    ar = average_reflectances(intercepts,
+                              slopes,
+                              columnar.ordinals([get('date', s) for s in segments]))
+
+    names = [p + 'ar' for p in columnar.PREFIXES]
+    
+    return [merge(s, dict(zip(names, r))) for s, r in zip(segments, ar.tolist())]
 
 
 def unload_segments(ctx):
@@ -245,6 +304,12 @@ def to_numpy(data):
     return numpy.array(data, dtype=numpy.float32)
 
 
+# Version of the variable layout produced by standard_format.
+# Increment it whenever standard_format changes so models trained
+# on an older layout are not used for prediction.
+FEATURE_LAYOUT = 1
+
+
 def standard_format(segmap):
     return list(flatten([get('nlcdtrn', segmap),
                          get('aspect' , segmap),
@@ -297,31 +362,157 @@ def prediction_format(segment):
             'pday': get('date', segment),
             'independent': independent(to_numpy(standard_format(segment)))}
 
+
+# Aux variables and band prefixes in standard_format order
+AUX = ('nlcdtrn', 'aspect', 'posidex', 'slope', 'mpw', 'dem')
+
+FORMAT_PREFIXES = ('bl', 'gr', 'ni', 're', 's1', 's2', 'th')
+
+
+def prediction_matrix(segments, dates):
+    '''Build independent variables for every prediction date of segments.
+
+       Equivalent to prediction_dates, average_reflectance and
+       prediction_format but works on columns: each segment & aux value is
+       read once and every prediction row is written into one preallocated
+       float32 matrix.  Segments must not be defaults.
+
+       Returns (rows, matrix) where rows is a dict of cx, cy, px, py, sday,
+       eday and pday arrays (days as ordinals) parallel to matrix's rows.
+    '''
+
+    segments = list(segments)
+    n        = len(segments)
+    column   = lambda k, dtype=None: numpy.array([get(k, s) for s in segments], dtype=dtype)
+
+    sday = columnar.ordinals(column('sday')) if n else numpy.array([], dtype=numpy.int64)
+    eday = columnar.ordinals(column('eday')) if n else numpy.array([], dtype=numpy.int64)
+
+    index, pday = prediction_ordinals(sday, eday, dates)
+
+    rows = {'cx':   column('cx', numpy.int64)[index],
+            'cy':   column('cy', numpy.int64)[index],
+            'px':   column('px', numpy.int64)[index],
+            'py':   column('py', numpy.int64)[index],
+            'sday': sday[index],
+            'eday': eday[index],
+            'pday': pday}
+
+    if n == 0:
+        return rows, numpy.empty((0, 0), dtype=numpy.float32)
+
+    # the first aux value is the label
+    aux   = numpy.hstack([column(a, numpy.float32).reshape(n, -1) for a in AUX])[:, 1:]
+    coefs = [column(p + 'coef', numpy.float64).reshape(n, -1) for p in FORMAT_PREFIXES]
+    rmse  = [column(p + 'rmse', numpy.float32) for p in FORMAT_PREFIXES]
+
+    ar = average_reflectances(numpy.stack([column(p + 'int', numpy.float64) for p in FORMAT_PREFIXES], axis=1)[index],
+                              numpy.stack([c[:, 0] for c in coefs], axis=1)[index],
+                              pday)
+
+    width  = aux.shape[1] + sum(c.shape[1] + 2 for c in coefs)
+    matrix = numpy.empty((len(index), width), dtype=numpy.float32)
+
+    matrix[:, :aux.shape[1]] = aux[index]
+    i = aux.shape[1]
+
+    for b in range(len(FORMAT_PREFIXES)):
+        k = coefs[b].shape[1]
+        matrix[:, i:i + k] = coefs[b][index]
+        matrix[:, i + k]   = rmse[b][index]
+        matrix[:, i + k + 1] = ar[:, b]
+        i += k + 2
+
+    return rows, matrix
+
+
+def predict(booster, matrix, chunk_rows=0):
+    '''Class probabilities for every row of matrix.
+
+       Rows are predicted in place, without building a DMatrix, chunk_rows
+       at a time (all at once if 0) into one preallocated float32 array, so
+       xgboost's working memory does not grow with the size of matrix.
+    '''
+
+    n     = len(matrix)
+    chunk = chunk_rows if chunk_rows > 0 else max(n, 1)
+    probs = None
+
+    for start in range(0, n, chunk):
+        p = booster.inplace_predict(matrix[start:start + chunk])
+
+        if probs is None:
+            probs = numpy.empty((n,) + p.shape[1:], dtype=numpy.float32)
+
+        probs[start:start + len(p)] = p
+
+    return probs if probs is not None else numpy.empty((0,), dtype=numpy.float32)
+
+
+def prediction_records(rows, probs):
+    '''Prediction dicts for rows from prediction_matrix and their probabilities'''
+
+    return [{'cx': cx, 'cy': cy, 'px': px, 'py': py,
+             'sday': sday, 'eday': eday, 'pday': pday, 'prob': prob}
+            for cx, cy, px, py, sday, eday, pday, prob in zip(rows['cx'].tolist(),
+                                                               rows['cy'].tolist(),
+                                                               rows['px'].tolist(),
+                                                               rows['py'].tolist(),
+                                                               columnar.isoformat(rows['sday']),
+                                                               columnar.isoformat(rows['eday']),
+                                                               columnar.isoformat(rows['pday']),
+                                                               probs)]
+
         
 def bytes_from_booster(booster):
-    f = None
-    try:
-        f = tempfile.NamedTemporaryFile(delete=False)
-        booster.save_model(f.name)
+    '''Serialize a booster in memory in xgboost's binary format.  The
+       format is named rather than left to xgboost's default, which
+       changes between versions, and is several times faster to save and
+       load than UBJSON or JSON (bin/benchmark-booster.py).  xgboost warns
+       that it is deprecated on every save, so logging is quieted here.'''
 
-        with open(f.name, 'rb+') as tf:
-            return tf.read()
-        
-    finally:
-        if f:
-            os.remove(f.name)
+    with xgb.config_context(verbosity=0):
+        return bytes(booster.save_raw(raw_format='deprecated'))
 
         
 def booster_from_bytes(booster_bytes, params):
-    f = None
-    try:
-        f = tempfile.NamedTemporaryFile(delete=False)
+    '''Load a booster from bytes in any format xgboost saves (binary,
+       UBJSON or JSON), including models saved to files by earlier
+       versions of blackmagic'''
+
+    with xgb.config_context(verbosity=0):
+        return xgb.Booster(params=params, model_file=bytearray(booster_bytes))
+
+
+class Batches(xgb.DataIter):
+    '''Feeds the independent & dependent rows at indices to xgboost in
+       batches of batch_rows.  A DMatrix built from Batches uses xgboost's
+       external memory: pages are cached in files starting with
+       cache_prefix and only one batch of rows is gathered at a time.'''
+
+    def __init__(self, independent, dependent, indices, batch_rows, cache_prefix):
+        self.independent = independent
+        self.dependent = dependent
+        self.indices = indices
+        self.batch_rows = max(int(batch_rows), 1)
+        self.start = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.start >= len(self.indices):
+            return 0
+
+        i = self.indices[self.start:self.start + self.batch_rows]
+        input_data(data=self.independent[i], label=self.dependent[i])
+        self.start += self.batch_rows
+
+        return 1
+
+    def reset(self):
+        self.start = 0
 
-        with open(f.name, 'wb+') as tf:
-            tf.write(booster_bytes)
 
-        return xgb.Booster(model_file=tf.name, params=params)
+def batch_rows(batch_bytes, independent):
+    '''How many rows of independent fit in batch_bytes'''
 
-    finally:
-        if f:
-            os.remove(f.name)
+    return max(batch_bytes // max(independent.shape[1] * independent.itemsize, 1), 1)
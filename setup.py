@@ -31,7 +31,7 @@ setup(name='lcmap-blackmagic',
           'cython',
           'lcmap-merlin>=2.3.1',
           'lcmap-pyccd==2018.10.17',
-          'xgboost',
+          'xgboost>=1.7,<3.1',
           'flask',
           'gunicorn',
           'tenacity',
@@ -44,6 +44,8 @@ setup(name='lcmap-blackmagic',
       # $ pip install -e .[test]
       extras_require={
           'test': ['pytest'],
+          'zstd': ['zstandard'],
+          'lz4': ['lz4'],
           'dev': ['',],
       },
       #test_suite='nose.collector',
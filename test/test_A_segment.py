@@ -1,12 +1,20 @@
 from blackmagic import app
+from blackmagic import columnar
+from blackmagic import workers
+from blackmagic.blueprints import segment
 from blackmagic.data import ceph
 from cytoolz import do
 from cytoolz import get
 from cytoolz import reduce
+from cytoolz import take
 
 import json
+import multiprocessing
+import numpy
 import os
 import pytest
+import shutil
+import tempfile
 import test
 
 _ceph = ceph.Ceph(app.cfg)
@@ -230,3 +238,90 @@ def test_segment_save_exception(client):
     assert len(list(map(lambda x: x, chips))) == 0
     assert len(list(map(lambda x: x, pixels))) == 0
     assert len(list(map(lambda x: x, segments))) == 0
+
+
+def test_share():
+
+    timeseries = [((1, 2, 3, 4), {'dates':    [10, 11, 12],
+                                  'blues':    numpy.array([1, 2, 3], dtype=numpy.int16),
+                                  'greens':   numpy.array([4, 5, 6], dtype=numpy.int16),
+                                  'reds':     numpy.array([7, 8, 9], dtype=numpy.int16),
+                                  'nirs':     numpy.array([1, 1, 1], dtype=numpy.int16),
+                                  'swir1s':   numpy.array([2, 2, 2], dtype=numpy.int16),
+                                  'swir2s':   numpy.array([3, 3, 3], dtype=numpy.int16),
+                                  'thermals': numpy.array([4, 4, 4], dtype=numpy.int16),
+                                  'qas':      numpy.array([66, 66, 322], dtype=numpy.uint16)}),
+                  ((1, 2, 5, 6), {'dates':    [10, 11, 12],
+                                  'blues':    numpy.array([9, 9, 9], dtype=numpy.int16),
+                                  'greens':   numpy.array([8, 8, 8], dtype=numpy.int16),
+                                  'reds':     numpy.array([7, 7, 7], dtype=numpy.int16),
+                                  'nirs':     numpy.array([6, 6, 6], dtype=numpy.int16),
+                                  'swir1s':   numpy.array([5, 5, 5], dtype=numpy.int16),
+                                  'swir2s':   numpy.array([4, 4, 4], dtype=numpy.int16),
+                                  'thermals': numpy.array([3, 3, 3], dtype=numpy.int16),
+                                  'qas':      numpy.array([2, 2, 2], dtype=numpy.uint16)})]
+
+    path = segment.share(timeseries)
+
+    try:
+        a = segment.shared(path)
+
+        assert numpy.array_equal(a['keys'], [[1, 2, 3, 4], [1, 2, 5, 6]])
+        assert numpy.array_equal(a['dates'], [10, 11, 12])
+        assert a['spectra'].shape == (2, 7, 3)
+        assert numpy.array_equal(a['spectra'][1, 0], [9, 9, 9])
+        assert numpy.array_equal(a['spectra'][0, 6], [4, 4, 4])
+        assert numpy.array_equal(a['qas'][0], [66, 66, 322])
+    finally:
+        shutil.rmtree(path)
+
+
+def test_blocks():
+    assert segment.blocks(5, 2) == [range(0, 2), range(2, 4), range(4, 5)]
+    assert segment.blocks(0, 2) == []
+
+
+@pytest.fixture(scope='module')
+def pixels():
+    ctx = segment.timeseries({'cx': test.cx, 'cy': test.cy, 'acquired': test.acquired}, app.cfg)
+
+    return list(take(6, ctx['timeseries']))
+
+
+def failing_detect(timeseries):
+    raise Exception('detection failed')
+
+
+def test_shared_detection(pixels):
+    cfg = dict(app.cfg, shared_timeseries_dir=tempfile.mkdtemp())
+
+    with workers(cfg) as w:
+        expected = segment.tables(w.map(segment.detect, pixels))
+        outputs  = segment.tables(segment.shared_detection(w, pixels, cfg))
+
+        assert columnar.length(outputs['pixels']) == len(pixels)
+        assert columnar.length(outputs['segments']) > 0
+        assert sorted(outputs) == sorted(expected)
+
+        for t in ('segments', 'pixels'):
+            assert sorted(outputs[t]) == sorted(expected[t])
+
+            for c in expected[t]:
+                numpy.testing.assert_equal(outputs[t][c], expected[t][c])
+
+    assert os.listdir(cfg['shared_timeseries_dir']) == []
+    os.rmdir(cfg['shared_timeseries_dir'])
+
+
+def test_shared_detection_exception(pixels, monkeypatch):
+    monkeypatch.setattr(segment, 'detect', failing_detect)
+
+    with tempfile.TemporaryDirectory() as d:
+        cfg = dict(app.cfg, shared_timeseries_dir=d, cpus_per_worker=2)
+
+        # workers forked after the patch fail in detect_shared
+        with multiprocessing.Pool(2) as w:
+            with pytest.raises(Exception, match='detection failed'):
+                segment.shared_detection(w, pixels, cfg)
+
+        assert os.listdir(d) == []
@@ -1,4 +1,5 @@
 from blackmagic import app
+from blackmagic import sampling
 from blackmagic.blueprints import tile
 from blackmagic.data import ceph
 from collections import namedtuple
@@ -13,7 +14,9 @@ import os
 import pytest
 import numpy
 import requests
+import tempfile
 import test
+import xgboost as xgb
 
 _ceph = ceph.Ceph(app.cfg)
 _ceph.start()
@@ -216,6 +219,33 @@ def test_tile_save_exception(client):
     assert len(list(map(lambda x: x, tiles))) == 0
 
     
+def test_tile_parameters_normalize_date():
+    ctx = tile.parameters({'tx': '1', 'ty': '2', 'acquired': test.acquired, 'chips': [[3, 4]],
+                           'date': '2001/07/01'})
+
+    assert ctx['date'] == '2001-07-01'
+    assert ctx['chips'] == [(3, 4)]
+
+
+def test_tile_non_iso_date(client):
+    assert client.post('/segment',
+                       json={'cx': test.cx,
+                             'cy': test.cy,
+                             'acquired': test.acquired}).status == '200 OK'
+
+    response = client.post('/tile',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'acquired': test.acquired,
+                                 'chips': test.chips,
+                                 'date': test.training_date.replace('-', '/')})
+
+    assert response.status == '200 OK'
+    assert get('exception', response.get_json(), None) == None
+    assert get('date', response.get_json()) == test.training_date
+    assert _ceph.select_model(test.tx, test.ty)['metadata']['date'] == test.training_date
+
+
 def test_segments_filter():
     
     inputs = {'date': '1980-01-01',
@@ -231,49 +261,135 @@ def test_segments_filter():
 
     
 def test_tile_statistics():
-    ctx = {'data': numpy.array([[0, 1, 2],
+    reservoirs = sampling.Reservoirs(100)
+
+    reservoirs.add(numpy.array([[0, 1, 2],
                                 [0, 2, 3],
                                 [1, 1, 2],
                                 [1, 1, 1],
-                                [1, 1, 1],
-                                [2, 2, 2],
+                                [1, 1, 1]]))
+    reservoirs.add(numpy.array([[2, 2, 2],
                                 [2, 2, 2],
                                 [2, 3, 4],
                                 [2, 4, 5],
-                                [2, 6, 7]])}
+                                [2, 6, 7]]))
 
-    stats = get('statistics', tile.statistics(ctx))
+    stats = get('statistics', tile.statistics({'reservoirs': reservoirs}))
 
     assert numpy.array_equal(stats[0], numpy.array([0, 1, 2]))
     assert numpy.array_equal(stats[1], numpy.array([0.20, 0.30, 0.50]))
            
 
 def test_tile_randomize():
-    pass
+    data = numpy.arange(20).reshape(10, 2)
+    ctx  = tile.randomize({'data': data}, {})
+
+    assert sorted(ctx['indices'].tolist()) == list(range(10))
+    assert ctx['data'] is data
+
+
+def test_tile_train_test_indices():
+    itrain, itest = tile.train_test_indices(numpy.array([9, 3, 5, 0, 1, 8, 2, 7, 6, 4]), 0.2)
+
+    assert itrain.tolist() == [0, 1, 2, 3, 5, 7, 8, 9]
+    assert itest.tolist() == [4, 6]
 
 
 def test_tile_sample():
+
+    reservoirs = sampling.Reservoirs(3)
+    reservoirs.add(numpy.array([[0, 0, 1],
+                                [1, 4, 4],
+                                [0, 2, 3],
+                                [2, 4, 5],
+                                [0, 6, 7],
+                                [2, 8, 9],
+                                [0, 9, 10]]))
     
-    ctx = {'independent': numpy.array([[0, 1],
-                                       [4, 4],
-                                       [2, 3],
-                                       [4, 5],
-                                       [6, 7],
-                                       [8, 9],
-                                       [9, 10]]),
-           'dependent': numpy.array([0, 1, 0, 2, 0, 2, 0]),
+    ctx = {'reservoirs': reservoirs,
            'statistics': (numpy.array([0,1,2]),
                           numpy.array([0.5714, 0.1428, 0.2857]))}
 
     cfg = {'xgboost': {'target_samples': 50, 'class_min': 2, 'class_max': 3}}
            
     s = tile.sample(ctx, cfg)
-    i = s['independent']
-    d = s['dependent']
+    d = s['data'][:, 0]
 
     assert numpy.array_equal(d, [0, 0, 0, 1, 2, 2])    
+    assert 'reservoirs' not in s
 
     
+def test_tile_matrix():
+    independent = numpy.arange(60, dtype=numpy.float32).reshape(20, 3)
+    dependent   = numpy.arange(20, dtype=numpy.int8) % 3
+    indices     = numpy.array([1, 4, 5, 9, 10, 11, 18])
+    cfg         = {'xgboost': {'external_memory_bytes': 24}}
+    ctx         = {'independent': independent, 'dependent': dependent}
+
+    memory = tile.matrix(ctx, indices, 'train', cfg)
+
+    with tempfile.TemporaryDirectory() as d:
+        workdir = namedtuple('Workdir', ['name'])(d)
+        disk    = tile.matrix(dict(ctx, workdir=workdir), indices, 'train', cfg)
+
+        assert disk.num_row() == memory.num_row() == 7
+        assert disk.num_col() == 3
+        assert numpy.array_equal(disk.get_label(), memory.get_label())
+        assert any(f.startswith('train') for f in os.listdir(d))
+
+
+def test_tile_external_memory(client, monkeypatch):
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setitem(tile.cfg['xgboost'], 'external_memory', True)
+        monkeypatch.setitem(tile.cfg['xgboost'], 'external_memory_dir', d)
+
+        assert client.post('/segment',
+                           json={'cx': test.cx,
+                                 'cy': test.cy,
+                                 'acquired': test.acquired}).status == '200 OK'
+
+        response = client.post('/tile',
+                               json={'tx': test.tx,
+                                     'ty': test.ty,
+                                     'acquired': test.acquired,
+                                     'chips': test.chips,
+                                     'date': test.training_date})
+
+        assert response.status == '200 OK'
+        assert get('exception', response.get_json(), None) == None
+        assert len(_ceph.select_tile(tx=test.tx, ty=test.ty)) == 1
+        assert os.listdir(d) == []
+
+
+def failing_pipeline(*args, **kwargs):
+    raise Exception('pipeline should not run')
+
+
+def test_tile_training_row_cache(client, monkeypatch):
+    assert client.post('/segment',
+                       json={'cx': test.cx,
+                             'cy': test.cy,
+                             'acquired': test.acquired}).status == '200 OK'
+
+    request = {'tx': test.tx,
+               'ty': test.ty,
+               'acquired': test.acquired,
+               'chips': test.chips,
+               'date': test.training_date}
+
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setitem(tile.cfg, 'training_cache_dir', d)
+
+        assert client.post('/tile', json=request).status == '200 OK'
+        assert len(os.listdir(d)) == 1
+
+        monkeypatch.setattr(tile, 'pipeline', failing_pipeline)
+
+        # cached rows are used for the same chips, acquired & date
+        assert client.post('/tile', json=request).status == '200 OK'
+        assert client.post('/tile', json=dict(request, date='0002-01-01')).status == '500 INTERNAL SERVER ERROR'
+
+
 def test_tile_train():
     pass
 
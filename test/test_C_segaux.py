@@ -6,7 +6,11 @@ from cytoolz import get
 
 import blackmagic
 import numpy
+import os
+import tempfile
 import test
+import warnings
+import xgboost as xgb
 
 
 def test_independent_2d():
@@ -19,6 +23,7 @@ def test_independent_2d():
     outputs = segaux.independent(inputs)
     
     assert numpy.array_equal(expected, outputs)
+    assert numpy.shares_memory(inputs, outputs)
 
     
 def test_independent_1d():
@@ -252,6 +257,31 @@ def test_prediction_dates():
     assert expected == outputs
 
 
+def test_prediction_dates_many():
+    inputs = {'segments' : [{'sday': '1980-01-01',
+                             'eday': '1981-06-01'},
+                            {'sday': '0001-01-01',
+                             'eday': '0001-01-01'}],
+              'dates': [['07', '01'], ['01', '15']]}
+
+    expected = [{'sday': '1980-01-01',
+                 'eday': '1981-06-01',
+                 'date': '1980-07-01'},
+                {'sday': '1980-01-01',
+                 'eday': '1981-06-01',
+                 'date': '1980-01-15'},
+                {'sday': '1980-01-01',
+                 'eday': '1981-06-01',
+                 'date': '1981-01-15'},
+                {'sday': '0001-01-01',
+                 'eday': '0001-01-01',
+                 'date': '0001-01-01'}]
+               
+    outputs = list(segaux.prediction_dates(**inputs))
+
+    assert expected == outputs
+
+
 def test_training_date():
     inputs = {'date': '1980-01-01',
               'data': {'a': 1}}
@@ -620,3 +650,124 @@ def test_prediction_format():
     outputs.pop('independent')
 
     assert expected == outputs
+
+
+def booster():
+    data = numpy.random.rand(90, 5).astype(numpy.float32)
+    labels = numpy.arange(90) % 9
+
+    return xgb.train(params={'objective': 'multi:softprob', 'num_class': 9},
+                     dtrain=xgb.DMatrix(data, label=labels),
+                     num_boost_round=3), data
+
+
+def test_booster_bytes():
+    model, data = booster()
+
+    b = segaux.bytes_from_booster(model)
+    
+    assert isinstance(b, bytes)
+
+    loaded = segaux.booster_from_bytes(b, {'nthread': 1})
+
+    assert numpy.allclose(model.predict(xgb.DMatrix(data)),
+                          loaded.predict(xgb.DMatrix(data)))
+
+
+def test_booster_bytes_format():
+    '''Models are saved in the binary format without xgboost warnings'''
+
+    model, data = booster()
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        b = segaux.bytes_from_booster(model)
+        segaux.booster_from_bytes(b, {'nthread': 1})
+
+    assert w == []
+
+    with xgb.config_context(verbosity=0):
+        assert b == bytes(model.save_raw(raw_format='deprecated'))
+
+    # models saved in other formats remain loadable
+    for f in ('ubj', 'json'):
+        loaded = segaux.booster_from_bytes(bytes(model.save_raw(raw_format=f)), {'nthread': 1})
+
+        assert numpy.allclose(model.predict(xgb.DMatrix(data)),
+                              loaded.predict(xgb.DMatrix(data)))
+
+
+def test_booster_from_file_bytes():
+    '''Models saved to files by earlier versions remain loadable'''
+
+    model, data = booster()
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'model')
+        model.save_model(path)
+
+        with open(path, 'rb') as f:
+            loaded = segaux.booster_from_bytes(f.read(), {'nthread': 1})
+
+    assert numpy.allclose(model.predict(xgb.DMatrix(data)),
+                          loaded.predict(xgb.DMatrix(data)))
+
+
+def test_prediction_ordinals():
+    sday = segaux.columnar.ordinals(['1980-01-01', '0001-01-01', '1983-03-01', '1999-12-31'])
+    eday = segaux.columnar.ordinals(['1986-06-01', '0001-01-01', '1985-02-28', '2000-12-31'])
+
+    index, ordinals = segaux.prediction_ordinals(sday, eday, [['07', '01'], ['02', '29']])
+
+    expected = [(0, '1980-07-01'), (0, '1981-07-01'), (0, '1982-07-01'),
+                (0, '1983-07-01'), (0, '1984-07-01'), (0, '1985-07-01'),
+                (0, '1980-02-29'), (0, '1984-02-29'),
+                (1, '0001-01-01'),
+                (2, '1983-07-01'), (2, '1984-07-01'), (2, '1984-02-29'),
+                (3, '2000-07-01'), (3, '2000-02-29')]
+
+    assert list(zip(index.tolist(), segaux.columnar.isoformat(ordinals))) == expected
+
+
+def test_average_reflectances():
+    intercepts = numpy.array([[2.0] * 7, [1.0] * 7])
+    slopes     = numpy.array([[0.1] * 7, [0.0] * 7])
+    ordinals   = segaux.columnar.ordinals(['1980-01-01', '0001-01-01'])
+
+    outputs = segaux.average_reflectances(intercepts, slopes, ordinals)
+
+    assert outputs.shape == (2, 7)
+    assert outputs[0].tolist() == [72283.5] * 7
+    assert outputs[1].tolist() == [1.0] * 7
+
+
+def test_prediction_records():
+    rows = {'cx': numpy.array([1]), 'cy': numpy.array([2]),
+            'px': numpy.array([3]), 'py': numpy.array([4]),
+            'sday': segaux.columnar.ordinals(['1980-01-01']),
+            'eday': segaux.columnar.ordinals(['1981-12-31']),
+            'pday': segaux.columnar.ordinals(['1980-07-01'])}
+
+    assert segaux.prediction_records(rows, [[0.5, 0.5]]) == [{'cx': 1, 'cy': 2, 'px': 3, 'py': 4,
+                                                              'sday': '1980-01-01',
+                                                              'eday': '1981-12-31',
+                                                              'pday': '1980-07-01',
+                                                              'prob': [0.5, 0.5]}]
+
+
+def test_predict():
+    data   = numpy.random.rand(100, 4).astype(numpy.float32)
+    labels = numpy.random.randint(0, 3, 100)
+    model  = xgb.train(params={'objective': 'multi:softprob', 'num_class': 3, 'tree_method': 'hist'},
+                       dtrain=xgb.DMatrix(data, label=labels),
+                       num_boost_round=5)
+
+    expected = model.predict(xgb.DMatrix(data))
+
+    for chunk_rows in (0, 7, 100, 1000):
+        outputs = segaux.predict(model, data, chunk_rows)
+
+        assert outputs.dtype == numpy.float32
+        assert numpy.allclose(outputs, expected)
+
+    assert len(segaux.predict(model, data[:0], 7)) == 0
@@ -1,4 +1,6 @@
 from blackmagic import app
+from blackmagic import segaux
+from blackmagic import workers
 from blackmagic.blueprints import prediction
 from blackmagic.data import ceph
 from cytoolz import count
@@ -9,11 +11,14 @@ from cytoolz import reduce
 from datetime import date
 
 import json
+import logging
 import numpy
 import os
 import pytest
 import random
 import test
+import time
+import xgboost as xgb
 
 _ceph = ceph.Ceph(app.cfg)
 _ceph.start()
@@ -470,49 +475,6 @@ def test_prediction_prediction_exception(client):
     assert len(list(map(lambda x: x, predictions))) == 0
 
     
-def test_prediction_delete_exception(client):
-    '''
-    As a blackmagic user, when an exception occurs deleting 
-    predictions, an HTTP 500 is issued
-    with a descriptive message so that the issue may be 
-    investigated, corrected & retried.
-    '''
-
-    tx = test.tx
-    ty = test.ty
-    cx = test.cx
-    cy = test.cy
-    acquired = test.acquired
-    month = test.prediction_month
-    day = test.prediction_day
-
-    delete_predictions(test.cx, test.cy)
-    
-    response = client.post('/prediction',
-                           json={'tx': tx,
-                                 'ty': ty,
-                                 'cx': cx,
-                                 'cy': cy,
-                                 'acquired': acquired,
-                                 'month': month,
-                                 'day': day,
-                                 'test_delete_exception': True})
-
-    predictions = _ceph.select_predictions(cx=test.cx, cy=test.cy)
-        
-    assert response.status == '500 INTERNAL SERVER ERROR'
-    assert get('tx', response.get_json()) == tx
-    assert get('ty', response.get_json()) == ty
-    assert get('cx', response.get_json()) == cx
-    assert get('cy', response.get_json()) == cy
-    assert get('acquired', response.get_json()) == acquired
-    assert get('month', response.get_json()) == month
-    assert get('day', response.get_json()) == day
-    assert type(get('exception', response.get_json())) is str
-    assert len(get('exception', response.get_json())) > 0
-    assert len(list(map(lambda x: x, predictions))) == 0
-
-    
 def test_prediction_save_exception(client):
     '''
     As a blackmagic user, when an exception occurs saving 
@@ -632,18 +594,36 @@ def test_prediction_matrix():
 
     
     # normal expected input with no default segments
-    inputs = {'data': [{'independent': [1.,2.,3.,4.]},
-                       {'independent': [5.,6.,7.,8.]}]}
+    segment = {'cx': 1, 'cy': 2, 'px': 3, 'py': 4,
+               'sday': '1980-01-01', 'eday': '1981-12-31',
+               'nlcdtrn': [1], 'aspect': [2], 'posidex': [3],
+               'slope': [4], 'mpw': [5], 'dem': [6]}
+
+    for p in ('bl', 'gr', 're', 'ni', 's1', 's2', 'th'):
+        segment.update({p + 'coef': [0.5] * 7, p + 'rmse': 2.5, p + 'int': 3.5})
 
-    expected = {'data':  [{'independent': [1.,2.,3.,4.]},
-                          {'independent': [5.,6.,7.,8.]}],
-                'ndata': numpy.array([[1.,2.,3.,4.],
-                                      [5.,6.,7.,8.]], dtype='float32')}
+    inputs = {'data': [segment],
+              'defaults': [{'sday': '0001-01-01', 'eday': '0001-01-01'}],
+              'dates': [['07', '01']]}
 
     outputs = prediction.matrix(inputs)
 
-    assert numpy.array_equal(outputs['ndata'], expected['ndata'])
-    assert expected['data'] == outputs['data']
+    expected = [segaux.prediction_format(d) for d in
+                segaux.average_reflectance(segaux.prediction_dates([segment], dates=[['07', '01']]))]
+
+    assert numpy.array_equal(outputs['ndata'], numpy.array([e['independent'] for e in expected]))
+    assert outputs['ndata'].dtype == numpy.float32
+    assert outputs['rows']['pday'].tolist() == [date(1980, 7, 1).toordinal(), date(1981, 7, 1).toordinal()]
+    assert outputs['rows']['cx'].tolist() == [1, 1]
+    assert outputs['defaults'] == [{'sday': '0001-01-01', 'eday': '0001-01-01', 'pday': '0001-01-01'}]
+    assert 'data' not in outputs
+
+    
+    # defaults only
+    outputs = prediction.matrix({'data': [], 'defaults': [], 'dates': [['07', '01']]})
+
+    assert len(outputs['ndata']) == 0
+    assert len(outputs['rows']['pday']) == 0
 
 
 def test_prediction_default_predictions():
@@ -701,3 +681,216 @@ def test_prediction_default_predictions():
 
 
 
+
+
+def test_prediction_cache_booster():
+
+    prediction._boosters['pid'] = None
+    assert prediction.cached_booster((1, 2, 'a')) is None
+
+    prediction.cache_booster((1, 2, 'a'), 'model-a', 4, 10)
+    prediction.cache_booster((3, 4, 'a'), 'model-b', 4, 10)
+
+    assert prediction.cached_booster((1, 2, 'a')) == 'model-a'
+
+    # retrained tile replaces the old version
+    prediction.cache_booster((1, 2, 'b'), 'model-c', 4, 10)
+
+    assert prediction.cached_booster((1, 2, 'a')) is None
+    assert prediction.cached_booster((1, 2, 'b')) == 'model-c'
+
+    # least recently used is evicted
+    prediction.cache_booster((5, 6, 'a'), 'model-d', 4, 10)
+
+    assert prediction.cached_booster((3, 4, 'a')) is None
+    assert prediction.cached_booster((5, 6, 'a')) == 'model-d'
+    assert prediction._boosters['size'] == 8
+
+
+def test_prediction_load_booster(client):
+
+    if not _ceph.select_tile(test.tx, test.ty):
+        create_prediction_test_data(client)
+
+    a = prediction.load_booster(test.tx, test.ty, app.cfg)
+    b = prediction.load_booster(test.tx, test.ty, app.cfg)
+
+    assert a is b
+
+    # retraining the tile changes its etag
+    tile = _ceph.select_model(test.tx, test.ty)
+    
+    retrained = xgb.train(params={'objective': 'multi:softprob', 'num_class': 9},
+                          dtrain=xgb.DMatrix(numpy.random.rand(18, 4), label=list(range(9)) * 2),
+                          num_boost_round=1)
+    try:
+        _ceph.insert_tile(test.tx, test.ty, segaux.bytes_from_booster(retrained), metadata=tile['metadata'])
+
+        assert prediction.load_booster(test.tx, test.ty, app.cfg) is not a
+    finally:
+        _ceph.insert_tile(test.tx, test.ty, tile['model'], metadata=tile['metadata'])
+
+    with pytest.raises(Exception):
+        prediction.load_booster(test.missing_tx, test.missing_ty, app.cfg)
+
+
+def test_batch_predictions(client):
+    '''
+    As a blackmagic user, when I send tx, ty, acquired, month, day and a list
+    of chips via HTTP POST, predictions are generated and saved for every chip
+    and the response reports the status of each.
+    '''
+
+    if not _ceph.select_tile(test.tx, test.ty):
+        create_prediction_test_data(client)
+
+    delete_predictions(test.cx, test.cy)
+
+    response = client.post('/predictions',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'chips': test.chips,
+                                 'month': test.prediction_month,
+                                 'day': test.prediction_day,
+                                 'acquired': test.acquired})
+
+    predictions = _ceph.select_predictions(cx=test.cx, cy=test.cy)
+    chips = get('chips', response.get_json())
+
+    assert response.status == '200 OK'
+    assert get('tx', response.get_json()) == test.tx
+    assert get('exception', response.get_json(), None) == None
+    assert chips == [{'cx': test.cx, 'cy': test.cy, 'status': 200, 'predictions': len(predictions)}]
+    assert len(predictions) > 0
+
+
+def test_batch_predictions_log_request(caplog):
+    with caplog.at_level(logging.INFO, logger='blackmagic.prediction'):
+        prediction.log_batch_request({'tx': 1, 'ty': 2, 'chips': [[3, 4], [5, 6]],
+                                      'acquired': test.acquired, 'month': 7, 'day': 1})
+
+    assert caplog.messages[-1] == 'POST /predictions 1,2,7,1,None,{},2,[[3, 4], [5, 6]]'.format(test.acquired)
+
+
+def load_or_fail(chip):
+    if chip == 1:
+        raise ValueError('chip failed')
+
+    time.sleep(0.5)
+    return chip
+
+
+def test_prefetch_exception_discards_pool():
+    with pytest.raises(ValueError):
+        with workers(app.cfg) as w:
+            failed = w
+            list(prediction.prefetch(w, load_or_fail, [0, 1] + [2] * 10, 4))
+
+    start = time.time()
+
+    with workers(app.cfg) as w:
+        assert w is not failed
+        assert list(prediction.prefetch(w, abs, [-1, -2, -3], 2)) == [1, 2, 3]
+
+    assert time.time() - start < 5
+
+
+def test_batch_predictions_chip_exception(client):
+    '''
+    As a blackmagic user, when a chip fails during a batch prediction
+    the HTTP status is 500 and the failing chip is reported.
+    '''
+
+    response = client.post('/predictions',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'chips': test.chips,
+                                 'month': test.prediction_month,
+                                 'day': test.prediction_day,
+                                 'acquired': test.acquired,
+                                 'test_load_data_exception': True})
+
+    chip = first(get('chips', response.get_json()))
+
+    assert response.status == '500 INTERNAL SERVER ERROR'
+    assert get('status', chip) == 500
+    assert get('predictions', chip) == 0
+    assert 'load_data' in get('exception', chip)
+
+
+def test_batch_predictions_bad_parameters(client):
+
+    response = client.post('/predictions',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'chips': [],
+                                 'month': test.prediction_month,
+                                 'day': test.prediction_day,
+                                 'acquired': test.acquired})
+
+    assert response.status == '400 BAD REQUEST'
+    assert get('chips', response.get_json()) == []
+    assert len(get('exception', response.get_json())) > 0
+
+
+@pytest.mark.parametrize('dates,message', [(['07', '01'], 'list of [month, day] pairs'),
+                                           ([['07', '01', '02']], 'list of [month, day] pairs'),
+                                           ('07-01', 'list of [month, day] pairs'),
+                                           ([['13', '01']], '13-01 is not a valid month and day'),
+                                           ([[2, 30]], '2-30 is not a valid month and day'),
+                                           ([['07', 'x']], '07-x is not a valid month and day'),
+                                           ([[7, None]], '7-None is not a valid month and day')])
+def test_prediction_bad_dates(client, dates, message):
+    response = client.post('/prediction',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'cx': test.cx,
+                                 'cy': test.cy,
+                                 'acquired': test.acquired,
+                                 'dates': dates})
+
+    assert response.status == '400 BAD REQUEST'
+    assert message in get('exception', response.get_json())
+
+
+def test_prediction_bad_month_day(client):
+    response = client.post('/predictions',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'chips': test.chips,
+                                 'acquired': test.acquired,
+                                 'month': 4,
+                                 'day': 31})
+
+    assert response.status == '400 BAD REQUEST'
+    assert '4-31 is not a valid month and day' in get('exception', response.get_json())
+
+
+def test_prediction_leap_day():
+    assert prediction.dates_parameter({'dates': [[2, 29], ['07', '01']]}) == [[2, 29], ['07', '01']]
+
+
+def test_prediction_many_dates(client):
+    '''
+    As a blackmagic user, when I send a list of prediction dates
+    predictions for every date are generated and saved in one pass.
+    '''
+
+    if not _ceph.select_tile(test.tx, test.ty):
+        create_prediction_test_data(client)
+
+    response = client.post('/prediction',
+                           json={'tx': test.tx,
+                                 'ty': test.ty,
+                                 'cx': test.cx,
+                                 'cy': test.cy,
+                                 'dates': [['07', '01'], ['01', '01']],
+                                 'acquired': test.acquired})
+
+    predictions = _ceph.select_predictions(cx=test.cx, cy=test.cy)
+    pdays = {p['pday'][5:] for p in predictions if p['pday'] != '0001-01-01'}
+    
+    assert response.status == '200 OK'
+    assert get('dates', response.get_json()) == [['07', '01'], ['01', '01']]
+    assert get('exception', response.get_json(), None) == None
+    assert pdays == {'07-01', '01-01'}
@@ -0,0 +1,89 @@
+import blackmagic
+import pytest
+import test
+import time
+
+
+def square(x):
+    return x * x
+
+
+def slow_or_fail(x):
+    if x == 0:
+        raise ValueError('chip failed')
+
+    time.sleep(0.5)
+    return x
+
+
+def test_workers_reuses_pool():
+
+    with blackmagic.workers(blackmagic.cfg) as w:
+        first_pool = w
+        assert w.map(square, [1, 2, 3]) == [1, 4, 9]
+
+    with blackmagic.workers(blackmagic.cfg) as w:
+        assert w is first_pool
+        assert w.map(square, [4]) == [16]
+
+
+def test_workers_recreates_unhealthy_pool():
+
+    p = blackmagic.pool(blackmagic.cfg)
+    p.terminate()
+
+    with blackmagic.workers(blackmagic.cfg) as w:
+        assert w is not p
+        assert w.map(square, [5]) == [25]
+
+
+def test_workers_discards_pool_after_exception():
+
+    with pytest.raises(ValueError):
+        with blackmagic.workers(blackmagic.cfg) as w:
+            failed = w
+
+            for _ in w.imap_unordered(slow_or_fail, [0] + [1] * 20):
+                pass
+
+    start = time.time()
+
+    # the next request does not wait behind the failed request's tasks
+    with blackmagic.workers(blackmagic.cfg) as w:
+        assert w is not failed
+        assert w.map(square, [6]) == [36]
+
+    assert time.time() - start < 5
+
+
+def test_healthy_does_not_wait_for_queued_tasks():
+
+    with blackmagic.workers(blackmagic.cfg) as w:
+        r = w.map_async(time.sleep, [1] * 4)
+        start = time.time()
+
+        assert blackmagic._healthy(w)
+        assert time.time() - start < 0.5
+
+        r.get()
+
+
+def test_workers_recreates_pool_after_fork():
+
+    p = blackmagic.pool(blackmagic.cfg)
+
+    # simulate running in a forked child
+    blackmagic._pool['pid'] = -1
+
+    try:
+        assert blackmagic.pool(blackmagic.cfg) is not p
+    finally:
+        p.terminate()
+
+
+def test_shutdown():
+
+    blackmagic.pool(blackmagic.cfg)
+    blackmagic.shutdown()
+
+    assert blackmagic._pool['pool'] is None
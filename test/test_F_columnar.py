@@ -0,0 +1,94 @@
+from blackmagic import columnar
+
+import numpy
+import test
+
+
+def change_model(start_day, end_day, break_day):
+    band = {'magnitude': 1.5,
+            'rmse': 2.5,
+            'intercept': 3.5,
+            'coefficients': (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7)}
+
+    return {'start_day': start_day,
+            'end_day': end_day,
+            'break_day': break_day,
+            'change_probability': 1.0,
+            'curve_qa': 8,
+            'blue': band,
+            'green': band,
+            'red': band,
+            'nir': band,
+            'swir1': band,
+            'swir2': band,
+            'thermal': band}
+
+
+def test_segments():
+    t = columnar.segments(cx=1, cy=2, px=3, py=4,
+                          change_models=[change_model(724000, 725000, 725001),
+                                         change_model(725002, 726000, 726000)])
+
+    assert columnar.length(t) == 2
+    assert t['mag'].shape == (2, 7)
+    assert t['coef'].shape == (2, 7, 7)
+    assert numpy.array_equal(t['sday'], [724000, 725002])
+    assert numpy.array_equal(t['px'], [3, 3])
+    assert numpy.allclose(t['coef'][1, 6], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7])
+
+
+def test_segments_defaults():
+    t = columnar.segments(cx=1, cy=2, px=3, py=4, change_models=[])
+
+    assert columnar.length(t) == 1
+    assert numpy.array_equal(columnar.defaults(t), [True])
+    assert t['curqa'][0] == 0
+    assert numpy.all(t['coef'] == 0)
+
+
+def test_concat():
+    a = columnar.segments(1, 2, 3, 4, [change_model(724000, 725000, 725001)])
+    b = columnar.segments(1, 2, 5, 6, [])
+
+    t = columnar.concat([a, {}, b])
+
+    assert columnar.length(t) == 2
+    assert numpy.array_equal(t['px'], [3, 5])
+    assert columnar.concat([]) == {}
+
+
+def test_isoformat():
+    assert columnar.isoformat([1, 724000]) == ['0001-01-01', '1983-03-31']
+
+
+def test_records():
+    t = columnar.concat([columnar.segments(1, 2, 3, 4, [change_model(724000, 725000, 725001)]),
+                         columnar.segments(1, 2, 5, 6, None)])
+
+    r = columnar.records(t)
+
+    assert len(r) == 2
+    assert len(r[0]) == 37
+    assert r[0]['sday'] == '1983-03-31'
+    assert r[0]['blcoef'] == [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]
+    assert r[0]['thmag'] == 1.5
+    assert r[1]['sday'] == '0001-01-01'
+    assert r[1]['eday'] == '0001-01-01'
+    assert r[1]['blcoef'] == []
+    assert r[1]['chprob'] == 0.0
+    assert type(r[1]['px']) is int
+
+
+def test_pixel_records():
+    pixels = columnar.concat([columnar.pixels(1, 2, 3, 4, [1, 0, 1]),
+                              columnar.pixels(1, 2, 5, 6, [0, 0, 1])])
+
+    r = columnar.pixel_records(pixels)
+
+    assert r == [{'cx': 1, 'cy': 2, 'px': 3, 'py': 4, 'mask': [1, 0, 1]},
+                 {'cx': 1, 'cy': 2, 'px': 5, 'py': 6, 'mask': [0, 0, 1]}]
+
+    t = columnar.pixel_table(r)
+
+    assert numpy.array_equal(t['mask'], pixels['mask'])
+    assert numpy.array_equal(t['py'], [4, 6])
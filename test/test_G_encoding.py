@@ -0,0 +1,128 @@
+from blackmagic import columnar
+from blackmagic.data import encoding
+
+import numpy
+import pytest
+import test
+
+
+def test_encode_decode():
+    table = {'a': numpy.array([1, 2, 3], dtype=numpy.int32),
+             'b': numpy.array([[1.5, 2.5], [3.5, 4.5], [5.5, 6.5]], dtype=numpy.float64),
+             'c': numpy.array([True, False, True])}
+
+    buf = encoding.encode(table, attrs={'kind': 'test'})
+
+    assert encoding.is_encoded(buf)
+
+    outputs, attrs = encoding.decode(buf)
+
+    assert attrs == {'kind': 'test'}
+    assert set(outputs.keys()) == {'a', 'b', 'c'}
+
+    for k, v in table.items():
+        assert outputs[k].dtype == v.dtype
+        assert numpy.array_equal(outputs[k], v)
+
+
+def test_decode_rejects_other_bytes():
+    assert not encoding.is_encoded(b'[{"cx": 1}]')
+
+    with pytest.raises(ValueError):
+        encoding.decode(b'[{"cx": 1}]')
+
+
+def test_encode_decode_pixels():
+    pixels = columnar.concat([columnar.pixels(1, 2, 3, 4, [1, 0, 1, 1, 0, 0, 0, 0, 1, 1]),
+                              columnar.pixels(1, 2, 5, 6, [0, 0, 1, 0, 0, 0, 0, 0, 0, 1])])
+
+    buf = encoding.encode_pixels(pixels)
+
+    assert encoding.decode_pixels(buf) == columnar.pixel_records(pixels)
+
+    packed = encoding.decode_pixels(buf, packed=True)
+
+    assert packed['dates'] == 10
+    assert packed['mask'].shape == (2, 2)
+    assert numpy.array_equal(numpy.unpackbits(packed['mask'], axis=1, count=packed['dates']),
+                             pixels['mask'])
+
+
+def segments():
+    band = {'magnitude': 1.5,
+            'rmse': 2.5,
+            'intercept': 3.5,
+            'coefficients': (0.5, 0.25, 0.125, 0.0, 0.0, 0.0, 0.0)}
+
+    cm = {'start_day': 724000,
+          'end_day': 725000,
+          'break_day': 725001,
+          'change_probability': 1.0,
+          'curve_qa': 8,
+          'blue': band, 'green': band, 'red': band, 'nir': band,
+          'swir1': band, 'swir2': band, 'thermal': band}
+
+    return columnar.concat([columnar.segments(1, 2, 3, 4, [cm, cm]),
+                            columnar.segments(1, 2, 5, 6, [])])
+
+
+@pytest.mark.parametrize('codec', [None, 'zstd', 'lz4'])
+def test_encode_decode_segments(codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    if codec == 'lz4':
+        pytest.importorskip('lz4')
+
+    s = segments()
+
+    buf = encoding.encode_segments(s, codec=codec)
+
+    table = encoding.decode_segments(buf, table=True)
+
+    assert table['sday'].dtype == numpy.int32
+    assert table['mag'].dtype == numpy.float32
+    assert table['coef'].shape == (3, 7, 7)
+
+    for k, v in s.items():
+        assert numpy.array_equal(table[k], v)
+
+    assert encoding.decode_segments(buf) == columnar.records(s)
+
+
+def test_segment_table():
+    s = segments()
+
+    t = columnar.segment_table(columnar.records(s))
+
+    for k, v in s.items():
+        assert numpy.array_equal(t[k], v)
+
+
+def predictions():
+    return [{'cx': 1, 'cy': 2, 'px': 1, 'py': 2,
+             'sday': '1983-03-31', 'eday': '1985-12-26', 'pday': '1984-07-01',
+             'prob': [0.1, 0.6, 0.3]},
+            {'cx': 1, 'cy': 2, 'px': 4, 'py': 5,
+             'sday': '0001-01-01', 'eday': '0001-01-01', 'pday': '0001-01-01',
+             'prob': []}]
+
+
+@pytest.mark.parametrize('quantization', ['uint8', 'float16'])
+def test_encode_decode_predictions(quantization):
+    table   = columnar.prediction_table(predictions())
+    buf     = encoding.encode_predictions(table, quantization=quantization)
+    decoded = encoding.decode_predictions(buf)
+
+    assert encoding.decode(buf)[0]['prob'].dtype == numpy.dtype(quantization)
+    assert [dict(d, prob=None) for d in decoded] == [dict(p, prob=None) for p in predictions()]
+    assert numpy.allclose(decoded[0]['prob'], [0.1, 0.6, 0.3], atol=1 / 255)
+    assert decoded[1]['prob'] == []
+    assert encoding.decode_predictions(buf, table=True)['prob'].shape == (2, 3)
+
+
+def test_encode_decode_predictions_top_k():
+    table   = columnar.prediction_table(predictions())
+    decoded = encoding.decode_predictions(encoding.encode_predictions(table, top_k=2))
+
+    assert numpy.allclose(decoded[0]['prob'], [0, 0.6, 0.3], atol=1 / 255)
+    assert decoded[1]['prob'] == []
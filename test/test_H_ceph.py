@@ -0,0 +1,228 @@
+from blackmagic.data import ceph
+from cytoolz import first
+from cytoolz import merge
+
+import numpy
+import test
+
+
+def segment(cx, cy):
+    s = {'cx': cx, 'cy': cy, 'px': cx, 'py': cy,
+         'sday': '1983-03-31', 'eday': '1985-12-26', 'bday': '1985-12-27',
+         'chprob': 1.0, 'curqa': 8}
+
+    for p in ('bl', 'gr', 're', 'ni', 's1', 's2', 'th'):
+        s.update({p + 'mag': 1.5, p + 'rmse': 2.5, p + 'int': 3.5, p + 'coef': [0.5] * 7})
+
+    return s
+
+
+def test_client_is_shared():
+    a = ceph.Ceph(ceph.cfg)
+    b = ceph.Ceph(ceph.cfg)
+
+    assert a.client is b.client
+
+    with ceph.connect(ceph.cfg) as c:
+        assert c.client is a.client
+
+
+def test_client_per_endpoint():
+    a = ceph.client(ceph.cfg)
+    b = ceph.client(merge(ceph.cfg, {'s3_url': 'http://localhost:4573'}))
+    c = ceph.client(merge(ceph.cfg, {'s3_max_pool_connections': 50}))
+
+    assert a is not b
+    assert a is not c
+    assert c.meta.config.max_pool_connections == 50
+
+
+def test_client_recreated_after_fork():
+    a = ceph.client(ceph.cfg)
+
+    # simulate running in a forked child
+    ceph._clients['pid'] = -1
+
+    assert ceph.client(ceph.cfg) is not a
+
+
+def test_select_segments_many():
+    chips = [(100, 200), (300, 400), (500, 600)]
+
+    with ceph.connect(merge(ceph.cfg, {'s3_threads': 2})) as c:
+        for cx, cy in chips[:2]:
+            c.insert_segments([segment(cx, cy)])
+
+        results = {(cx, cy): s for cx, cy, s in c.select_segments_many(chips)}
+
+        for cx, cy in chips[:2]:
+            c.delete_segments(cx, cy)
+
+    assert set(results.keys()) == set(chips)
+    assert results[(100, 200)] == [segment(100, 200)]
+    assert results[(300, 400)] == [segment(300, 400)]
+    assert results[(500, 600)] == []
+
+
+def test_tile_formats():
+    tx, ty = 900, 1000
+    model  = bytes(range(256))
+    meta   = {'tx': tx, 'ty': ty, 'date': '2001-07-01', 'layout': 1}
+
+    with ceph.connect(merge(ceph.cfg, {'tile_format': 'binary'})) as c:
+        try:
+            c.insert_tile(tx, ty, model, metadata=meta)
+
+            assert c.select_model(tx, ty) == {'model': model, 'metadata': meta}
+            assert c.select_tile(tx, ty) == [{'tx': tx, 'ty': ty, 'model': model.hex()}]
+            assert c.select_tile_etag(tx, ty) is not None
+        finally:
+            c.delete_tile(tx, ty)
+
+        assert c.select_model(tx, ty) == {}
+        assert c.select_tile_etag(tx, ty) is None
+
+        # hex JSON tiles remain readable
+        with ceph.connect(ceph.cfg) as j:
+            j.insert_tile(tx, ty, model.hex())
+
+        try:
+            assert c.select_model(tx, ty) == {'model': model, 'metadata': {}}
+        finally:
+            c.delete_tile(tx, ty)
+
+
+def test_prediction_formats():
+    cx, cy = 1100, 1200
+    preds  = [{'cx': cx, 'cy': cy, 'px': cx, 'py': cy,
+               'sday': '1983-03-31', 'eday': '1985-12-26', 'pday': '1984-07-01',
+               'prob': [0.0, 0.2, 0.8]}]
+
+    with ceph.connect(merge(ceph.cfg, {'prediction_format': 'compact', 'prediction_top_k': 2})) as c:
+        try:
+            c.insert_predictions(preds)
+
+            selected = c.select_predictions(cx, cy)
+
+            assert [dict(s, prob=None) for s in selected] == [dict(first(preds), prob=None)]
+            assert numpy.allclose(first(selected)['prob'], [0.0, 0.2, 0.8], atol=1 / 255)
+            assert c.select_predictions(cx, cy, table=True)['prob'].shape == (1, 3)
+        finally:
+            c.delete_predictions(cx, cy)
+
+        assert c.select_predictions(cx, cy) == []
+
+        # JSON predictions remain readable
+        with ceph.connect(ceph.cfg) as j:
+            j.insert_predictions(preds)
+
+        try:
+            assert c.select_predictions(cx, cy) == preds
+        finally:
+            c.delete_predictions(cx, cy)
+
+
+def test_writes_replace_other_formats():
+    cx, cy = 1300, 1400
+    cfg    = merge(ceph.cfg, {'format_cleanup': True})
+
+    with ceph.connect(cfg) as j, ceph.connect(merge(cfg, {'segment_format': 'columnar'})) as c:
+        try:
+            j.insert_segments([segment(cx, cy)])
+            c.insert_segments([segment(cx, cy)])
+
+            assert list(c._keys('segment/{}-{}.'.format(cx, cy))) == ['segment/{}-{}.bin'.format(cx, cy)]
+
+            j.insert_segments([segment(cx, cy)])
+
+            assert list(c._keys('segment/{}-{}.'.format(cx, cy))) == ['segment/{}-{}.json'.format(cx, cy)]
+            assert c.select_segments(cx, cy) == [segment(cx, cy)]
+        finally:
+            c.delete_segments(cx, cy)
+
+        assert list(c._keys('segment/{}-{}.'.format(cx, cy))) == []
+
+
+def test_delete_many():
+    keys = ['test/delete-many-{}.json'.format(i) for i in range(5)]
+
+    with ceph.connect(ceph.cfg) as c:
+        for k in keys:
+            c._put_json(k, {})
+
+        c._delete_many(keys + ['test/never-written.json'])
+
+        assert list(c._keys('test/delete-many-')) == []
+
+
+def test_batch_deletes_other_formats_once():
+    cx, cy  = 1500, 1600
+    pixels  = [{'cx': cx, 'cy': cy, 'px': cx, 'py': cy, 'mask': [1, 0, 1]}]
+    packed  = merge(ceph.cfg, {'pixel_format': 'packed', 'segment_format': 'columnar'})
+
+    with ceph.connect(packed) as p, ceph.connect(merge(ceph.cfg, {'format_cleanup': True})) as j:
+        calls = []
+        delete_many = j._delete_many
+        j._delete_many = lambda keys: calls.append(list(keys)) or delete_many(keys)
+
+        try:
+            p.insert_pixels(pixels)
+            p.insert_segments([segment(cx, cy)])
+
+            with j.batch():
+                j.insert_chip([{'cx': cx, 'cy': cy, 'dates': ['1983-03-31']}])
+                j.insert_pixels(pixels)
+                j.insert_segments([segment(cx, cy)])
+
+                # removals wait for the end of the batch
+                assert calls == []
+
+            assert calls == [['pixel/{}-{}.bin'.format(cx, cy), 'segment/{}-{}.bin'.format(cx, cy)]]
+            assert list(j._keys('pixel/{}-{}.'.format(cx, cy))) == ['pixel/{}-{}.json'.format(cx, cy)]
+            assert list(j._keys('segment/{}-{}.'.format(cx, cy))) == ['segment/{}-{}.json'.format(cx, cy)]
+        finally:
+            delete_many(['chip/{}-{}.json'.format(cx, cy)] +
+                        ['{}/{}-{}.{}'.format(k, cx, cy, e) for k in ('pixel', 'segment') for e in ('json', 'bin')])
+
+
+def test_format_cleanup_off():
+    cx, cy = 1700, 1800
+
+    # off by default
+    with ceph.connect(ceph.cfg) as c:
+        calls = []
+        c._delete_many = lambda keys: calls.append(list(keys))
+
+        try:
+            c.insert_segments([segment(cx, cy)])
+
+            assert calls == []
+        finally:
+            del c._delete_many
+            c.delete_segments(cx, cy)
+
+
+def test_remove_other_formats():
+    cx, cy = 1900, 2000
+    pixels = [{'cx': cx, 'cy': cy, 'px': cx, 'py': cy, 'mask': [1, 0, 1]}]
+    other  = merge(ceph.cfg, {'tile_format': 'binary', 'pixel_format': 'packed', 'segment_format': 'columnar'})
+
+    with ceph.connect(other) as o, ceph.connect(ceph.cfg) as j:
+        try:
+            o.insert_tile(cx, cy, bytes(range(8)), metadata={'tx': cx})
+            o.insert_pixels(pixels)
+            o.insert_segments([segment(cx, cy)])
+            j.insert_tile(cx, cy, bytes(range(8)), metadata={'tx': cx})
+            j.insert_segments([segment(cx, cy)])
+
+            # pixels only exist in the other format, so they are kept
+            assert j.remove_other_formats() >= 2
+            assert list(j._keys('tile/{}-{}.'.format(cx, cy))) == ['tile/{}-{}.json'.format(cx, cy),
+                                                                    'tile/{}-{}.meta.json'.format(cx, cy)]
+            assert list(j._keys('segment/{}-{}.'.format(cx, cy))) == ['segment/{}-{}.json'.format(cx, cy)]
+            assert list(j._keys('pixel/{}-{}.'.format(cx, cy))) == ['pixel/{}-{}.bin'.format(cx, cy)]
+            assert j.select_pixels(cx, cy) == pixels
+        finally:
+            j.delete_tile(cx, cy)
+            j.delete_pixels(cx, cy)
+            j.delete_segments(cx, cy)
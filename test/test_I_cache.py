@@ -0,0 +1,188 @@
+from blackmagic import app
+from blackmagic.data import cache
+from blackmagic.data import ceph
+from blackmagic.data import local
+from blackmagic.data import storage
+from cytoolz import merge
+
+import mmap
+import numpy
+import os
+import pytest
+import tempfile
+import test
+
+
+def segment(cx, cy, chprob):
+    s = {'cx': cx, 'cy': cy, 'px': cx, 'py': cy,
+         'sday': '1983-03-31', 'eday': '1985-12-26', 'bday': '1985-12-27',
+         'chprob': chprob, 'curqa': 8}
+
+    for p in ('bl', 'gr', 're', 'ni', 's1', 's2', 'th'):
+        s.update({p + 'mag': 1.5, p + 'rmse': 2.5, p + 'int': 3.5, p + 'coef': [0.5] * 7})
+
+    return s
+
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    yield app.app.test_client()
+
+
+def test_memory_lru():
+    m = cache.Memory(10)
+
+    assert m.put('a', 'e1', b'1234') == 0
+    assert m.put('b', 'e1', b'1234') == 0
+    assert m.get('a', 'e1') == b'1234'
+    assert m.put('c', 'e1', b'1234') == 1
+
+    # b was least recently used
+    assert m.get('b', 'e1') is None
+    assert m.get('a', 'e1') == b'1234'
+    assert m.get('a', 'e2') is None
+    assert m.get('a', 'e1') is None
+    assert m.size == 4
+
+
+def test_disk_lru():
+    with tempfile.TemporaryDirectory() as d:
+        disk = cache.Disk(d, 10)
+
+        disk.put('a', 'e1', b'1234')
+        os.utime(disk._path('a', 'e1'), (0, 0))
+        disk.put('b', 'e1', b'1234')
+
+        assert disk.get('a', 'e1') == b'1234'
+        assert disk.get('a', 'e2') is None
+
+        disk.put('a', 'e2', b'5678')
+
+        # the replaced version no longer counts
+        assert disk.size == 8
+        assert disk.get('a', 'e1') is None
+        assert disk.get('a', 'e2') == b'5678'
+
+        os.utime(disk._path('b', 'e1'), (0, 0))
+
+        assert disk.put('c', 'e1', b'1234') == 1
+        assert disk.get('b', 'e1') is None
+        assert disk.size == 8
+
+
+def test_arrays_lru():
+    a = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+
+    with tempfile.TemporaryDirectory() as d:
+        arrays = cache.Arrays(d, a.nbytes * 2 + 256)
+
+        assert arrays.get('a', 'e1') is None
+        assert arrays.put('a', 'e1', a) == 0
+
+        b = arrays.get('a', 'e1')
+
+        assert isinstance(b, numpy.memmap)
+        assert numpy.array_equal(a, b)
+        assert arrays.get('a', 'e2') is None
+        assert all(f.endswith('.npy') for f in os.listdir(d))
+
+        os.utime(arrays.disk._path('a', 'e1'), (0, 0))
+        arrays.put('b', 'e1', a)
+
+        assert arrays.put('c', 'e1', a) == 1
+        assert arrays.get('a', 'e1') is None
+        assert numpy.array_equal(arrays.get('c', 'e1'), a)
+
+
+def test_arrays_disabled():
+    assert cache.arrays(merge(cache.cfg, {'training_cache_dir': None})) is None
+
+
+def test_cached_storage(client):
+    with tempfile.TemporaryDirectory() as d:
+        cfg = merge(app.cfg, {'cache': True,
+                              'cache_memory_bytes': 1024 ** 2,
+                              'cache_dir': d})
+        cx, cy = 700, 800
+
+        s = cache.Cached(cfg)
+        s.insert_segments([segment(cx, cy, 0.5)])
+
+        try:
+            assert s.select_segments(cx, cy) == [segment(cx, cy, 0.5)]
+            assert s.select_segments(cx, cy) == [segment(cx, cy, 0.5)]
+
+            stats = s.stats()
+            assert stats['misses'] == 1
+            assert stats['memory_hits'] == 1
+
+            # a new process only has the disk tier
+            cache._caches['pid'] = -1
+            s = cache.Cached(cfg)
+
+            assert s.select_segments(cx, cy) == [segment(cx, cy, 0.5)]
+            assert s.stats()['disk_hits'] == 1
+
+            # overwritten objects are never served stale
+            s.insert_segments([segment(cx, cy, 0.75)])
+
+            assert s.select_segments(cx, cy) == [segment(cx, cy, 0.75)]
+            assert s.stats()['misses'] == 1
+
+            assert len(client.get('/health/cache').get_json()) > 0
+        finally:
+            s.delete_segments(cx, cy)
+
+        assert s.select_segments(cx, cy) == []
+
+
+def test_cached_model_with_known_etag():
+    with tempfile.TemporaryDirectory() as d:
+        cfg = merge(app.cfg, {'cache': True,
+                              'cache_memory_bytes': 1024 ** 2,
+                              'cache_dir': d})
+        tx, ty = 700, 800
+
+        cache._caches['pid'] = -1
+        s = cache.Cached(cfg)
+        s.insert_tile(tx, ty, b'model', metadata={})
+
+        try:
+            etag = s.select_tile_etag(tx, ty)
+            heads = []
+            head = s.backend._etag
+            s.backend._etag = lambda key: heads.append(key) or head(key)
+
+            assert s.select_model(tx, ty, etag=etag)['model'] == b'model'
+            assert s.select_model(tx, ty, etag=etag)['model'] == b'model'
+            assert s.stats()['memory_hits'] >= 1
+
+            # only the metadata is looked up
+            assert all(k.endswith('.meta.json') for k in heads)
+        finally:
+            s.backend._etag = head
+            s.delete_tile(tx, ty)
+
+
+def test_cached_local_storage_keeps_no_maps():
+    with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as l:
+        cfg = merge(app.cfg, local.cfg, {'cache': True,
+                                         'cache_memory_bytes': 1024 ** 2,
+                                         'cache_dir': d,
+                                         'storage': 'local',
+                                         'local_dir': l})
+
+        cache._caches['pid'] = -1
+        s = storage(cfg)
+        s.insert_segments([segment(700, 800, 0.5)])
+
+        assert s.select_segments(700, 800) == [segment(700, 800, 0.5)]
+        assert s.select_segments(700, 800) == [segment(700, 800, 0.5)]
+
+        stats = s.stats()
+
+        assert stats['misses'] == 2
+        assert stats['memory_size'] == 0
+        assert stats['disk_size'] == 0
+        assert not any(isinstance(v, mmap.mmap) for _, v in s.backend.cache.memory.entries.values())
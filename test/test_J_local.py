@@ -0,0 +1,110 @@
+from blackmagic import columnar
+from blackmagic.data import local
+from blackmagic.data import storage
+from cytoolz import merge
+
+import mmap
+import numpy
+import os
+import pytest
+import tempfile
+import test
+
+
+def segment(cx, cy):
+    s = {'cx': cx, 'cy': cy, 'px': cx, 'py': cy,
+         'sday': '1983-03-31', 'eday': '1985-12-26', 'bday': '1985-12-27',
+         'chprob': 1.0, 'curqa': 8}
+
+    for p in ('bl', 'gr', 're', 'ni', 's1', 's2', 'th'):
+        s.update({p + 'mag': 1.5, p + 'rmse': 2.5, p + 'int': 3.5, p + 'coef': [0.5] * 7})
+
+    return s
+
+
+@pytest.fixture
+def directory():
+    with tempfile.TemporaryDirectory() as d:
+        yield d
+
+
+def test_storage_selects_local(directory):
+    s = storage(merge(local.cfg, {'storage': 'local', 'local_dir': directory}))
+
+    assert isinstance(s, local.Local)
+
+
+def test_local_round_trip(directory):
+    cfg = merge(local.cfg, {'local_dir': directory})
+
+    with local.connect(cfg) as s:
+        s.setup()
+
+        s.insert_tile(1, 2, 'model')
+        s.insert_chip([{'cx': 3, 'cy': 4, 'dates': ['1983-03-31']}])
+        s.insert_segments([segment(3, 4)])
+        s.insert_pixels([{'cx': 3, 'cy': 4, 'px': 3, 'py': 4, 'mask': [1, 0, 1]}])
+
+        assert s.select_tile(1, 2) == [{'tx': 1, 'ty': 2, 'model': 'model'}]
+        assert s.select_chip(3, 4) == [{'cx': 3, 'cy': 4, 'dates': ['1983-03-31']}]
+        assert s.select_segments(3, 4) == [segment(3, 4)]
+        assert s.select_pixels(3, 4) == [{'cx': 3, 'cy': 4, 'px': 3, 'py': 4, 'mask': [1, 0, 1]}]
+        assert os.path.isfile(os.path.join(directory, 'segment', '3-4.json'))
+
+        assert s.select_segments_etag(3, 4) is not None
+
+        s.delete_segments(3, 4)
+
+        assert s.select_segments(3, 4) == []
+        assert s.select_segments_etag(3, 4) is None
+        assert s.select_predictions(3, 4) == []
+
+        # no temporary files are left behind
+        assert not [f for _, _, files in os.walk(directory) for f in files if f.startswith('.')]
+
+
+def test_local_tile_metadata_written_first(directory):
+    cfg = merge(local.cfg, {'local_dir': directory, 'tile_format': 'binary'})
+
+    with local.connect(cfg) as s:
+        s.insert_tile(1, 2, b'model 1', metadata={'date': '2001-07-01'})
+
+        def fail(key, value):
+            raise OSError('disk full')
+
+        s._put = fail
+
+        with pytest.raises(OSError):
+            s.insert_tile(1, 2, b'model 2', metadata={'date': '2002-07-01'})
+
+        # a failed save leaves the previous model & metadata together
+        tile = s.select_model(1, 2)
+
+        assert bytes(tile['model']) == b'model 1'
+        assert tile['metadata'] == {'date': '2001-07-01'}
+
+
+def test_local_columnar_segments_are_mapped(directory):
+    cfg = merge(local.cfg, {'local_dir': directory, 'segment_format': 'columnar'})
+
+    with local.connect(cfg) as s:
+        s.insert_segments([segment(3, 4), segment(3, 4)])
+
+        assert isinstance(s._get_bin(s._columnar_segment_key(3, 4)), mmap.mmap)
+
+        table = s.select_segments(3, 4, table=True)
+
+        assert columnar.length(table) == 2
+        assert table['coef'].dtype == numpy.float32
+        assert s.select_segments(3, 4) == [segment(3, 4), segment(3, 4)]
+
+
+def test_local_convert_segments(directory):
+    cfg = merge(local.cfg, {'local_dir': directory})
+
+    with local.connect(cfg) as s:
+        s.insert_segments([segment(3, 4)])
+
+        assert s.convert_segments(remove=True) == 1
+        assert os.listdir(os.path.join(directory, 'segment')) == ['3-4.bin']
+        assert s.select_segments(3, 4) == [segment(3, 4)]
@@ -0,0 +1,118 @@
+from blackmagic import sampling
+
+import numpy
+import os
+import tempfile
+import test
+
+
+def rows(label, n, start=0):
+    r = numpy.zeros((n, 2), dtype=numpy.float32)
+    r[:, 0] = label
+    r[:, 1] = numpy.arange(start, start + n)
+    return r
+
+
+def test_capacity():
+    assert sampling.capacity(20000000, 8000000, 600000) == 8000000
+    assert sampling.capacity(100, 8000000, 600000) == 600000
+    assert sampling.capacity(100, 50, 10) == 50
+
+
+def test_reservoirs_keep_everything_under_capacity():
+    r = sampling.Reservoirs(10, random_state=0)
+
+    r.add(rows(1, 4))
+    r.add(rows(1, 4, start=4))
+    r.add(numpy.array([]))
+    r.add(rows(2, 2))
+
+    labels, percent = r.statistics()
+
+    assert labels.tolist() == [1, 2]
+    assert numpy.allclose(percent, [0.8, 0.2])
+
+    sample = r.sample(labels, [100, 100])
+
+    assert sample[:, 0].tolist() == [1] * 8 + [2] * 2
+    assert sorted(sample[:8, 1].tolist()) == list(range(8))
+    assert sorted(sample[8:, 1].tolist()) == [0, 1]
+
+
+def test_reservoirs_sample_uniformly():
+    capacity = 50
+    seen     = numpy.zeros(1000)
+
+    for seed in range(200):
+        r = sampling.Reservoirs(capacity, random_state=seed)
+
+        for start in range(0, 1000, 90):
+            r.add(rows(3, min(90, 1000 - start), start=start))
+
+        sample = r.sample([3], [capacity])
+
+        assert len(sample) == capacity
+        assert len(numpy.unique(sample[:, 1])) == capacity
+
+        seen[sample[:, 1].astype(int)] += 1
+
+    assert r.counts == {3.0: 1000}
+
+    # every row is kept with probability capacity / rows, 10 times in 200
+    assert abs(seen[:500].mean() - seen[500:].mean()) < 1.5
+    assert abs(seen.mean() - 10) < 0.01
+
+
+def test_reservoirs_sample_fewer():
+    r = sampling.Reservoirs(10, random_state=0)
+    r.add(rows(0, 10))
+
+    sample = r.sample([0], [4])
+
+    assert len(sample) == 4
+    assert len(numpy.unique(sample[:, 1])) == 4
+    assert len(r.sample([5], [4])) == 0
+
+
+def test_seeded_reservoirs_ignore_arrival_order():
+    chips = [(cx, 0, numpy.concatenate([rows(1, 30, start=cx * 100), rows(2, 5, start=cx * 100)]))
+             for cx in range(6)]
+
+    def run(chips):
+        r = sampling.Reservoirs(20, random_state=7)
+
+        for cx, cy, data in chips:
+            r.add(data, keys=sampling.keys(len(data), 7, cx, cy))
+
+        return r.sample(r.statistics()[0], [10, 10])
+
+    first  = run(chips)
+    second = run(list(reversed(chips)))
+
+    assert numpy.array_equal(first, second)
+    assert first[:, 0].tolist() == [1] * 10 + [2] * 10
+    assert not numpy.array_equal(first, run([(cx + 1, cy, d) for cx, cy, d in chips]))
+
+
+def test_reservoirs_on_disk():
+    data = numpy.concatenate([rows(1, 50), rows(2, 8)])
+    keys = numpy.random.RandomState(3).random_sample(len(data))
+
+    memory = sampling.Reservoirs(20)
+    memory.add(data, keys=keys)
+
+    with tempfile.TemporaryDirectory() as d:
+        disk = sampling.Reservoirs(20, directory=d)
+        disk.add(data[:30], keys=keys[:30])
+        disk.add(data[30:], keys=keys[30:])
+
+        sample = disk.sample([1, 2], [10, 10])
+
+        assert isinstance(sample, numpy.memmap)
+        assert numpy.array_equal(sample, memory.sample([1, 2], [10, 10]))
+        assert sorted(os.listdir(d)) == ['rows-1.f32', 'rows-2.f32', 'sample.f32']
+
+
+def test_keys():
+    assert numpy.array_equal(sampling.keys(5, 1, -2115585, 1964805), sampling.keys(5, 1, -2115585, 1964805))
+    assert not numpy.array_equal(sampling.keys(5, 1, 0, 0), sampling.keys(5, 2, 0, 0))